@@ -0,0 +1,273 @@
+#
+# bench_zopfli
+#
+#   Copyright (c) 2026 Akinori Hattori <hattya@gmail.com>
+#
+#   SPDX-License-Identifier: Apache-2.0
+#
+
+"""Benchmarks for ZopfliPy
+
+Each case runs in its own process over a deterministic corpus, and reports
+the throughput, the peak RSS, and the compression ratio.
+
+    $ python benchmarks/bench_zopfli.py               # compare with baseline
+    $ python benchmarks/bench_zopfli.py --save        # update baseline
+    $ python benchmarks/bench_zopfli.py -k png        # select cases
+"""
+
+from __future__ import annotations
+import argparse
+from collections.abc import Callable
+import json
+import os
+import random
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any
+import zipfile
+import zlib
+
+import zopfli
+
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+KiB = 1 << 10
+
+
+#
+# corpus
+#
+
+def text(size: int) -> bytes:
+    rnd = random.Random(size)
+    words = [''.join(rnd.choices('abcdefghijklmnopqrstuvwxyz', k=rnd.randint(2, 10))).encode() for _ in range(2000)]
+    b = bytearray()
+    while len(b) < size:
+        line = b' '.join(rnd.choices(words, k=rnd.randint(4, 16)))
+        b += line[:1].upper() + line[1:] + b'.\n'
+    return bytes(b[:size])
+
+
+def binary(size: int) -> bytes:
+    rnd = random.Random(size)
+    b = bytearray()
+    i = 0
+    while len(b) < size:
+        # records of a counter, small integers, and a float
+        b += struct.pack('<IhhId', i, rnd.randint(-64, 64), rnd.randint(0, 4), rnd.getrandbits(12), rnd.random())
+        i += 1
+    return bytes(b[:size])
+
+
+def incompressible(size: int) -> bytes:
+    return random.Random(size).randbytes(size)
+
+
+def png(size: int, noise: int) -> bytes:
+    rnd = random.Random(size * noise)
+    raw = bytearray()
+    for y in range(size):
+        raw.append(0)
+        for x in range(size):
+            raw += bytes(min(255, max(0, v + rnd.randint(-noise, noise))) for v in (x * 255 // size, y * 255 // size, 128))
+
+    def chunk(type: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + type + data + struct.pack('>I', zlib.crc32(type + data))
+
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(bytes(raw), 6))
+            + chunk(b'IEND', b''))
+
+
+CORPUS: dict[str, Callable[[], bytes]] = {
+    'text': lambda: text(256 * KiB),
+    'binary': lambda: binary(256 * KiB),
+    'random': lambda: incompressible(256 * KiB),
+    'png-64': lambda: png(64, 0),
+    'png-256': lambda: png(256, 0),
+    'png-256-noise': lambda: png(256, 8),
+}
+
+
+#
+# cases
+#
+
+def bench_compressor(name: str) -> Callable[[], bytes]:
+    data = CORPUS[name]()
+
+    def run() -> bytes:
+        c = zopfli.ZopfliCompressor(zopfli.ZOPFLI_FORMAT_DEFLATE)
+        return c.compress(data) + c.flush()
+
+    return run
+
+
+def bench_deflater(name: str, chunk_size: int) -> Callable[[], bytes]:
+    data = CORPUS[name]()
+
+    def run() -> bytes:
+        c = zopfli.ZopfliDeflater()
+        return b''.join(c.compress(data[i:i+chunk_size]) for i in range(0, len(data), chunk_size)) + c.flush()
+
+    return run
+
+
+def bench_many(name: str, size: int) -> Callable[[], bytes]:
+    data = CORPUS[name]()
+
+    def run() -> bytes:
+        return b''.join(zopfli.compress_many([data[i:i+size] for i in range(0, len(data), size)],
+                                             zopfli.ZOPFLI_FORMAT_GZIP, iterations=1))
+
+    return run
+
+
+def bench_png(name: str, **kwargs: Any) -> Callable[[], bytes]:
+    data = CORPUS[name]()
+
+    def run() -> bytes:
+        return zopfli.ZopfliPNG(**kwargs).optimize(data)
+
+    return run
+
+
+def bench_zipfile(tmp: str, names: list[str]) -> Callable[[], bytes]:
+    files = []
+    for n in names:
+        files.append(os.path.join(tmp, n))
+        with open(files[-1], 'wb') as fp:
+            fp.write(CORPUS[n]())
+
+    def run() -> bytes:
+        path = os.path.join(tmp, 'a.zip')
+        with zopfli.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for p in files:
+                zf.write(p, os.path.basename(p))
+        with open(path, 'rb') as fp:
+            return fp.read()
+
+    return run
+
+
+CASES: dict[str, tuple[Callable[[str], Callable[[], bytes]], list[str]]] = {}
+for n in ('text', 'binary', 'random'):
+    CASES[f'compressor/{n}'] = (lambda tmp, n=n: bench_compressor(n), [n])
+for n in ('text', 'binary'):
+    for cs in (16, 64, 256):
+        CASES[f'deflater/{n}/{cs}k'] = (lambda tmp, n=n, cs=cs: bench_deflater(n, cs * KiB), [n])
+CASES['many/text/4k'] = (lambda tmp: bench_many('text', 4 * KiB), ['text'])
+for n in ('png-64', 'png-256', 'png-256-noise'):
+    CASES[f'png/{n[4:]}'] = (lambda tmp, n=n: bench_png(n), [n])
+CASES['png/256-noise/threads'] = (lambda tmp: bench_png('png-256-noise', filter_strategies='01234me', threads=os.cpu_count() or 1),
+                                  ['png-256-noise'])
+CASES['png/256-noise/candidates'] = (lambda tmp: bench_png('png-256-noise', filter_strategies='01234me', filter_candidates=2), ['png-256-noise'])
+CASES['zipfile/write'] = (lambda tmp: bench_zipfile(tmp, ['text', 'binary', 'random']), ['text', 'binary', 'random'])
+
+
+def measure(case: str, repeat: int) -> dict[str, float | None]:
+    setup, names = CASES[case]
+    size = sum(len(CORPUS[n]()) for n in names)
+    elapsed = float('inf')
+    with tempfile.TemporaryDirectory(prefix='zopfli-') as tmp:
+        run = setup(tmp)
+        for _ in range(repeat):
+            start = time.perf_counter()
+            z = run()
+            elapsed = min(elapsed, time.perf_counter() - start)
+    rss = peak_rss()
+    return {
+        'mb_per_s': round(size / elapsed / 1e6, 4),
+        'peak_rss': round(rss, 1) if rss is not None else None,
+        'ratio': round(len(z) / size, 6),
+    }
+
+
+def peak_rss() -> float | None:
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB elsewhere
+    return rss / (1 << 20) if sys.platform == 'darwin' else rss / KiB
+
+
+#
+# driver
+#
+
+def run(cases: list[str], repeat: int) -> dict[str, dict[str, float | None]]:
+    results = {}
+    for case in cases:
+        # peak RSS is per process
+        p = subprocess.run([sys.executable, __file__, '--case', case, '--repeat', str(repeat)],
+                           stdout=subprocess.PIPE, check=True)
+        results[case] = json.loads(p.stdout)
+    return results
+
+
+def compare(results: dict[str, dict[str, float | None]], baseline: dict[str, dict[str, float | None]], threshold: float) -> int:
+    rv = 0
+    print(f'{"case":<24} {"MB/s":>8} {"":>8} {"RSS MiB":>8} {"":>8} {"ratio":>7} {"":>8}')
+    for case, r in results.items():
+        b = baseline.get(case, {})
+        row = [f'{case:<24}']
+        # the ratio is deterministic, and should not grow at all
+        for k, width, fmt, limit in (('mb_per_s', 8, '.3f', -threshold), ('peak_rss', 8, '.1f', threshold), ('ratio', 7, '.4f', 1e-3)):
+            v = r[k]
+            row.append(f'{v:{width}{fmt}}' if v is not None else f'{"-":>{width}}')
+            bv = b.get(k)
+            if v is None or not bv:
+                row.append(f'{"":>8}')
+                continue
+            delta = v / bv - 1
+            regressed = delta < limit if limit < 0 else delta > limit
+            row.append(f'{delta:+8.1%}' + ('!' if regressed else ''))
+            if regressed:
+                rv = 1
+        print(' '.join(row))
+    return rv
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-k', dest='pattern', help='run cases which contain PATTERN')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs per case (default: %(default)s)')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed slowdown and memory growth against the baseline (default: %(default)s)')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline file (default: %(default)s)')
+    parser.add_argument('--save', action='store_true', help='save the results as the baseline')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        json.dump(measure(args.case, args.repeat), sys.stdout)
+        return 0
+
+    cases = [c for c in CASES if not args.pattern or args.pattern in c]
+    results = run(cases, args.repeat)
+    if args.save:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, encoding='utf-8') as fp:
+                baseline = json.load(fp)
+        baseline.update(results)
+        with open(args.baseline, 'w', encoding='utf-8') as fp:
+            json.dump(baseline, fp, indent=2, sort_keys=True)
+            fp.write('\n')
+        return compare(results, {}, args.threshold)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as fp:
+            return compare(results, json.load(fp), args.threshold)
+    return compare(results, {}, args.threshold)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,15 +6,25 @@
 #   SPDX-License-Identifier: Apache-2.0
 #
 
+import asyncio
+import gc
+import gzip
+import io
+import mmap
 import os
+import random
+import struct
 import sys
 import tempfile
 import time
 import unittest
 import unittest.mock
+import weakref
 import zipfile
+import zlib
 
 import zopfli
+import zopfli.aio
 
 
 class ZopfliTestCase(unittest.TestCase):
@@ -40,6 +50,426 @@ class ZopfliTestCase(unittest.TestCase):
             z = c.compress(b) + c.flush()
             self._test_decompress(fmt, z, b)
 
+    def test_chunk_size(self):
+        b = b'Hello, world!' * 1000
+        for fmt in (zopfli.ZOPFLI_FORMAT_GZIP, zopfli.ZOPFLI_FORMAT_ZLIB, zopfli.ZOPFLI_FORMAT_DEFLATE):
+            c = zopfli.ZopfliCompressor(fmt, chunk_size=1024)
+            z = b''.join(c.compress(b[i:i+1000]) for i in range(0, len(b), 1000))
+            self.assertGreater(len(z), 0)
+            z += c.flush()
+            self._test_decompress(fmt, z, b)
+
+            c = zopfli.ZopfliCompressor(fmt, chunk_size=1024)
+            self._test_decompress(fmt, c.flush(), b'')
+
+        with self.assertRaises(TypeError):
+            zopfli.ZopfliCompressor(chunk_size=None)
+        with self.assertRaises(ValueError):
+            zopfli.ZopfliCompressor(chunk_size=-1)
+
+    def test_threads(self):
+        b = b'Hello, world!' * 1000
+        for fmt in (zopfli.ZOPFLI_FORMAT_GZIP, zopfli.ZOPFLI_FORMAT_ZLIB, zopfli.ZOPFLI_FORMAT_DEFLATE):
+            c = zopfli.ZopfliCompressor(fmt, threads=4)
+            z = c.compress(b) + c.flush()
+            self._test_decompress(fmt, z, b)
+
+            c = zopfli.ZopfliCompressor(fmt, chunk_size=1024, threads=4)
+            z = b''.join(c.compress(b[i:i+1000]) for i in range(0, len(b), 1000)) + c.flush()
+            self._test_decompress(fmt, z, b)
+
+        c = zopfli.ZopfliDeflater(threads=4)
+        z = c.compress(b) + c.compress(b) + c.flush()
+        self._test_decompress(zopfli.ZOPFLI_FORMAT_DEFLATE, z, b * 2)
+
+        with self.assertRaises(ValueError):
+            zopfli.ZopfliCompressor(threads=0)
+        with self.assertRaises(ValueError):
+            zopfli.ZopfliDeflater(threads=0)
+
+        # across 2 ZOPFLI_MASTER_BLOCK_SIZE, and each block ends in a partial byte
+        rnd = random.Random(0)
+        b = b''.join(rnd.randbytes(1000000 - 4000) + b'Hello, world!' * 300 for _ in range(3))[:2100000]
+        fmt = zopfli.ZOPFLI_FORMAT_GZIP
+        outputs = []
+        for threads in (1, 4):
+            z = zopfli.compress(b, fmt, iterations=1, threads=threads)
+            self._test_decompress(fmt, z, b)
+            with tempfile.TemporaryFile() as fp:
+                zopfli.compress_fd(b, fp.fileno(), fmt, iterations=1, threads=threads)
+                fp.seek(0)
+                self.assertEqual(fp.read(), z)
+            outputs.append(z)
+        # the blocks are aligned with an empty stored block
+        self.assertGreater(len(outputs[1]), len(outputs[0]))
+        self.assertLessEqual(len(outputs[1]) - len(outputs[0]), 5 * 2)
+
+    def test_budget(self):
+        b = b'Hello, world!' * 1000
+        for kwargs in ({'deadline': 1e-6}, {'min_gain': 1.0}, {'deadline': 60.0, 'min_gain': 1e-6}):
+            for fmt in (zopfli.ZOPFLI_FORMAT_GZIP, zopfli.ZOPFLI_FORMAT_ZLIB, zopfli.ZOPFLI_FORMAT_DEFLATE):
+                c = zopfli.ZopfliCompressor(fmt, **kwargs)
+                self.assertEqual(c.iterations_used, 0)
+                z = c.compress(b) + c.flush()
+                self._test_decompress(fmt, z, b)
+                self.assertGreaterEqual(c.iterations_used, 1)
+                self.assertLessEqual(c.iterations_used, 15)
+
+                c = zopfli.ZopfliCompressor(fmt, chunk_size=1024, threads=2, **kwargs)
+                z = b''.join(c.compress(b[i:i+1000]) for i in range(0, len(b), 1000)) + c.flush()
+                self._test_decompress(fmt, z, b)
+
+            c = zopfli.ZopfliDeflater(**kwargs)
+            z = c.compress(b) + c.compress(b) + c.flush()
+            self._test_decompress(zopfli.ZOPFLI_FORMAT_DEFLATE, z, b * 2)
+            self.assertGreaterEqual(c.iterations_used, 1)
+
+        c = zopfli.ZopfliCompressor(deadline=1e-6)
+        c.compress(b)
+        c.flush()
+        self.assertEqual(c.iterations_used, 1)
+
+        c = zopfli.ZopfliCompressor()
+        c.compress(b)
+        c.flush()
+        self.assertEqual(c.iterations_used, 15)
+
+        # the trials are counted against the deadline
+        rnd = random.Random(0)
+        words = [bytes(rnd.choices(b'abcdefghijklmnop', k=rnd.randint(2, 8))) for _ in range(2000)]
+        b = b' '.join(rnd.choices(words, k=50000))
+        t = time.monotonic()
+        zopfli.compress(b, iterations=1)
+        deadline = (time.monotonic() - t) * 4
+        for kwargs in ({}, {'min_gain': 1e-6}):
+            t = time.monotonic()
+            self._test_decompress(zopfli.ZOPFLI_FORMAT_DEFLATE, zopfli.compress(b, iterations=1000, deadline=deadline, **kwargs), b)
+            self.assertLess(time.monotonic() - t, deadline * 2)
+
+        for kwargs in ({'deadline': -1.0}, {'min_gain': -1.0}):
+            with self.assertRaises(ValueError):
+                zopfli.ZopfliCompressor(**kwargs)
+            with self.assertRaises(ValueError):
+                zopfli.ZopfliDeflater(**kwargs)
+
+    def test_stats(self):
+        b = b'Hello, world!' * 1000
+        for fmt in (zopfli.ZOPFLI_FORMAT_GZIP, zopfli.ZOPFLI_FORMAT_ZLIB, zopfli.ZOPFLI_FORMAT_DEFLATE):
+            for kwargs in ({}, {'chunk_size': 4096}, {'chunk_size': 4096, 'threads': 2, 'min_gain': 1e-6}):
+                stats = []
+                c = zopfli.ZopfliCompressor(fmt, stats_callback=stats.append, **kwargs)
+                z = c.compress(b)
+                self.assertIsNone(c.stats)
+                z += c.flush()
+                self.assertEqual(stats, [c.stats])
+                self.assertEqual(c.stats['bytes_in'], len(b))
+                self.assertEqual(c.stats['bytes_out'], len(z))
+                self.assertEqual(c.stats['segments'], 4 if kwargs else 1)
+                self.assertEqual(c.stats['iterations'], c.iterations_used)
+                self.assertGreater(c.stats['time'], 0)
+                if 'min_gain' in kwargs:
+                    self.assertGreater(c.stats['search_time'], 0)
+                    self.assertLessEqual(c.stats['search_time'], c.stats['time'])
+                else:
+                    self.assertEqual(c.stats['search_time'], 0)
+
+        stats = []
+        c = zopfli.ZopfliDeflater(stats_callback=stats.append)
+        z = c.compress(b) + c.compress(b)
+        self.assertIsNone(c.stats)
+        z += c.flush()
+        self.assertEqual(stats, [c.stats])
+        self.assertEqual(c.stats['bytes_in'], len(b) * 2)
+        self.assertEqual(c.stats['bytes_out'], len(z))
+        self.assertEqual(c.stats['segments'], 2)
+        # the iterations are chosen on the first 64 KiB as a separate segment
+        c = zopfli.ZopfliCompressor(iterations=1, min_gain=1e-6)
+        c.compress(bytes(100000))
+        c.flush()
+        self.assertEqual(c.stats['segments'], 2)
+
+        def callback(stats):
+            raise ZeroDivisionError
+
+        for c in (zopfli.ZopfliCompressor(stats_callback=callback), zopfli.ZopfliDeflater(stats_callback=callback)):
+            c.compress(b)
+            with self.assertRaises(ZeroDivisionError):
+                c.flush()
+
+        with self.assertRaises(TypeError):
+            zopfli.ZopfliCompressor(stats_callback=1)
+        with self.assertRaises(TypeError):
+            zopfli.ZopfliDeflater(stats_callback=1)
+
+    def test_into(self):
+        b = b'Hello, world!' * 1000
+        for new in (lambda: zopfli.ZopfliCompressor(zopfli.ZOPFLI_FORMAT_GZIP),
+                    lambda: zopfli.ZopfliCompressor(zopfli.ZOPFLI_FORMAT_GZIP, chunk_size=4096),
+                    lambda: zopfli.ZopfliDeflater()):
+            c = new()
+            z = c.compress(b) + c.compress(b) + c.flush()
+
+            c = new()
+            buf = bytearray(len(z))
+            i = c.compress_into(b, buf)
+            i += c.compress_into(b, memoryview(buf)[i:])
+            i += c.flush_into(memoryview(buf)[i:])
+            self.assertEqual(buf, z)
+            self.assertEqual(i, len(z))
+            self.assertEqual(c.flush_into(buf), 0)
+            self.assertEqual(c.stats['bytes_out'], len(z))
+
+            # small buffer
+            c = new()
+            buf = bytearray(7)
+            v = b''
+            for d in (b, b):
+                n = c.compress_into(d, buf)
+                v += buf[:n]
+            while True:
+                n = c.flush_into(buf)
+                if n == 0:
+                    break
+                v += buf[:n]
+            self.assertEqual(v, z)
+            self.assertEqual(c.stats['bytes_out'], len(z))
+
+            c = new()
+            v = c.compress(b) + c.compress(b)
+            m = c.flush(memoryview=True)
+            self.assertIsInstance(m, memoryview)
+            self.assertTrue(m.readonly)
+            self.assertEqual(v + m, z)
+            self.assertEqual(c.flush_into(bytearray(1)), 0)
+            with self.assertRaises(ValueError):
+                c.flush()
+
+            c = new()
+            with self.assertRaises(TypeError):
+                c.compress_into(b, b'')
+            with self.assertRaises(TypeError):
+                c.flush_into(b'')
+
+        for c in (zopfli.ZopfliCompressor(), zopfli.ZopfliDeflater()):
+            m = c.flush(memoryview=True)
+            self.assertIsInstance(m, memoryview)
+
+    def test_zdict(self):
+        zdict = b'{"id": 0, "name": "", "tags": []}'
+        b = b'{"id": 1, "name": "zopfli", "tags": ["zlib"]}'
+        for fmt in (zopfli.ZOPFLI_FORMAT_ZLIB, zopfli.ZOPFLI_FORMAT_DEFLATE):
+            for new, kwargs in ((zopfli.ZopfliCompressor, {'format': fmt}),
+                                (zopfli.ZopfliCompressor, {'format': fmt, 'chunk_size': 16}),
+                                (zopfli.ZopfliDeflater, {})):
+                if (new is zopfli.ZopfliDeflater
+                    and fmt != zopfli.ZOPFLI_FORMAT_DEFLATE):
+                    continue
+                c = new(zdict=zdict, **kwargs)
+                z = c.compress(b) + c.flush()
+                self._test_decompress(fmt, z, b, zdict)
+                c = new(zdict=memoryview(zdict), **kwargs)
+                self.assertEqual(c.compress(b) + c.flush(), z)
+                c = new(**kwargs)
+                self.assertLess(len(z), len(c.compress(b) + c.flush()))
+            # longer than the window
+            zdict_ = os.urandom(1 << 16) + zdict
+            c = zopfli.ZopfliCompressor(fmt, zdict=zdict_)
+            self._test_decompress(fmt, c.compress(b) + c.flush(), b, zdict_)
+
+        c = zopfli.ZopfliCompressor(zopfli.ZOPFLI_FORMAT_ZLIB, zdict=zdict)
+        z = c.compress(b) + c.flush()
+        self.assertEqual(z[:2], b'\x78\xf9')
+        self.assertEqual(int.from_bytes(z[2:6], 'big'), zlib.adler32(zdict))
+        self.assertEqual(zlib.decompressobj(zdict=zdict).decompress(z), b)
+        with self.assertRaises(zlib.error):
+            zlib.decompress(z)
+
+        with self.assertRaises(ValueError):
+            zopfli.ZopfliCompressor(zopfli.ZOPFLI_FORMAT_GZIP, zdict=zdict)
+        with self.assertRaises(ValueError):
+            zopfli.ZopfliDecompressor(zopfli.ZOPFLI_FORMAT_GZIP, zdict=zdict)
+        with self.assertRaises(TypeError):
+            zopfli.ZopfliCompressor(zdict='')
+        with self.assertRaises(TypeError):
+            zopfli.ZopfliDeflater(zdict='')
+        with self.assertRaises(ValueError):
+            zopfli.GzipFile(fileobj=io.BytesIO(), mode='wb', zdict=zdict)
+        with zopfli.ZipFile(io.BytesIO(), 'w') as zf:
+            with self.assertRaises(ValueError):
+                zf.writestr('a.txt', b, zdict=zdict)
+
+    def test_cancel(self):
+        for c in (zopfli.ZopfliCompressor(), zopfli.ZopfliCompressor(chunk_size=1024), zopfli.ZopfliDeflater()):
+            c.compress(b'Hello, world!')
+            c.cancel()
+            c.cancel()
+            with self.assertRaises(RuntimeError):
+                c.compress(b'Hello, world!')
+            with self.assertRaises(RuntimeError):
+                c.flush()
+
+    def test_compress(self):
+        b = b'Hello, world!' * 1000
+        for fmt, func in ((zopfli.ZOPFLI_FORMAT_GZIP, zopfli.gzip_compress),
+                          (zopfli.ZOPFLI_FORMAT_ZLIB, zopfli.zlib_compress),
+                          (zopfli.ZOPFLI_FORMAT_DEFLATE, None)):
+            for kwargs in ({}, {'block_splitting': False}, {'threads': 2}, {'min_gain': 1e-6}):
+                c = zopfli.ZopfliCompressor(fmt, **kwargs)
+                z = c.compress(b) + c.flush()
+                self.assertEqual(zopfli.compress(b, fmt, **kwargs), z)
+                self.assertEqual(zopfli.compress(data=memoryview(b), format=fmt, **kwargs), z)
+                if func is not None:
+                    self.assertEqual(func(bytearray(b), **kwargs), z)
+        self.assertEqual(zopfli.compress(b''), b'\x03\x00')
+
+        with tempfile.TemporaryFile() as fp:
+            fp.write(b)
+            fp.flush()
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                self._test_decompress(zopfli.ZOPFLI_FORMAT_DEFLATE, zopfli.compress(m), b)
+
+        with self.assertRaises(TypeError):
+            zopfli.compress('')
+        with self.assertRaises(TypeError):
+            zopfli.gzip_compress(b, format=zopfli.ZOPFLI_FORMAT_ZLIB)
+        with self.assertRaises(ValueError):
+            zopfli.compress(b, -1)
+        with self.assertRaises(ValueError):
+            zopfli.compress(b, threads=0)
+        with self.assertRaises(ValueError):
+            zopfli.zlib_compress(b, deadline=-1)
+
+    def test_compress_file(self):
+        with tempfile.TemporaryDirectory(prefix='zopfli-') as tmp:
+            src = os.path.join(tmp, 'src')
+            dst = os.path.join(tmp, 'dst')
+            # across ZOPFLI_MASTER_BLOCK_SIZE
+            for data in (b'', b'Hello, world!', bytes(1000000 + 1)):
+                with open(src, 'wb') as fp:
+                    fp.write(data)
+                for fmt in (zopfli.ZOPFLI_FORMAT_GZIP, zopfli.ZOPFLI_FORMAT_ZLIB, zopfli.ZOPFLI_FORMAT_DEFLATE):
+                    for kwargs in ({}, {'threads': 2}):
+                        zopfli.compress_file(src, dst, fmt, **kwargs)
+                        with open(dst, 'rb') as fp:
+                            z = fp.read()
+                        if 'threads' not in kwargs:
+                            self.assertEqual(z, zopfli.compress(data, fmt, **kwargs))
+                        self._test_decompress(fmt, z, data)
+
+            with self.assertRaises(ValueError):
+                zopfli.compress_file(src, src)
+            with self.assertRaises(FileNotFoundError):
+                zopfli.compress_file(os.path.join(tmp, 'none'), dst)
+            with self.assertRaises(ValueError):
+                zopfli.compress_file(src, dst, -1)
+            with self.assertRaises(ValueError):
+                zopfli.compress_fd(b'', -1)
+            r, w = os.pipe()
+            os.close(r)
+            try:
+                with self.assertRaises(OSError):
+                    zopfli.compress_fd(b'', w)
+            finally:
+                os.close(w)
+
+    def test_decompress_into(self):
+        b = b'Hello, world!' * 1000
+        for fmt in (zopfli.ZOPFLI_FORMAT_GZIP, zopfli.ZOPFLI_FORMAT_ZLIB, zopfli.ZOPFLI_FORMAT_DEFLATE):
+            z = zopfli.compress(b, fmt)
+
+            d = zopfli.ZopfliDecompressor(fmt)
+            buf = bytearray(len(b))
+            i = d.decompress_into(z[:10], buf)
+            i += d.decompress_into(z[10:], memoryview(buf)[i:])
+            i += d.flush_into(memoryview(buf)[i:])
+            self.assertEqual(buf, b)
+            self.assertEqual(i, len(b))
+            self.assertEqual(d.flush_into(buf), 0)
+            self.assertTrue(d.eof)
+
+            # small buffer
+            d = zopfli.ZopfliDecompressor(fmt)
+            buf = bytearray(7)
+            v = b''
+            for data in (z[:10], b'', z[10:]):
+                n = d.decompress_into(data, buf)
+                v += buf[:n]
+            while True:
+                n = d.flush_into(buf)
+                if n == 0:
+                    break
+                v += buf[:n]
+            self.assertEqual(v, b)
+            self.assertEqual(d.unconsumed_tail, b'')
+            self.assertTrue(d.eof)
+
+            d = zopfli.ZopfliDecompressor(fmt)
+            v = b''.join(buf[:d.decompress_into(z, buf)] for buf in (bytearray(10), bytearray(0)))
+            self.assertEqual(v + d.decompress(b'') + d.flush(), b)
+
+            d = zopfli.ZopfliDecompressor(fmt)
+            with self.assertRaises(TypeError):
+                d.decompress_into(z, b'')
+            with self.assertRaises(TypeError):
+                d.flush_into(bytes(1))
+
+    def test_decompress_file(self):
+        with tempfile.TemporaryDirectory(prefix='zopfli-') as tmp:
+            src = os.path.join(tmp, 'src')
+            dst = os.path.join(tmp, 'dst')
+            for data in (b'', b'Hello, world!', b'Hello, world!' * 10000):
+                for fmt in (zopfli.ZOPFLI_FORMAT_GZIP, zopfli.ZOPFLI_FORMAT_ZLIB, zopfli.ZOPFLI_FORMAT_DEFLATE):
+                    with open(src, 'wb') as fp:
+                        fp.write(zopfli.compress(data, fmt))
+                    for kwargs in ({}, {'chunk_size': 7}):
+                        zopfli.decompress_file(src, dst, fmt, **kwargs)
+                        with open(dst, 'rb') as fp:
+                            self.assertEqual(fp.read(), data)
+
+            zdict = b'Hello, world!'
+            with open(src, 'wb') as fp:
+                c = zopfli.ZopfliCompressor(zopfli.ZOPFLI_FORMAT_ZLIB, zdict=zdict)
+                fp.write(c.compress(zdict) + c.flush())
+            zopfli.decompress_file(src, dst, zopfli.ZOPFLI_FORMAT_ZLIB, zdict=zdict)
+            with open(dst, 'rb') as fp:
+                self.assertEqual(fp.read(), zdict)
+
+            with open(src, 'wb') as fp:
+                fp.write(zopfli.compress(b'Hello, world!', zopfli.ZOPFLI_FORMAT_GZIP)[:-4])
+            with self.assertRaises(EOFError):
+                zopfli.decompress_file(src, dst, zopfli.ZOPFLI_FORMAT_GZIP)
+            with self.assertRaises(ValueError):
+                zopfli.decompress_file(src, src)
+            with self.assertRaises(ValueError):
+                zopfli.decompress_file(src, dst, chunk_size=0)
+            with self.assertRaises(FileNotFoundError):
+                zopfli.decompress_file(os.path.join(tmp, 'none'), dst)
+
+    def test_compress_many(self):
+        data = [b'Hello, world!' * i for i in range(20)]
+        for fmt in (zopfli.ZOPFLI_FORMAT_GZIP, zopfli.ZOPFLI_FORMAT_ZLIB, zopfli.ZOPFLI_FORMAT_DEFLATE):
+            for kwargs in ({}, {'workers': 1}, {'workers': 4, 'iterations': 1}, {'min_gain': 1e-6}):
+                z = [zopfli.compress(b, fmt, **{k: v for k, v in kwargs.items() if k != 'workers'}) for b in data]
+                self.assertEqual(zopfli.compress_many(data, fmt, **kwargs), z)
+                self.assertEqual(zopfli.compress_many(iter(data), format=fmt, **kwargs), z)
+                self.assertEqual(list(zopfli.compress_iter(data, fmt, batch_size=7, **kwargs)), z)
+        self.assertEqual(zopfli.compress_many([]), [])
+        self.assertEqual(list(zopfli.compress_iter([])), [])
+        self.assertEqual(zopfli.compress_many([bytearray(b'a'), memoryview(b'a')]), [b'K\x04\x00'] * 2)
+
+        with self.assertRaises(TypeError):
+            zopfli.compress_many(None)
+        with self.assertRaises(TypeError):
+            zopfli.compress_many([b'', ''])
+        with self.assertRaises(ValueError):
+            zopfli.compress_many([], -1)
+        with self.assertRaises(ValueError):
+            zopfli.compress_many([], workers=-1)
+        with self.assertRaises(ValueError):
+            zopfli.compress_many([], deadline=-1)
+        with self.assertRaises(ValueError):
+            next(zopfli.compress_iter([], batch_size=0))
+
     def test_unknown(self):
         with self.assertRaises(ValueError):
             zopfli.ZopfliCompressor(-1)
@@ -74,6 +504,12 @@ class ZopfliTestCase(unittest.TestCase):
             z = c.compress(b) + c.compress(b) + c.compress(b) + c.flush()
             self._test_decompress(zopfli.ZOPFLI_FORMAT_DEFLATE, z, b * 3)
 
+            c = zopfli.ZopfliDeflater(block_splitting=i)
+            b = b'Hello, world!'
+            z = b''.join(c.compress(b) for _ in range(100)) + c.flush()
+            self._test_decompress(zopfli.ZOPFLI_FORMAT_DEFLATE, z, b * 100)
+            self.assertLess(len(z), len(b) * 100 // 4)
+
         with self.assertRaises(TypeError):
             zopfli.ZopfliDeflater(iterations=None)
 
@@ -92,8 +528,8 @@ class ZopfliTestCase(unittest.TestCase):
         with self.assertRaises(ValueError):
             c.flush()
 
-    def _test_decompress(self, fmt, z, b):
-        d = zopfli.ZopfliDecompressor(fmt)
+    def _test_decompress(self, fmt, z, b, zdict=None):
+        d = zopfli.ZopfliDecompressor(fmt, zdict=zdict)
         self.assertEqual(d.decompress(z) + d.flush(), b)
         self.assertEqual(d.unused_data, b'')
         self.assertEqual(d.unconsumed_tail, b'')
@@ -110,6 +546,24 @@ black_png = (
 )
 
 
+def noise_png(size):
+    # 8-bit RGB PNG (size x size pixels) of a gradient with noise
+    rnd = random.Random(size)
+    raw = bytearray()
+    for y in range(size):
+        raw.append(0)
+        for x in range(size):
+            raw += bytes(min(255, max(0, v + rnd.randint(-8, 8))) for v in (x * 255 // size, y * 255 // size, 128))
+
+    def chunk(type, data):
+        return struct.pack('>I', len(data)) + type + data + struct.pack('>I', zlib.crc32(type + data))
+
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(bytes(raw), 6))
+            + chunk(b'IEND', b''))
+
+
 class ZopfliPNGTestCase(unittest.TestCase):
 
     def test_verbose(self):
@@ -264,6 +718,163 @@ class ZopfliPNGTestCase(unittest.TestCase):
         with self.assertRaises(TypeError):
             del zopfli.ZopfliPNG().iterations_large
 
+    def test_threads(self):
+        png = zopfli.ZopfliPNG()
+        self.assertEqual(png.threads, 1)
+
+        png.threads = 4
+        self.assertEqual(png.threads, 4)
+
+        for fs in ('01234mep', 'pem43210', '0', ''):
+            b = zopfli.ZopfliPNG(filter_strategies=fs, iterations=1, iterations_large=1).optimize(black_png)
+            for kwargs in ({'threads': 2}, {'threads': 16}, {'threads': 4, 'min_gain': 1e-6}):
+                png = zopfli.ZopfliPNG(filter_strategies=fs, iterations=1, iterations_large=1, **kwargs)
+                self.assertEqual(png.optimize(black_png), b)
+        # the remaining filter strategies are skipped after the deadline
+        b = noise_png(64)
+        png = zopfli.ZopfliPNG(filter_strategies='01234mep')
+        png.optimize(b)
+        self.assertEqual(png.stats['filter_strategy'], 'e')
+        png.deadline = 1e-6
+        png.optimize(b)
+        self.assertEqual(png.stats['filter_strategy'], '0')
+
+        with self.assertRaises(ValueError):
+            zopfli.ZopfliPNG(threads=0)
+        with self.assertRaises(ValueError):
+            zopfli.ZopfliPNG().threads = 0
+        with self.assertRaises(TypeError):
+            zopfli.ZopfliPNG().threads = None
+        with self.assertRaises(TypeError):
+            del zopfli.ZopfliPNG().threads
+
+    def test_filter_candidates(self):
+        png = zopfli.ZopfliPNG()
+        self.assertEqual(png.filter_candidates, 0)
+        png.optimize(black_png)
+        self.assertIsNone(png.stats['filter_estimates'])
+
+        png.filter_candidates = 2
+        self.assertEqual(png.filter_candidates, 2)
+
+        for fs, n in (('', 8), ('01234mep', 8), ('4m', 2), ('0', 1)):
+            b = zopfli.ZopfliPNG(filter_strategies=fs, iterations=1, iterations_large=1).optimize(black_png)
+            for kwargs in ({'filter_candidates': 1}, {'filter_candidates': 16}, {'filter_candidates': 2, 'threads': 4, 'min_gain': 1e-6}):
+                png = zopfli.ZopfliPNG(filter_strategies=fs, iterations=1, iterations_large=1, **kwargs)
+                self.assertEqual(len(png.optimize(black_png)), len(b))
+                self.assertEqual(len(png.stats['filter_estimates']), n)
+                self.assertIn(png.stats['filter_strategy'], png.stats['filter_estimates'])
+
+        with self.assertRaises(ValueError):
+            zopfli.ZopfliPNG(filter_candidates=-1)
+        with self.assertRaises(ValueError):
+            zopfli.ZopfliPNG().filter_candidates = -1
+        with self.assertRaises(TypeError):
+            zopfli.ZopfliPNG().filter_candidates = None
+        with self.assertRaises(TypeError):
+            del zopfli.ZopfliPNG().filter_candidates
+
+    def test_verify(self):
+        png = zopfli.ZopfliPNG()
+        self.assertEqual(png.verify, 'full')
+
+        for v in ('header', 'none', 'full'):
+            png.verify = v
+            self.assertEqual(png.verify, v)
+            self.assertGreater(len(black_png), len(png.optimize(black_png)))
+
+            png = zopfli.ZopfliPNG(verify=v)
+            self.assertEqual(png.verify, v)
+
+        with self.assertRaises(TypeError):
+            zopfli.ZopfliPNG(verify=None)
+        with self.assertRaises(ValueError):
+            zopfli.ZopfliPNG(verify='spam')
+        with self.assertRaises(ValueError):
+            zopfli.ZopfliPNG().verify = 'spam'
+        with self.assertRaises(TypeError):
+            del zopfli.ZopfliPNG().verify
+
+    def test_budget(self):
+        png = zopfli.ZopfliPNG()
+        self.assertEqual(png.deadline, 0.0)
+        self.assertEqual(png.min_gain, 0.0)
+        self.assertEqual(png.iterations_used, 0)
+        png.optimize(black_png)
+        self.assertEqual(png.iterations_used, 15)
+
+        for n in ('deadline', 'min_gain'):
+            png = zopfli.ZopfliPNG(**{n: 1e-6})
+            self.assertEqual(getattr(png, n), 1e-6)
+            self.assertGreater(len(black_png), len(png.optimize(black_png)))
+            self.assertGreaterEqual(png.iterations_used, 1)
+            self.assertLessEqual(png.iterations_used, 15)
+
+            setattr(png, n, 0)
+            self.assertEqual(getattr(png, n), 0.0)
+            with self.assertRaises(TypeError):
+                setattr(png, n, None)
+            with self.assertRaises(ValueError):
+                setattr(png, n, -1)
+            with self.assertRaises(ValueError):
+                zopfli.ZopfliPNG(**{n: -1})
+            with self.assertRaises(TypeError):
+                delattr(png, n)
+        with self.assertRaises(AttributeError):
+            png.iterations_used = 1
+
+        # the trials are counted against the deadline
+        b = noise_png(256)
+        t = time.monotonic()
+        zopfli.ZopfliPNG(iterations=1, iterations_large=1).optimize(b)
+        deadline = (time.monotonic() - t) * 4
+        for kwargs in ({}, {'min_gain': 1e-6}):
+            png = zopfli.ZopfliPNG(iterations=1000, iterations_large=1000, deadline=deadline, **kwargs)
+            t = time.monotonic()
+            png.optimize(b)
+            self.assertLess(time.monotonic() - t, deadline * 2)
+
+    def test_stats(self):
+        stats = []
+        png = zopfli.ZopfliPNG(stats_callback=stats.append)
+        self.assertIsNone(png.stats)
+        self.assertEqual(png.stats_callback, stats.append)
+        b = png.optimize(black_png)
+        self.assertEqual(stats, [png.stats])
+        self.assertEqual(png.stats['bytes_in'], len(black_png))
+        self.assertEqual(png.stats['bytes_out'], len(b))
+        self.assertEqual(png.stats['iterations'], 15)
+        self.assertGreater(png.stats['time'], 0)
+        self.assertEqual(png.stats['search_time'], 0)
+        # all scanlines use filter type 0
+        self.assertEqual(png.stats['filter_strategy'], '0')
+        for fs, v in (('e', 'e'), ('40', '0'), ('34', '3'), ('1m', 'm')):
+            png.filter_strategies = fs
+            png.optimize(black_png)
+            self.assertEqual(png.stats['filter_strategy'], v)
+
+        stats.clear()
+        self.assertEqual(len(list(png.optimize_many([black_png, black_png]))), 2)
+        self.assertEqual(len(stats), 2)
+
+        png.stats_callback = None
+        self.assertIsNone(png.stats_callback)
+        png.optimize(black_png)
+        with self.assertRaises(TypeError):
+            png.stats_callback = 1
+        with self.assertRaises(TypeError):
+            del png.stats_callback
+        with self.assertRaises(AttributeError):
+            png.stats = None
+        with self.assertRaises(TypeError):
+            zopfli.ZopfliPNG(stats_callback=1)
+
+    def test_cancel(self):
+        png = zopfli.ZopfliPNG()
+        png.cancel()
+        with self.assertRaises(RuntimeError):
+            png.optimize(black_png)
+
     def test_optimize(self):
         png = zopfli.ZopfliPNG()
         self.assertGreater(len(black_png), len(png.optimize(black_png)))
@@ -273,6 +884,296 @@ class ZopfliPNGTestCase(unittest.TestCase):
         with self.assertRaises(ValueError):
             png.optimize(b'')
 
+    def test_optimize_file(self):
+        stats = []
+        png = zopfli.ZopfliPNG(stats_callback=stats.append)
+        b = png.optimize(black_png)
+        with tempfile.TemporaryDirectory(prefix='zopfli-') as path:
+            src = os.path.join(path, 'black.png')
+            dst = os.path.join(path, 'out.png')
+            with open(src, 'wb') as fp:
+                fp.write(black_png)
+            self.assertIsNone(png.optimize_file(src, dst))
+            with open(dst, 'rb') as fp:
+                self.assertEqual(fp.read(), b)
+            self.assertEqual(len(stats), 2)
+            self.assertEqual(png.stats['bytes_out'], len(b))
+            # in place
+            png.optimize_file(src, src)
+            with open(src, 'rb') as fp:
+                self.assertEqual(fp.read(), b)
+
+            with self.assertRaises(FileNotFoundError):
+                png.optimize_file(os.path.join(path, 'white.png'), dst)
+            with self.assertRaises(OSError):
+                png.optimize_file(src, os.path.join(path, 'none', 'out.png'))
+            with open(src, 'wb'):
+                pass
+            with self.assertRaises(ValueError):
+                png.optimize_file(src, dst)
+
+        with self.assertRaises(TypeError):
+            png.optimize_file(None, None)
+
+    def test_optimize_many(self):
+        png = zopfli.ZopfliPNG()
+        b = png.optimize(black_png)
+        with tempfile.TemporaryDirectory(prefix='zopfli-') as path:
+            p = os.path.join(path, 'black.png')
+            with open(p, 'wb') as fp:
+                fp.write(black_png)
+            self.assertEqual(list(png.optimize_many([black_png, bytearray(black_png), p], workers=2)), [b] * 3)
+            self.assertEqual(sorted(png.optimize_many([black_png, p], ordered=False)), [(0, b), (1, b)])
+
+            it = png.optimize_many([b'', black_png, os.path.join(path, 'white.png')])
+            with self.assertRaises(ValueError):
+                next(it)
+            self.assertEqual(next(it), b)
+            with self.assertRaises(ValueError):
+                next(it)
+            self.assertEqual(list(it), [])
+
+        self.assertEqual(list(png.optimize_many([])), [])
+        with self.assertRaises(TypeError):
+            png.optimize_many(None)
+        with self.assertRaises(TypeError):
+            png.optimize_many([None])
+        with self.assertRaises(ValueError):
+            png.optimize_many([], workers=-1)
+
+        class Callback:
+
+            def __call__(self, stats):
+                pass
+
+        png = zopfli.ZopfliPNG(stats_callback=Callback())
+        png.stats_callback.it = png.optimize_many([black_png])
+        r = weakref.ref(png.stats_callback)
+        del png
+        gc.collect()
+        self.assertIsNone(r())
+
+
+class GzipFileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory(prefix='zopfli-')
+        self.path = self._dir.name
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_write(self):
+        b = b'Hello, world!' * 1000
+        path = os.path.join(self.path, 'a.gz')
+        with zopfli.GzipFile(path, 'wb', mtime=0, chunk_size=4096) as fp:
+            for i in range(0, len(b), 1000):
+                fp.write(b[i:i+1000])
+            fp.flush()
+        with open(path, 'rb') as fp:
+            z = fp.read()
+        self.assertEqual(z[:3], b'\x1f\x8b\x08')
+        self.assertEqual(z[8], 2)
+        self.assertEqual(gzip.decompress(z), b)
+
+        with zopfli.GzipFile(path) as fp:
+            self.assertEqual(fp.read(), b)
+
+        with self.assertRaises(ValueError):
+            zopfli.GzipFile(path, 'wb', chunk_size=0)
+
+    def test_open(self):
+        path = os.path.join(self.path, 'a.txt.gz')
+        with zopfli.open(path, 'wt', encoding='utf-8', iterations=1) as fp:
+            fp.write('Hello, world!\n' * 100)
+        with gzip.open(path, 'rt', encoding='utf-8') as fp:
+            self.assertEqual(fp.read(), 'Hello, world!\n' * 100)
+        with zopfli.open(path, 'rt', encoding='utf-8') as fp:
+            self.assertEqual(fp.read(), 'Hello, world!\n' * 100)
+
+        b = io.BytesIO()
+        with zopfli.open(b, 'wb') as fp:
+            fp.write(b'Hello, world!')
+        self.assertEqual(gzip.decompress(b.getvalue()), b'Hello, world!')
+
+        # empty
+        with zopfli.open(path, 'wb'):
+            pass
+        with open(path, 'rb') as fp:
+            self.assertEqual(gzip.decompress(fp.read()), b'')
+        with zopfli.open(path, 'rb') as fp:
+            self.assertEqual(fp.read(), b'')
+
+        with self.assertRaises(ValueError):
+            zopfli.open(path, 'rbt')
+        for n in ('encoding', 'errors', 'newline'):
+            with self.assertRaises(ValueError):
+                zopfli.open(path, 'rb', **{n: ''})
+        with self.assertRaises(TypeError):
+            zopfli.open(None)
+
+
+class ZopfliCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory(prefix='zopfli-')
+        self.path = self._dir.name
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_compressor(self):
+        cache = zopfli.ZopfliCache(self.path)
+        data = b'Hello, world!' * 100
+        for fmt in (zopfli.ZOPFLI_FORMAT_GZIP, zopfli.ZOPFLI_FORMAT_ZLIB, zopfli.ZOPFLI_FORMAT_DEFLATE):
+            c = zopfli.ZopfliCompressor(fmt)
+            b = c.compress(data) + c.flush()
+            c = cache.compressor(fmt)
+            self.assertEqual(c.compress(data) + c.flush(), b)
+        self.assertEqual(len(self._entries()), 3)
+        # hit
+        for p in self._entries():
+            with open(p, 'wb') as fp:
+                fp.write(b'cached')
+        c = cache.compressor(zopfli.ZOPFLI_FORMAT_DEFLATE)
+        self.assertEqual(c.compress(data[:10]) + c.compress(data[10:]) + c.flush(), b'cached')
+        # different options
+        c = cache.compressor(zopfli.ZOPFLI_FORMAT_DEFLATE, iterations=1)
+        self.assertNotEqual(c.compress(data) + c.flush(), b'cached')
+        self.assertEqual(len(self._entries()), 4)
+
+        cache.clear()
+        self.assertEqual(self._entries(), [])
+
+        with self.assertRaises(ValueError):
+            cache.compressor(chunk_size=1)
+        with self.assertRaises(ValueError):
+            zopfli.ZopfliCache(self.path, max_size=-1)
+
+    def test_optimize(self):
+        cache = zopfli.ZopfliCache(self.path)
+        png = zopfli.ZopfliPNG()
+        b = png.optimize(black_png)
+        self.assertEqual(cache.optimize(png, black_png), b)
+        self.assertEqual(len(self._entries()), 1)
+        png.iterations = 1
+        cache.optimize(png, black_png)
+        self.assertEqual(len(self._entries()), 2)
+        png.min_gain = 0.5
+        cache.optimize(png, black_png)
+        self.assertEqual(len(self._entries()), 3)
+
+    def test_evict(self):
+        cache = zopfli.ZopfliCache(self.path, max_size=250)
+        for i in range(3):
+            cache.set(f'{i:02x}', bytes(100))
+            os.utime(os.path.join(self.path, f'{i:02x}', f'{i:02x}'), (i, i))
+        self.assertEqual(sorted(os.path.basename(p) for p in self._entries()), ['01', '02'])
+        # 01 was used recently
+        self.assertEqual(cache.get('01'), bytes(100))
+        cache.set('03', bytes(100))
+        self.assertIsNone(cache.get('02'))
+        self.assertIsNotNone(cache.get('01'))
+        self.assertIsNotNone(cache.get('03'))
+        # too large
+        cache.set('04', bytes(251))
+        self.assertIsNone(cache.get('04'))
+
+        # the entries are scanned on the first set(), and after that only when
+        # the total size exceeds max_size
+        cache = zopfli.ZopfliCache(os.path.join(self.path, 'scan'), max_size=1000)
+        with unittest.mock.patch.object(cache, '_entries', wraps=cache._entries) as m:
+            for i in range(10):
+                cache.set(f'{i:02x}', bytes(100))
+            self.assertEqual(m.call_count, 1)
+            cache.set('0a', bytes(100))
+            self.assertEqual(m.call_count, 2)
+            cache.set('0b', bytes(100))
+            self.assertEqual(m.call_count, 2)
+        # evicted below max_size
+        self.assertEqual(len(cache._entries()), 10)
+
+    def _entries(self):
+        return [os.path.join(r, n) for r, _, files in os.walk(self.path) for n in files]
+
+
+class AioTestCase(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory(prefix='zopfli-')
+        self.path = self._dir.name
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    async def test_compress(self):
+        b = b'Hello, world!' * 100
+        for fmt in (zopfli.ZOPFLI_FORMAT_GZIP, zopfli.ZOPFLI_FORMAT_ZLIB, zopfli.ZOPFLI_FORMAT_DEFLATE):
+            c = zopfli.ZopfliCompressor(fmt)
+            self.assertEqual(await zopfli.aio.compress(b, fmt), c.compress(b) + c.flush())
+
+        png = zopfli.ZopfliPNG()
+        self.assertEqual(await zopfli.aio.optimize_png(black_png), png.optimize(black_png))
+        with self.assertRaises(ValueError):
+            await zopfli.aio.optimize_png(b'')
+
+    async def test_cancel(self):
+        b = b''.join(b'%d spam eggs ham\n' % i for i in range(10000))
+        t = time.monotonic()
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(zopfli.aio.compress(b, chunk_size=4096, iterations=100), 0.1)
+        self.assertLess(time.monotonic() - t, 3.0)
+
+        # stopped before the next filter strategy
+        b = noise_png(256)
+        t = time.monotonic()
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(zopfli.aio.optimize_png(b, filter_strategies='01234mep'), 0.1)
+        self.assertLess(time.monotonic() - t, 3.0)
+
+    async def test_zipfile(self):
+        path = os.path.join(self.path, 'a.txt')
+        with open(path, 'wb') as fp:
+            fp.write(b'spam')
+        with zopfli.ZipFile(os.path.join(self.path, 'a.zip'), 'w', zipfile.ZIP_DEFLATED) as zf:
+            await zopfli.aio.write(zf, path, 'spam.txt')
+            await zopfli.aio.write(zf, path, 'eggs.txt', zipfile.ZIP_STORED)
+            await zopfli.aio.writestr(zf, 'ham.txt', 'ham')
+            await zopfli.aio.writestr(zf, 'toast.txt', b'toast', zipfile.ZIP_STORED)
+        with zopfli.ZipFile(os.path.join(self.path, 'a.zip')) as zf:
+            for n, compress_type in (
+                ('spam.txt', zipfile.ZIP_DEFLATED),
+                ('eggs.txt', zipfile.ZIP_STORED),
+                ('ham.txt', zipfile.ZIP_DEFLATED),
+                ('toast.txt', zipfile.ZIP_STORED),
+            ):
+                self.assertEqual(zf.getinfo(n).compress_type, compress_type)
+            self.assertEqual(zf.read('spam.txt'), b'spam')
+            self.assertEqual(zf.read('eggs.txt'), b'spam')
+            self.assertEqual(zf.read('ham.txt'), b'ham')
+            self.assertEqual(zf.read('toast.txt'), b'toast')
+
+    def test_set_max_workers(self):
+        try:
+            zopfli.aio.set_max_workers(1)
+            self.assertEqual(zopfli.aio._get_executor()._max_workers, 1)
+        finally:
+            zopfli.aio.set_max_workers(None)
+        with self.assertRaises(ValueError):
+            zopfli.aio.set_max_workers(0)
+
+
+class Unseekable(io.RawIOBase):
+
+    def __init__(self, fp):
+        self._fp = fp
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        return self._fp.write(b)
+
 
 @unittest.mock.patch('time.time')
 class ZipFileTest(unittest.TestCase):
@@ -335,6 +1236,302 @@ class ZipFileTest(unittest.TestCase):
         self._test_encode(encoding, names)
         self._test_zip(encoding, names)
 
+    def test_write_many(self, time):
+        time.return_value = self.time
+
+        folder = os.path.join(self.path, 'New Folder')
+        os.mkdir(folder)
+        files = [folder]
+        for i, n in enumerate(('spam', 'eggs', 'ham', 'toast')):
+            p = os.path.join(folder, f'{n}.txt')
+            with open(p, 'w') as fp:
+                fp.write(n * i * 100)
+            os.utime(p, (self.time,) * 2)
+            files.append(p)
+        os.utime(folder, (self.time,) * 2)
+
+        for compress_type in (zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED):
+            path = os.path.join(self.path, 'serial.zip')
+            with zopfli.ZipFile(path, 'w', compress_type) as zf:
+                for p in files:
+                    zf.write(p, os.path.relpath(p, self.path))
+            with open(path, 'rb') as fp:
+                serial = fp.read()
+
+            path = os.path.join(self.path, 'parallel.zip')
+            with zopfli.ZipFile(path, 'w', compress_type) as zf:
+                zf.write_many(((p, os.path.relpath(p, self.path)) for p in files), workers=4)
+            with open(path, 'rb') as fp:
+                self.assertEqual(fp.read(), serial)
+
+        # up to 2 files per worker are pending
+        consumed = []
+
+        def items():
+            for p in files:
+                consumed.append(p)
+                yield p, os.path.relpath(p, self.path)
+
+        with zopfli.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            write = zf._write
+
+            def _write(filename, *args):
+                self.assertLessEqual(len(consumed) - files.index(filename), 2 + 1)
+                return write(filename, *args)
+
+            with unittest.mock.patch.object(zf, '_write', side_effect=_write) as m:
+                zf.write_many(items(), workers=1)
+            self.assertEqual(m.call_count, len(files))
+        with zipfile.ZipFile(path) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(len(zf.namelist()), len(files))
+
+    def test_skip_incompressible(self, time):
+        time.return_value = self.time
+
+        members = {
+            'random.bin': os.urandom(4096),
+            'spam.txt': b'spam' * 1024,
+        }
+        with zopfli.ZipFile(os.path.join(self.path, 'buffer.zip'), 'w', skip_incompressible=True) as zf:
+            zf.writestr('random.bin', bytearray(members['random.bin']))
+            zf.writestr('spam.txt', memoryview(members['spam.txt']))
+        with zopfli.ZipFile(os.path.join(self.path, 'buffer.zip')) as zf:
+            self.assertEqual(zf.getinfo('random.bin').compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(zf.getinfo('spam.txt').compress_type, zipfile.ZIP_DEFLATED)
+            for n, data in members.items():
+                self.assertEqual(zf.read(n), data)
+
+        for n, data in members.items():
+            with open(os.path.join(self.path, n), 'wb') as fp:
+                fp.write(data)
+        path = os.path.join(self.path, 'skip.zip')
+        for write in ('write', 'writestr', 'write_many'):
+            with zopfli.ZipFile(path, 'w', skip_incompressible=True) as zf:
+                if write == 'write':
+                    for n in members:
+                        zf.write(os.path.join(self.path, n), n)
+                elif write == 'writestr':
+                    for n, data in members.items():
+                        zf.writestr(n, data)
+                else:
+                    zf.write_many((os.path.join(self.path, n), n) for n in members)
+            with zopfli.ZipFile(path) as zf:
+                self.assertEqual(zf.getinfo('random.bin').compress_type, zipfile.ZIP_STORED)
+                self.assertEqual(zf.getinfo('spam.txt').compress_type, zipfile.ZIP_DEFLATED)
+                for n, data in members.items():
+                    self.assertEqual(zf.read(n), data)
+
+    def test_recompress(self, time):
+        time.return_value = self.time
+
+        spam = b''.join(b'%d spam\n' % i for i in range(1000))
+        src = os.path.join(self.path, 'src.zip')
+        with zopfli.ZipFile(src, 'w') as zf:
+            zf.writestr('ham.txt', b'ham' * 1000)
+        with zipfile.ZipFile(src, 'a') as zf:
+            zi = zipfile.ZipInfo('spam.txt', (2000, 1, 1, 0, 0, 0))
+            zi.compress_type = zipfile.ZIP_DEFLATED
+            zi.extra = struct.pack('<2H', 0xcafe, 4) + b'spam'
+            zi.comment = b'spam'
+            zi.external_attr = 0o644 << 16
+            zf.writestr(zi, spam, compresslevel=1)
+            # aligned by zipalign
+            zi = zipfile.ZipInfo('lib/libeggs.so')
+            zi.extra = bytes(-(zf.fp.tell() + 30 + len(zi.filename)) % 4096)
+            zf.writestr(zi, b'eggs')
+            zf.writestr('toast/', b'')
+            zf.comment = b'zopfli'
+
+        dst = os.path.join(self.path, 'dst.zip')
+        zopfli.ZipFile.recompress(src, dst, workers=2)
+        with zipfile.ZipFile(src) as zin, zipfile.ZipFile(dst) as zout:
+            self.assertIsNone(zout.testzip())
+            self.assertEqual(zout.comment, b'zopfli')
+            self.assertEqual(zout.namelist(), zin.namelist())
+            for a, b in zip(zin.infolist(), zout.infolist()):
+                for n in ('date_time', 'compress_type', 'comment', 'extra', 'external_attr', 'flag_bits', 'CRC', 'file_size'):
+                    self.assertEqual(getattr(b, n), getattr(a, n))
+                self.assertEqual(zout.read(b), zin.read(a))
+            # not smaller
+            self.assertEqual(zout.getinfo('ham.txt').compress_size, zin.getinfo('ham.txt').compress_size)
+            self.assertLess(zout.getinfo('spam.txt').compress_size, zin.getinfo('spam.txt').compress_size)
+            zi = zout.getinfo('lib/libeggs.so')
+            zout.fp.seek(zi.header_offset + 26)
+            self.assertEqual((zi.header_offset + 30 + sum(struct.unpack('<2H', zout.fp.read(4)))) % 4096, 0)
+
+        # up to 1 member per worker is pending
+        read_member = zopfli._read_member
+        rewrite_file_header = zopfli._rewrite_file_header
+
+        def _rewrite_file_header(*args):
+            self.assertLessEqual(r.call_count - w.call_count, 1)
+            return rewrite_file_header(*args)
+
+        with unittest.mock.patch('zopfli._read_member', side_effect=read_member) as r, \
+             unittest.mock.patch('zopfli._rewrite_file_header', side_effect=_rewrite_file_header) as w:
+            zopfli.ZipFile.recompress(src, dst, workers=1)
+        self.assertEqual(r.call_count, 4)
+        self.assertEqual(w.call_count, 4)
+
+        # data descriptor
+        buf = io.BytesIO()
+        with zipfile.ZipFile(Unseekable(buf), 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+            zf.writestr('spam.txt', spam)
+            zf.writestr('ham.txt', b'ham')
+        out = io.BytesIO()
+        zopfli.ZipFile.recompress(io.BytesIO(buf.getvalue()), out)
+        with zipfile.ZipFile(out) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertTrue(zf.getinfo('spam.txt').flag_bits & 0x08)
+            self.assertEqual(zf.read('spam.txt'), spam)
+            self.assertEqual(zf.read('ham.txt'), b'ham')
+        self.assertLess(len(out.getvalue()), len(buf.getvalue()))
+
+    def test_reference(self, time):
+        time.return_value = self.time
+
+        members = {
+            'spam.txt': b'spam' * 1000,
+            'eggs.txt': b'eggs' * 1000,
+        }
+        for n, data in members.items():
+            with open(os.path.join(self.path, n), 'wb') as fp:
+                fp.write(data)
+        ref = os.path.join(self.path, 'ref.zip')
+        with zopfli.ZipFile(ref, 'w') as zf:
+            for n in members:
+                zf.write(os.path.join(self.path, n), n)
+            zf.writestr('ham.txt', b'ham' * 1000)
+        with zipfile.ZipFile(ref) as zf:
+            raw = {zi.filename: zopfli._read_member(zf.fp, zi)[1] for zi in zf.infolist()}
+
+        with open(os.path.join(self.path, 'eggs.txt'), 'wb') as fp:
+            fp.write(b'eggs' * 999)
+        path = os.path.join(self.path, 'new.zip')
+        for write in ('write', 'write_many', 'aio'):
+            stats = []
+            with zopfli.ZipFile(path, 'w', reference=ref, stats_callback=stats.append) as zf:
+                files = [(os.path.join(self.path, n), n) for n in members]
+                if write == 'write':
+                    for p, n in files:
+                        zf.write(p, n)
+                elif write == 'write_many':
+                    zf.write_many(files, workers=2)
+                else:
+                    async def main(files):
+                        for p, n in files:
+                            await zopfli.aio.write(zf, p, n)
+
+                    asyncio.run(main(files))
+                zf.writestr('ham.txt', b'ham' * 1000)
+                zf.writestr('toast.txt', b'toast')
+                with zf.open('beans.txt', 'w') as fp:
+                    fp.write(b'beans')
+            # eggs.txt, toast.txt, and beans.txt
+            self.assertEqual(len(stats), 3)
+            with zipfile.ZipFile(path) as zf:
+                self.assertIsNone(zf.testzip())
+                for n in ('spam.txt', 'ham.txt'):
+                    self.assertEqual(zopfli._read_member(zf.fp, zf.getinfo(n))[1], raw[n])
+                self.assertEqual(zf.read('eggs.txt'), b'eggs' * 999)
+
+        with zipfile.ZipFile(ref) as r:
+            with zopfli.ZipFile(path, 'w', reference=r) as zf:
+                zf.writestr('spam.txt', b'spam' * 1000)
+                # longer than the reference
+                zf.writestr('ham.txt', b'ham' * 1001)
+            self.assertIsNotNone(r.fp)
+            with zipfile.ZipFile(path) as zf:
+                self.assertEqual(zopfli._read_member(zf.fp, zf.getinfo('spam.txt'))[1], raw['spam.txt'])
+                self.assertEqual(zf.read('ham.txt'), b'ham' * 1001)
+
+        with self.assertRaises(FileNotFoundError):
+            zopfli.ZipFile(path, 'w', reference=os.path.join(self.path, 'none.zip'))
+
+    def test_stream(self, time):
+        time.return_value = self.time
+
+        members = {
+            'spam.txt': b'spam' * 1000,
+            'eggs.bin': bytes(3 << 19),
+            'ham/': b'',
+        }
+        for n, data in members.items():
+            if n.endswith('/'):
+                os.mkdir(os.path.join(self.path, n))
+            else:
+                with open(os.path.join(self.path, n), 'wb') as fp:
+                    fp.write(data)
+        files = [(os.path.join(self.path, n), n) for n in members]
+
+        with unittest.mock.patch.object(zopfli, 'ZopfliCompressor', wraps=zopfli.ZopfliCompressor) as c:
+            path = os.path.join(self.path, 'stream.zip')
+            for write in ('write', 'write_many'):
+                with zopfli.ZipFile(path, 'w', stream_threshold=1 << 20, iterations=1) as zf:
+                    if write == 'write':
+                        for p, n in files:
+                            zf.write(p, n)
+                    else:
+                        zf.write_many(files)
+                with zipfile.ZipFile(path) as zf:
+                    self.assertIsNone(zf.testzip())
+                    for n, data in members.items():
+                        zi = zf.getinfo(n)
+                        self.assertEqual(zf.read(zi), data)
+                        self.assertFalse(zi.flag_bits & 0x08)
+                    self.assertEqual(zf.getinfo('eggs.bin').compress_type, zipfile.ZIP_DEFLATED)
+                self.assertEqual(sum(kw.get('chunk_size', 0) > 0 for _, kw in c.call_args_list), 1)
+                c.reset_mock()
+
+        # non-seekable
+        for write in ('write', 'write_many', 'aio'):
+            buf = io.BytesIO()
+            with zopfli.ZipFile(Unseekable(buf), 'w', iterations=1) as zf:
+                if write == 'write':
+                    for p, n in files:
+                        zf.write(p, n)
+                elif write == 'write_many':
+                    zf.write_many(files)
+                else:
+                    async def main(files):
+                        for p, n in files:
+                            await zopfli.aio.write(zf, p, n)
+                        await zopfli.aio.writestr(zf, 'beans.txt', b'beans' * 100)
+
+                    asyncio.run(main(files))
+                zf.writestr('toast.txt', b'toast' * 100)
+                with zf.open('bacon.txt', 'w') as fp:
+                    fp.write(b'bacon' * 100)
+            with zipfile.ZipFile(buf) as zf:
+                self.assertIsNone(zf.testzip())
+                for n, data in (members | {'toast.txt': b'toast' * 100, 'bacon.txt': b'bacon' * 100}).items():
+                    zi = zf.getinfo(n)
+                    self.assertEqual(zf.read(zi), data)
+                    if not zi.is_dir():
+                        self.assertEqual(zi.compress_type, zipfile.ZIP_DEFLATED)
+                        self.assertTrue(zi.flag_bits & 0x08)
+                        self.assertLess(zi.compress_size, zi.file_size)
+
+    def test_cache(self, time):
+        time.return_value = self.time
+
+        cache = zopfli.ZopfliCache(os.path.join(self.path, 'cache'))
+        blobs = []
+        for _ in range(2):
+            path = os.path.join(self.path, 'cache.zip')
+            with zopfli.ZipFile(path, 'w', cache=cache) as zf:
+                zf.writestr('spam.txt', b'spam' * 100)
+                with zf.open('eggs.txt', 'w') as fp:
+                    fp.write(b'eggs' * 100)
+            with open(path, 'rb') as fp:
+                blobs.append(fp.read())
+            with zopfli.ZipFile(path) as zf:
+                self.assertEqual(zf.read('spam.txt'), b'spam' * 100)
+                self.assertEqual(zf.read('eggs.txt'), b'eggs' * 100)
+        self.assertEqual(blobs[0], blobs[1])
+        self.assertEqual(sum(len(files) for _, _, files in os.walk(cache.path)), 2)
+
     def _test_encode(self, encoding, names):
         f = self._f(names)
 
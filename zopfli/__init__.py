@@ -9,22 +9,40 @@
 """Zopfli Compression Algorithm"""
 
 from __future__ import annotations
+import builtins
+import collections
+from collections.abc import Callable, Iterable, Iterator
 import codecs
+import concurrent.futures
+import gzip
+import hashlib
+import io
+import itertools
+import mmap
 import os
+import shutil
 import struct
 import sys
+import tempfile
 import threading
-from typing import cast, Any, AnyStr, IO, Literal, TypeAlias
+from typing import cast, overload, Any, AnyStr, IO, Literal, Protocol, TypeAlias, TypeVar, TYPE_CHECKING
 import zipfile
 import zlib
 
 from ._zopfli import (ZOPFLI_FORMAT_GZIP, ZOPFLI_FORMAT_ZLIB, ZOPFLI_FORMAT_DEFLATE,
-                      ZopfliCompressor, ZopfliDeflater, ZopfliPNG)
+                      ZopfliCompressor, ZopfliDeflater, ZopfliPNG,
+                      compress, compress_fd, compress_many, gzip_compress, zlib_compress)
+if TYPE_CHECKING:
+    from _typeshed import ReadableBuffer, WriteableBuffer
+
+    from ._zopfli import _DeflateStats
 
 
 __all__ = ['ZOPFLI_FORMAT_GZIP', 'ZOPFLI_FORMAT_ZLIB', 'ZOPFLI_FORMAT_DEFLATE',
            'ZopfliCompressor', 'ZopfliDeflater', 'ZopfliDecompressor', 'ZopfliPNG',
-           'ZipFile', 'ZipInfo']
+           'ZopfliCache', 'GzipFile', 'ZipFile', 'ZipInfo',
+           'compress', 'compress_file', 'compress_iter', 'compress_many', 'gzip_compress', 'zlib_compress',
+           'decompress_file', 'open']
 __author__ = 'Akinori Hattori <hattya@gmail.com>'
 try:
     from .__version__ import version as __version__
@@ -32,14 +50,31 @@ except ImportError:
     __version__ = 'unknown'
 
 P: TypeAlias = str | os.PathLike[str]
+T = TypeVar('T')
+U = TypeVar('U')
 
 _ZIP_EFS = 1 << 11
+_ALIGNMENT_EXTRA = 0xd935
+_PROBE_SIZE = 64 * 1024
+_STREAM_CHUNK_SIZE = 1 << 20
+_PROBE_RATIO = 0.98
+_EVICT_RATIO = 0.9
+_PNG_OPTIONS = ('lossy_transparent', 'lossy_8bit', 'filter_strategies', 'auto_filter_strategy', 'keep_color_type', 'keep_chunks',
+                'use_zopfli', 'iterations', 'iterations_large', 'deadline', 'min_gain', 'filter_candidates')
+
+
+class _Compressor(Protocol):
+
+    def compress(self, data: bytes) -> bytes: ...
+    def flush(self) -> bytes: ...
 
 
 class ZopfliDecompressor:
 
-    def __init__(self, format: int = ZOPFLI_FORMAT_DEFLATE) -> None:
+    def __init__(self, format: int = ZOPFLI_FORMAT_DEFLATE, zdict: ReadableBuffer | None = None) -> None:
         if format == ZOPFLI_FORMAT_GZIP:
+            if zdict is not None:
+                raise ValueError('zdict is not supported in the gzip format')
             wbits = zlib.MAX_WBITS + 16
         elif format == ZOPFLI_FORMAT_ZLIB:
             wbits = zlib.MAX_WBITS
@@ -47,7 +82,9 @@ class ZopfliDecompressor:
             wbits = -zlib.MAX_WBITS
         else:
             raise ValueError('unknown format')
-        self.__z = zlib.decompressobj(wbits)
+        self.__z = zlib.decompressobj(wbits) if zdict is None else zlib.decompressobj(wbits, zdict)
+        # input which does not fit into the buffer of decompress_into()
+        self.__tail = b''
 
     @property
     def unused_data(self) -> bytes:
@@ -62,11 +99,259 @@ class ZopfliDecompressor:
         return self.__z.eof
 
     def decompress(self, data: bytes, max_length: int = 0) -> bytes:
+        if self.__tail:
+            data = self.__tail + data
+            self.__tail = b''
         return self.__z.decompress(data, max_length)
 
+    def decompress_into(self, data: ReadableBuffer, buffer: WriteableBuffer) -> int:
+        if self.__tail:
+            data = self.__tail + data
+        with memoryview(buffer) as m, m.cast('B') as b:
+            if b.readonly:
+                raise TypeError('buffer must be writable')
+            elif not b:
+                self.__tail = bytes(data)
+                return 0
+            v = self.__z.decompress(data, len(b))
+            b[:len(v)] = v
+            self.__tail = self.__z.unconsumed_tail
+            return len(v)
+
     def flush(self, length: int = zlib.DEF_BUF_SIZE) -> bytes:
+        if self.__tail:
+            data = self.__z.decompress(self.__tail)
+            self.__tail = b''
+            return data + self.__z.flush(length)
         return self.__z.flush(length)
 
+    def flush_into(self, buffer: WriteableBuffer) -> int:
+        return self.decompress_into(b'', buffer)
+
+
+class GzipFile(gzip.GzipFile):
+
+    def __init__(self, filename: P | None = None, mode: str | None = None, compresslevel: int = 9, fileobj: IO[bytes] | None = None,
+                 mtime: float | None = None, *, chunk_size: int = 1 << 20, **kwargs: Any) -> None:
+        if chunk_size <= 0:
+            raise ValueError('chunk_size must be positive')
+        elif 'zdict' in kwargs:
+            raise ValueError('zdict is not supported')
+        super().__init__(filename, mode, compresslevel, fileobj, mtime)
+        if self.mode == gzip.WRITE:
+            self.compress = cast(Any, _BufferedDeflater(chunk_size, **kwargs))
+
+
+def open(filename: P | IO[bytes], mode: str = 'rb', compresslevel: int = 9,
+         encoding: str | None = None, errors: str | None = None, newline: str | None = None, **kwargs: Any) -> GzipFile | io.TextIOWrapper:
+    if 't' in mode:
+        if 'b' in mode:
+            raise ValueError(f'invalid mode: {mode!r}')
+    else:
+        if encoding is not None:
+            raise ValueError("argument 'encoding' not supported in binary mode")
+        if errors is not None:
+            raise ValueError("argument 'errors' not supported in binary mode")
+        if newline is not None:
+            raise ValueError("argument 'newline' not supported in binary mode")
+
+    gz_mode = mode.replace('t', '')
+    if isinstance(filename, (str, os.PathLike)):
+        f = GzipFile(filename, gz_mode, compresslevel, **kwargs)
+    elif (hasattr(filename, 'read')
+          or hasattr(filename, 'write')):
+        f = GzipFile(None, gz_mode, compresslevel, filename, **kwargs)
+    else:
+        raise TypeError('filename must be a str, or a file')
+    return io.TextIOWrapper(f, encoding, errors, newline) if 't' in mode else f
+
+
+class _BufferedDeflater:
+
+    def __init__(self, chunk_size: int, **kwargs: Any) -> None:
+        self._z = ZopfliDeflater(**kwargs)
+        self._buf = bytearray()
+        self._chunk_size = chunk_size
+
+    def compress(self, data: bytes) -> bytes:
+        self._buf += data
+        if len(self._buf) < self._chunk_size:
+            return b''
+        data = bytes(self._buf)
+        self._buf.clear()
+        return self._z.compress(data)
+
+    def flush(self, mode: int = zlib.Z_FINISH) -> bytes:
+        # the buffered data can be compressed only at the end of the stream
+        if mode != zlib.Z_FINISH:
+            return b''
+        # the final block is written even if no data is compressed
+        data = self._z.compress(bytes(self._buf))
+        self._buf.clear()
+        return data + self._z.flush()
+
+
+def compress_file(src: P, dst: P, format: int = ZOPFLI_FORMAT_DEFLATE, **kwargs: Any) -> None:
+    with builtins.open(src, 'rb') as i:
+        if (os.path.exists(dst)
+            and os.path.samefile(src, dst)):
+            raise ValueError('src and dst are the same file')
+        with builtins.open(dst, 'wb') as o:
+            # an empty file cannot be mapped
+            if os.fstat(i.fileno()).st_size == 0:
+                compress_fd(b'', o.fileno(), format, **kwargs)
+                return
+            with mmap.mmap(i.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                compress_fd(m, o.fileno(), format, **kwargs)
+
+
+def compress_iter(iterable: Iterable[ReadableBuffer], format: int = ZOPFLI_FORMAT_DEFLATE, *, batch_size: int = 1024,
+                  **kwargs: Any) -> Iterator[bytes]:
+    if batch_size <= 0:
+        raise ValueError('batch_size must be greater than 0')
+    it = iter(iterable)
+    while batch := list(itertools.islice(it, batch_size)):
+        yield from compress_many(batch, format, **kwargs)
+
+
+def decompress_file(src: P, dst: P, format: int = ZOPFLI_FORMAT_DEFLATE, *, chunk_size: int = _STREAM_CHUNK_SIZE, **kwargs: Any) -> None:
+    if chunk_size <= 0:
+        raise ValueError('chunk_size must be positive')
+    d = ZopfliDecompressor(format, **kwargs)
+    with builtins.open(src, 'rb') as i:
+        if (os.path.exists(dst)
+            and os.path.samefile(src, dst)):
+            raise ValueError('src and dst are the same file')
+        with builtins.open(dst, 'wb') as o:
+            # both buffers are reused for each chunk
+            with memoryview(bytearray(chunk_size)) as ib, memoryview(bytearray(chunk_size)) as ob:
+                while n := i.readinto(ib):
+                    n = d.decompress_into(ib[:n], ob)
+                    while n:
+                        o.write(ob[:n])
+                        n = d.flush_into(ob)
+    if not d.eof:
+        raise EOFError('compressed file ended before the end-of-stream marker was reached')
+
+
+class ZopfliCache:
+
+    def __init__(self, path: P, max_size: int = 1 << 30) -> None:
+        if max_size < 0:
+            raise ValueError('max_size must be non-negative')
+        self.path = os.path.abspath(path)
+        self.max_size = max_size
+        os.makedirs(self.path, exist_ok=True)
+        # estimated total size of the entries, which is scanned on the first
+        # set() and after that only when it exceeds max_size
+        self._size: int | None = None
+        self._lock = threading.Lock()
+
+    def compressor(self, format: int = ZOPFLI_FORMAT_DEFLATE, **kwargs: Any) -> _CachedCompressor:
+        return _CachedCompressor(self, format, **kwargs)
+
+    def optimize(self, png: ZopfliPNG, data: bytes) -> bytes:
+        h = self._hash('png', {n: getattr(png, n) for n in _PNG_OPTIONS})
+        h.update(data)
+        key = h.hexdigest()
+        if (out := self.get(key)) is None:
+            out = png.optimize(data)
+            self.set(key, out)
+        return out
+
+    def get(self, key: str) -> bytes | None:
+        path = self._path(key)
+        try:
+            with builtins.open(path, 'rb') as fp:
+                data = fp.read()
+        except OSError:
+            return None
+        # the modification time is used as the access time for eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return data
+
+    def set(self, key: str, data: bytes) -> None:
+        if len(data) > self.max_size:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(prefix='.', dir=os.path.dirname(path))
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            if self._size is None:
+                self._size = sum(e[1] for e in self._entries())
+            else:
+                self._size += len(data)
+            if self._size > self.max_size:
+                self._evict()
+
+    def clear(self) -> None:
+        for _, _, path in self._entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        with self._lock:
+            self._size = None
+
+    def _entries(self) -> list[tuple[float, int, str]]:
+        entries = []
+        for d in os.scandir(self.path):
+            if d.name.startswith('.'):
+                continue
+            try:
+                it = os.scandir(d.path)
+            except OSError:
+                continue
+            with it:
+                for e in it:
+                    if e.name.startswith('.'):
+                        continue
+                    try:
+                        st = e.stat()
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, e.path))
+        return entries
+
+    def _evict(self) -> None:
+        entries = self._entries()
+        size = sum(e[1] for e in entries)
+        if size > self.max_size:
+            # evict below max_size to scan again only after more writes
+            for _, n, path in sorted(entries):
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                size -= n
+                if size <= self.max_size * _EVICT_RATIO:
+                    break
+        self._size = size
+
+    def _hash(self, kind: str, options: dict[str, Any]) -> Any:
+        h = hashlib.sha256()
+        h.update(repr((__version__, kind, sorted(options.items()))).encode())
+        return h
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], key)
+
 
 class ZipFile(zipfile.ZipFile):
 
@@ -75,11 +360,35 @@ class ZipFile(zipfile.ZipFile):
     _lock: threading.RLock
 
     def __init__(self, file: P | IO[bytes], mode: Literal['r', 'w', 'x', 'a'] = 'r', compression: int = zipfile.ZIP_DEFLATED, allowZip64: bool = True,
-                 compresslevel: int | None = None, *, strict_timestamps: bool = True, encoding: str = 'cp437', **kwargs: Any) -> None:
+                 compresslevel: int | None = None, *, strict_timestamps: bool = True, encoding: str = 'cp437', cache: ZopfliCache | None = None,
+                 skip_incompressible: bool = False, reference: P | IO[bytes] | zipfile.ZipFile | None = None,
+                 stream_threshold: int = 64 << 20, **kwargs: Any) -> None:
         self.encoding = encoding
+        self.cache = cache
+        self.skip_incompressible = skip_incompressible
+        self.stream_threshold = stream_threshold
+        self.reference: zipfile.ZipFile | None = None
         self._options = kwargs
         super().__init__(file, mode, compression, allowZip64, compresslevel)
         self._strict_timestamps = strict_timestamps
+        self._close_reference = False
+        if isinstance(reference, zipfile.ZipFile):
+            self.reference = reference
+        elif reference is not None:
+            try:
+                self.reference = ZipFile(reference, encoding=encoding)
+            except BaseException:
+                super().close()
+                raise
+            self._close_reference = True
+
+    def close(self) -> None:
+        try:
+            super().close()
+        finally:
+            if (self.reference is not None
+                and self._close_reference):
+                self.reference.close()
 
     def _RealGetContents(self) -> None:
         super()._RealGetContents()
@@ -97,9 +406,10 @@ class ZipFile(zipfile.ZipFile):
              *, force_zip64: bool = False, **kwargs: Any) -> IO[bytes]:
         fp = super().open(name, mode, pwd, force_zip64=force_zip64)
         if (mode == 'w'
-            and self._zopflify(None)
-            and fp._compressor):
-            fp._compressor = ZopfliCompressor(ZOPFLI_FORMAT_DEFLATE, **self._options | kwargs)
+            and self._zopflify(fp._zinfo.compress_type)):
+            stream = (not self._seekable
+                      or fp._zinfo.file_size >= self.stream_threshold)
+            fp._compressor = self._compressor(kwargs, fp._zinfo.filename, stream=stream)
         return fp
 
     def _open_to_write(self, zinfo: zipfile.ZipInfo, force_zip64: bool = False) -> IO[bytes]:
@@ -107,11 +417,112 @@ class ZipFile(zipfile.ZipFile):
 
     def write(self, filename: P, arcname: P | None = None,
               compress_type: int | None = None, compresslevel: int | None = None, **kwargs: Any) -> None:
-        zopflify = self._zopflify(compress_type)
-        z: ZopfliCompressor | None = None
-        if zopflify:
+        z: _Compressor | None = None
+        if self._zopflify(compress_type):
+            if self._streamed(filename):
+                self._stream(filename, arcname, self._compressor(kwargs, stream=True))
+                return
             compress_type = zipfile.ZIP_STORED
-            z = ZopfliCompressor(ZOPFLI_FORMAT_DEFLATE, **self._options | kwargs)
+            if not self._incompressible(filename):
+                z = self._compressor(kwargs, self._arcname(filename, arcname))
+        self._write(filename, arcname, compress_type, compresslevel, z)
+
+    def write_many(self, files: Iterable[P | tuple[P, P | None]], compress_type: int | None = None, compresslevel: int | None = None,
+                   *, workers: int | None = None, **kwargs: Any) -> None:
+        items = (f if isinstance(f, tuple) else (f, None) for f in files)
+        if not self._zopflify(compress_type):
+            for filename, arcname in items:
+                self.write(filename, arcname, compress_type, compresslevel)
+            return
+
+        def compress(filename: P, arcname: P | None) -> _Compressed | None:
+            return self._compress(filename, self._compressor(kwargs, self._arcname(filename, arcname)))
+
+        def submit(item: tuple[P, P | None]) -> concurrent.futures.Future[_Compressed | None] | None:
+            # large members are streamed in order
+            return None if self._streamed(item[0]) else executor.submit(compress, *item)
+
+        workers = workers or os.cpu_count() or 1
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            for (filename, arcname), f in _window(items, submit, 2 * workers):
+                if f is None:
+                    self._stream(filename, arcname, self._compressor(kwargs, stream=True))
+                else:
+                    self._write(filename, arcname, zipfile.ZIP_STORED, compresslevel, f.result())
+
+    @classmethod
+    def recompress(cls, src: P | IO[bytes], dst: P | IO[bytes], *, workers: int | None = None, encoding: str = 'cp437',
+                   cache: ZopfliCache | None = None, **kwargs: Any) -> None:
+        with cls(src, encoding=encoding) as zin, cls(dst, 'w', encoding=encoding, cache=cache, **kwargs) as zout:
+            # in the order of the local file headers
+            members = sorted(zin.infolist(), key=lambda zi: zi.header_offset)
+
+            def recompress(zi: zipfile.ZipInfo, raw: bytes) -> bytes:
+                if (zi.compress_type != zipfile.ZIP_DEFLATED
+                    or zi.flag_bits & 0x01):
+                    return raw
+                data = zlib.decompress(raw, -zlib.MAX_WBITS)
+                if zlib.crc32(data) != zi.CRC:
+                    raise zipfile.BadZipFile(f'Bad CRC-32 for file {zi.filename!r}')
+                z = zout._compressor({}, zi.filename)
+                data = z.compress(data) + z.flush()
+                # copy the existing deflate stream if it is not larger
+                return data if len(data) < len(raw) else raw
+
+            def submit(zi: zipfile.ZipInfo) -> tuple[bytes, concurrent.futures.Future[bytes]]:
+                # members are read in the calling thread
+                fh, raw = _read_member(zin.fp, zi)
+                return fh, executor.submit(recompress, zi, raw)
+
+            workers = workers or os.cpu_count() or 1
+            with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+                for zi, (fh, f) in _window(members, submit, workers):
+                    data = f.result()
+                    offset = zi.header_offset + len(fh)
+                    zi.header_offset = zout.fp.tell()
+                    zi.compress_size = len(data)
+                    zout.fp.write(_rewrite_file_header(zi, fh, offset))
+                    zout.fp.write(data)
+                    if zi.flag_bits & 0x08:
+                        fmt = '<4sLQQ' if zout._zip64(zi) else '<4sLLL'
+                        zout.fp.write(struct.pack(fmt, b'PK\x07\x08', zi.CRC, zi.compress_size, zi.file_size))
+                    # the ZIP64 extra field is rebuilt on close
+                    if any(id == 1 for id, _ in _extra_fields(zi.extra)):
+                        zi.extra = _pack_extra([(id, v) for id, v in _extra_fields(zi.extra) if id != 1])
+            zout.filelist = [zout._convert(zi) for zi in zin.infolist()]
+            zout.NameToInfo = {zi.filename: zi for zi in zout.filelist}
+            zout.start_dir = zout.fp.tell()
+            zout.comment = zin.comment
+
+    def _streamed(self, filename: P) -> bool:
+        return (not self._seekable
+                or (not os.path.isdir(filename)
+                    and os.path.getsize(filename) >= self.stream_threshold))
+
+    def _stream(self, filename: P, arcname: P | None, z: ZopfliCompressor) -> None:
+        zi = ZipInfo.from_file(filename, arcname, strict_timestamps=self._strict_timestamps)
+        if (zi.is_dir()
+            or self._incompressible(filename)):
+            self._write(filename, arcname, zipfile.ZIP_STORED, None, None)
+            return
+        zi.compress_type = zipfile.ZIP_DEFLATED
+        # the local file header is rewritten, or followed by the data descriptor
+        with self._lock, builtins.open(filename, 'rb') as src, super().open(zi, 'w') as dst:
+            cast(Any, dst)._compressor = z
+            shutil.copyfileobj(src, dst, _STREAM_CHUNK_SIZE)
+
+    def _compress(self, filename: P, z: _Compressor) -> _Compressed | None:
+        if os.path.isdir(filename):
+            return _Compressed(b'')
+        with builtins.open(filename, 'rb') as fp:
+            data = fp.read()
+        if self._incompressible(data):
+            return None
+        return _Compressed(z.compress(data) + z.flush())
+
+    def _write(self, filename: P, arcname: P | None, compress_type: int | None, compresslevel: int | None,
+               z: _Compressor | None) -> None:
+        zopflify = z is not None
         with self._lock:
             fp = self.fp
             try:
@@ -133,15 +544,28 @@ class ZipFile(zipfile.ZipFile):
 
     def writestr(self, zinfo_or_arcname: str | zipfile.ZipInfo, data: AnyStr,
                  compress_type: int | None = None, compresslevel: int | None = None, **kwargs: Any) -> None:
+        compress_type, z = self._prepare(zinfo_or_arcname, data, compress_type, kwargs)
+        self._writestr(zinfo_or_arcname, data, compress_type, compresslevel, z)
+
+    def _prepare(self, zinfo_or_arcname: str | zipfile.ZipInfo, data: AnyStr, compress_type: int | None,
+                 kwargs: dict[str, Any]) -> tuple[int | None, ZopfliCompressor | _CachedCompressor | _ReferencedCompressor | None]:
         if isinstance(zinfo_or_arcname, zipfile.ZipInfo):
             compress_type = zinfo_or_arcname.compress_type
             if isinstance(zinfo_or_arcname, ZipInfo):
                 zinfo_or_arcname.encoding = self.encoding
-        zopflify = self._zopflify(compress_type)
-        z: ZopfliCompressor | None = None
-        if zopflify:
-            compress_type = zipfile.ZIP_STORED
-            z = ZopfliCompressor(ZOPFLI_FORMAT_DEFLATE, **self._options | kwargs)
+        if not self._zopflify(compress_type):
+            return compress_type, None
+        elif self._incompressible(data.encode('utf-8') if isinstance(data, str) else data):
+            return zipfile.ZIP_STORED, None
+        elif not self._seekable:
+            # compressed by open() with the data descriptor
+            return zipfile.ZIP_DEFLATED, None
+        name = zinfo_or_arcname.filename if isinstance(zinfo_or_arcname, zipfile.ZipInfo) else zipfile.ZipInfo(zinfo_or_arcname).filename
+        return zipfile.ZIP_STORED, self._compressor(kwargs, name)
+
+    def _writestr(self, zinfo_or_arcname: str | zipfile.ZipInfo, data: AnyStr, compress_type: int | None, compresslevel: int | None,
+                  z: _Compressor | None) -> None:
+        zopflify = z is not None
         with self._lock:
             fp = self.fp
             try:
@@ -173,6 +597,37 @@ class ZipFile(zipfile.ZipFile):
                 self.filelist[-1] = zi
                 self.NameToInfo[zi.filename] = zi
 
+    @overload
+    def _compressor(self, kwargs: dict[str, Any], name: str | None = ..., *, stream: Literal[True]) -> ZopfliCompressor: ...
+    @overload
+    def _compressor(self, kwargs: dict[str, Any], name: str | None = ...,
+                    *, stream: bool = ...) -> ZopfliCompressor | _CachedCompressor | _ReferencedCompressor: ...
+
+    def _compressor(self, kwargs: dict[str, Any], name: str | None = None,
+                    *, stream: bool = False) -> ZopfliCompressor | _CachedCompressor | _ReferencedCompressor:
+        z: ZopfliCompressor | _CachedCompressor
+        options = self._options | kwargs
+        # members cannot be decompressed with a preset dictionary
+        if 'zdict' in options:
+            raise ValueError('zdict is not supported')
+        elif stream:
+            # the cache and the reference need the whole data
+            return ZopfliCompressor(ZOPFLI_FORMAT_DEFLATE, **options | {'chunk_size': options.get('chunk_size') or _STREAM_CHUNK_SIZE})
+        elif self.cache is not None:
+            z = self.cache.compressor(ZOPFLI_FORMAT_DEFLATE, **options)
+        else:
+            z = ZopfliCompressor(ZOPFLI_FORMAT_DEFLATE, **options)
+        if (self.reference is not None
+            and name is not None
+            and (zi := self.reference.NameToInfo.get(name)) is not None
+            and zi.compress_type == zipfile.ZIP_DEFLATED
+            and not zi.flag_bits & 0x01):
+            return _ReferencedCompressor(self.reference, zi, z)
+        return z
+
+    def _arcname(self, filename: P, arcname: P | None) -> str:
+        return zipfile.ZipInfo.from_file(filename, arcname, strict_timestamps=self._strict_timestamps).filename
+
     def _convert(self, src: zipfile.ZipInfo) -> ZipInfo:
         if isinstance(src, ZipInfo):
             dst = src
@@ -186,12 +641,12 @@ class ZipFile(zipfile.ZipFile):
         dst.encoding = self.encoding
         return dst
 
-    def _file(self, z: ZopfliCompressor | None) -> IO[bytes]:
+    def _file(self, z: _Compressor | None) -> IO[bytes]:
         LFH = '<4s5H3L2H'
 
         class ZopfliFile:
 
-            def __init__(self, zf: ZipFile, z: ZopfliCompressor | None) -> None:
+            def __init__(self, zf: ZipFile, z: _Compressor | None) -> None:
                 self.size = 0
                 self._zf = zf
                 self._fp = zf.fp
@@ -238,6 +693,19 @@ class ZipFile(zipfile.ZipFile):
 
         return cast(IO[bytes], ZopfliFile(self, z))
 
+    def _incompressible(self, data: ReadableBuffer | P) -> bool:
+        if not self.skip_incompressible:
+            return False
+        elif isinstance(data, (str, os.PathLike)):
+            if os.path.isdir(data):
+                return False
+            with builtins.open(data, 'rb') as fp:
+                b = fp.read(_PROBE_SIZE)
+        else:
+            with memoryview(data) as m, m.cast('B') as v:
+                b = bytes(v[:_PROBE_SIZE])
+        return len(zlib.compress(b, 1)) >= len(b) * _PROBE_RATIO
+
     def _zip64(self, zi: zipfile.ZipInfo) -> bool:
         return (zi.file_size > zipfile.ZIP64_LIMIT
                 or zi.compress_size > zipfile.ZIP64_LIMIT)
@@ -248,6 +716,175 @@ class ZipFile(zipfile.ZipFile):
                     and self.compression == zipfile.ZIP_DEFLATED))
 
 
+def _window(items: Iterable[T], submit: Callable[[T], U], size: int) -> Iterator[tuple[T, U]]:
+    # yield each item with the result of submit in order, and submit the next
+    # one after up to size items are pending
+    pending: collections.deque[tuple[T, U]] = collections.deque()
+    for item in items:
+        if len(pending) >= size:
+            yield pending.popleft()
+        pending.append((item, submit(item)))
+    while pending:
+        yield pending.popleft()
+
+
+def _read_member(fp: IO[bytes], zi: zipfile.ZipInfo) -> tuple[bytes, bytes]:
+    # the local file header, and the raw data
+    fp.seek(zi.header_offset)
+    fh = fp.read(30)
+    if (len(fh) != 30
+        or fh[:4] != zipfile.stringFileHeader):
+        raise zipfile.BadZipFile('Bad magic number for file header')
+    fh += fp.read(sum(struct.unpack('<2H', fh[26:])))
+    return fh, fp.read(zi.compress_size)
+
+
+def _extra_fields(extra: bytes) -> list[tuple[int, bytes]]:
+    fields = []
+    i = 0
+    while i + 4 <= len(extra):
+        id, n = struct.unpack('<2H', extra[i:i+4])
+        # zero bytes are the padding by zipalign
+        if id != 0:
+            fields.append((id, extra[i+4:i+4+n]))
+        i += 4 + n
+    return fields
+
+
+def _pack_extra(fields: list[tuple[int, bytes]]) -> bytes:
+    return b''.join(struct.pack('<2H', id, len(v)) + v for id, v in fields)
+
+
+def _rewrite_file_header(zi: zipfile.ZipInfo, fh: bytes, offset: int) -> bytes:
+    LFH = '<4s5H3L2H'
+
+    sig, ver, flag, meth, lmt, lmd, crc, csize, fsize, n, m = struct.unpack(LFH, fh[:30])
+    name = fh[30:30+n]
+    extra = fh[30+n:]
+    fields = _extra_fields(extra)
+    if csize == 0xffffffff:
+        # the compressed size follows the uncompressed size in the ZIP64 extra field
+        i = 8 if fsize == 0xffffffff else 0
+        fields = [(id, v[:i] + struct.pack('<Q', zi.compress_size) + v[i+8:] if id == 1 else v) for id, v in fields]
+        extra = _pack_extra(fields)
+    elif not (flag & 0x08
+              and csize == 0):
+        csize = zi.compress_size
+    # keep the alignment of the data in the source
+    alignment = _alignment(zi, fields, offset)
+    if alignment > 1:
+        offset = zi.header_offset + 30 + n
+        extra = _pack_extra([(id, v) for id, v in fields if id != _ALIGNMENT_EXTRA])
+        if any(id == _ALIGNMENT_EXTRA for id, _ in fields):
+            pad = -(offset + len(extra) + 6) % alignment
+            extra += struct.pack('<3H', _ALIGNMENT_EXTRA, 2 + pad, alignment) + bytes(pad)
+        else:
+            extra += bytes(-(offset + len(extra)) % alignment)
+    return struct.pack(LFH, sig, ver, flag, meth, lmt, lmd, crc, csize, fsize, n, len(extra)) + name + extra
+
+
+def _alignment(zi: zipfile.ZipInfo, fields: list[tuple[int, bytes]], offset: int) -> int:
+    for id, v in fields:
+        if (id == _ALIGNMENT_EXTRA
+            and len(v) >= 2):
+            return max(int.from_bytes(v[:2], 'little'), 1)
+    if (zi.compress_type != zipfile.ZIP_STORED
+        or zi.is_dir()):
+        return 1
+    # zipalign aligns shared libraries to pages, and the others to 4 bytes
+    for alignment in ((4096, 4) if zi.filename.endswith('.so') else (4,)):
+        if offset % alignment == 0:
+            return alignment
+    return 1
+
+
+class _CachedCompressor:
+
+    def __init__(self, cache: ZopfliCache, format: int = ZOPFLI_FORMAT_DEFLATE, **kwargs: Any) -> None:
+        if kwargs.get('chunk_size'):
+            raise ValueError('chunk_size is not supported')
+        self._cache = cache
+        self._z = ZopfliCompressor(format, **kwargs)
+        options = {n: v for n, v in kwargs.items() if n not in ('verbose', 'stats_callback')}
+        if 'zdict' in options:
+            options['zdict'] = bytes(options['zdict'])
+        self._h = cache._hash('deflate', options | {'format': format})
+
+    @property
+    def stats(self) -> _DeflateStats | None:
+        return self._z.stats
+
+    def compress(self, data: bytes) -> bytes:
+        self._h.update(data)
+        return self._z.compress(data)
+
+    def cancel(self) -> None:
+        self._z.cancel()
+
+    def flush(self) -> bytes:
+        key = self._h.hexdigest()
+        if (data := self._cache.get(key)) is None:
+            data = self._z.flush()
+            self._cache.set(key, data)
+        return data
+
+
+class _ReferencedCompressor:
+
+    def __init__(self, zf: zipfile.ZipFile, zi: zipfile.ZipInfo, z: ZopfliCompressor | _CachedCompressor) -> None:
+        self._zf = zf
+        self._zi = zi
+        self._z = z
+        self._buf: list[bytes] | None = []
+        self._crc = 0
+        self._size = 0
+
+    @property
+    def stats(self) -> _DeflateStats | None:
+        return self._z.stats
+
+    def compress(self, data: bytes) -> bytes:
+        if self._buf is None:
+            return self._z.compress(data)
+        # defer the compression until the data turns out to be changed
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        self._buf.append(bytes(data))
+        if self._size > self._zi.file_size:
+            return self._changed()
+        return b''
+
+    def cancel(self) -> None:
+        self._z.cancel()
+
+    def flush(self) -> bytes:
+        if self._buf is None:
+            return self._z.flush()
+        elif (self._size == self._zi.file_size
+              and self._crc == self._zi.CRC):
+            with self._zf._lock:
+                _, raw = _read_member(cast(IO[bytes], self._zf.fp), self._zi)
+            return raw
+        return self._changed() + self._z.flush()
+
+    def _changed(self) -> bytes:
+        buf = self._buf or []
+        self._buf = None
+        return b''.join(self._z.compress(b) for b in buf)
+
+
+class _Compressed:
+
+    def __init__(self, data: bytes) -> None:
+        self._data = data
+
+    def compress(self, data: bytes) -> bytes:
+        return b''
+
+    def flush(self) -> bytes:
+        return self._data
+
+
 class ZipInfo(zipfile.ZipInfo):
 
     __slots__ = ('encoding',)
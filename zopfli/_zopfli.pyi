@@ -6,7 +6,10 @@
 #   SPDX-License-Identifier: MIT
 #
 
-from collections.abc import Sequence
+from _typeshed import ReadableBuffer, WriteableBuffer
+from collections.abc import Callable, Iterable, Iterator, Sequence
+import os
+from typing import overload, Literal, TypedDict
 
 
 ZOPFLI_FORMAT_GZIP: int
@@ -14,20 +17,83 @@ ZOPFLI_FORMAT_ZLIB: int
 ZOPFLI_FORMAT_DEFLATE: int
 
 
+def compress(data: ReadableBuffer, format: int = ..., verbose: bool | None = ..., iterations: int = ...,
+             block_splitting: bool | None = ..., block_splitting_max: int = ..., threads: int = ...,
+             deadline: float = ..., min_gain: float = ...) -> bytes: ...
+def compress_fd(data: ReadableBuffer, fd: int, format: int = ..., verbose: bool | None = ..., iterations: int = ...,
+                block_splitting: bool | None = ..., block_splitting_max: int = ..., threads: int = ...,
+                deadline: float = ..., min_gain: float = ...) -> None: ...
+def compress_many(iterable: Iterable[ReadableBuffer], format: int = ..., workers: int = ..., verbose: bool | None = ...,
+                  iterations: int = ..., block_splitting: bool | None = ..., block_splitting_max: int = ...,
+                  deadline: float = ..., min_gain: float = ...) -> list[bytes]: ...
+def gzip_compress(data: ReadableBuffer, verbose: bool | None = ..., iterations: int = ...,
+                  block_splitting: bool | None = ..., block_splitting_max: int = ..., threads: int = ...,
+                  deadline: float = ..., min_gain: float = ...) -> bytes: ...
+def zlib_compress(data: ReadableBuffer, verbose: bool | None = ..., iterations: int = ...,
+                  block_splitting: bool | None = ..., block_splitting_max: int = ..., threads: int = ...,
+                  deadline: float = ..., min_gain: float = ...) -> bytes: ...
+
+
+class _Stats(TypedDict):
+
+    bytes_in: int
+    bytes_out: int
+    iterations: int
+    time: float
+    search_time: float
+
+
+class _DeflateStats(_Stats):
+
+    segments: int
+
+
+class _PNGStats(_Stats):
+
+    filter_strategy: str | None
+    filter_estimates: dict[str, int] | None
+
+
 class ZopfliCompressor:
 
     def __init__(self, format: int = ..., verbose: bool | None = ..., iterations: int = ...,
-                 block_splitting: bool | None = ..., block_splitting_max: int = ...) -> None: ...
-    def compress(self, data: bytes) -> bytes: ...
-    def flush(self) -> bytes: ...
+                 block_splitting: bool | None = ..., block_splitting_max: int = ..., chunk_size: int = ...,
+                 threads: int = ..., deadline: float = ..., min_gain: float = ...,
+                 stats_callback: Callable[[_DeflateStats], object] | None = ...,
+                 zdict: ReadableBuffer = ...) -> None: ...
+    @property
+    def iterations_used(self) -> int: ...
+    @property
+    def stats(self) -> _DeflateStats | None: ...
+    def compress(self, data: ReadableBuffer) -> bytes: ...
+    def compress_into(self, data: ReadableBuffer, buffer: WriteableBuffer) -> int: ...
+    @overload
+    def flush(self, memoryview: Literal[False] = ...) -> bytes: ...
+    @overload
+    def flush(self, memoryview: Literal[True]) -> memoryview: ...
+    def flush_into(self, buffer: WriteableBuffer) -> int: ...
+    def cancel(self) -> None: ...
 
 
 class ZopfliDeflater:
 
     def __init__(self, verbose: bool | None = ..., iterations: int = ...,
-                 block_splitting: bool | None = ..., block_splitting_max: int = ...) -> None: ...
-    def compress(self, data: bytes) -> bytes: ...
-    def flush(self) -> bytes: ...
+                 block_splitting: bool | None = ..., block_splitting_max: int = ..., threads: int = ...,
+                 deadline: float = ..., min_gain: float = ...,
+                 stats_callback: Callable[[_DeflateStats], object] | None = ...,
+                 zdict: ReadableBuffer = ...) -> None: ...
+    @property
+    def iterations_used(self) -> int: ...
+    @property
+    def stats(self) -> _DeflateStats | None: ...
+    def compress(self, data: ReadableBuffer) -> bytes: ...
+    def compress_into(self, data: ReadableBuffer, buffer: WriteableBuffer) -> int: ...
+    @overload
+    def flush(self, memoryview: Literal[False] = ...) -> bytes: ...
+    @overload
+    def flush(self, memoryview: Literal[True]) -> memoryview: ...
+    def flush_into(self, buffer: WriteableBuffer) -> int: ...
+    def cancel(self) -> None: ...
 
 
 class ZopfliPNG:
@@ -42,8 +108,29 @@ class ZopfliPNG:
     use_zopfli: bool
     iterations: int
     iterations_large: int
+    verify: Literal['full', 'header', 'none']
+    deadline: float
+    min_gain: float
+    stats_callback: Callable[[_PNGStats], object] | None
+    threads: int
+    filter_candidates: int
  
     def __init__(self, verbose: bool | None = ..., lossy_transparent: bool | None = ..., lossy_8bit: bool | None = ..., filter_strategies: str = ...,
                  auto_filter_strategy: bool | None = ..., keep_color_type: bool | None = ..., keep_chunks: Sequence[str] = ...,
-                 use_zopfli: bool | None = ..., iterations: int = ..., iterations_large: int = ...) -> None: ...
+                 use_zopfli: bool | None = ..., iterations: int = ..., iterations_large: int = ...,
+                 verify: Literal['full', 'header', 'none'] = ..., deadline: float = ..., min_gain: float = ...,
+                 stats_callback: Callable[[_PNGStats], object] | None = ..., threads: int = ...,
+                 filter_candidates: int = ...) -> None: ...
+    @property
+    def iterations_used(self) -> int: ...
+    @property
+    def stats(self) -> _PNGStats | None: ...
     def optimize(self, data: bytes) -> bytes: ...
+    def optimize_file(self, src: str | os.PathLike[str], dst: str | os.PathLike[str]) -> None: ...
+    def cancel(self) -> None: ...
+    @overload
+    def optimize_many(self, iterable: Iterable[bytes | str | os.PathLike[str]], workers: int = ...,
+                      ordered: Literal[True] = ...) -> Iterator[bytes]: ...
+    @overload
+    def optimize_many(self, iterable: Iterable[bytes | str | os.PathLike[str]], workers: int = ...,
+                      *, ordered: Literal[False]) -> Iterator[tuple[int, bytes]]: ...
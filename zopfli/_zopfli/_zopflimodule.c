@@ -8,8 +8,19 @@
 
 #include "_zopflimodule.h"
 
+#include <errno.h>
+#include <limits.h>
+#ifdef _WIN32
+# include <windows.h>
+# include <io.h>
+#else
+# include <time.h>
+# include <unistd.h>
+#endif
+
 #include "zopfli/zopfli.h"
 #include "zopfli/deflate.h"
+#include "zopfli/util.h"
 
 
 #define PARSE_BOOL(self, var)                       \
@@ -21,361 +32,2242 @@
     } while (0)
 
 
+static unsigned long crc_table[256];
+
+static void
+make_crc_table(void) {
+    unsigned long c;
+    int i, k;
+
+    for (i = 0; i < 256; ++i) {
+        c = (unsigned long)i;
+        for (k = 0; k < 8; ++k) {
+            c = c & 1 ? 0xedb88320UL ^ (c >> 1) : c >> 1;
+        }
+        crc_table[i] = c;
+    }
+}
+
+static unsigned long
+crc32_update(unsigned long crc, const unsigned char *p, size_t n) {
+    crc ^= 0xffffffffUL;
+    for (; n > 0; --n) {
+        crc = crc_table[(crc ^ *p++) & 0xff] ^ (crc >> 8);
+    }
+    return crc ^ 0xffffffffUL;
+}
+
+static unsigned long
+adler32_update(unsigned long adler, const unsigned char *p, size_t n) {
+    unsigned long s1, s2;
+    size_t k;
+
+    s1 = adler & 0xffff;
+    s2 = adler >> 16;
+    while (n > 0) {
+        k = n < 5552 ? n : 5552;
+        n -= k;
+        for (; k > 0; --k) {
+            s1 += *p++;
+            s2 += s1;
+        }
+        s1 %= 65521;
+        s2 %= 65521;
+    }
+    return (s2 << 16) | s1;
+}
+
+
+double
+monotonic(void) {
+#ifdef _WIN32
+    LARGE_INTEGER f, c;
+
+    QueryPerformanceFrequency(&f);
+    QueryPerformanceCounter(&c);
+    return (double)c.QuadPart / (double)f.QuadPart;
+#else
+    struct timespec ts;
+
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (double)ts.tv_sec + (double)ts.tv_nsec / 1e9;
+#endif
+}
+
+/* upper bound of the overhead of a call in iterations */
+#define OVERHEAD_MAX 16
+
+int
+budget_active(const Budget *b) {
+    return b->deadline > 0
+           || b->min_gain > 0;
+}
+
+void
+budget_start(Budget *b, int iterations) {
+    b->limit = monotonic() + b->deadline;
+    b->overhead = 1;
+    b->iterations = iterations;
+}
+
+/*
+ * call func(arg, k) with doubling iterations k up to max, and return the
+ * iterations of the smallest output. func returns the output size, or 0 on
+ * error. cost is set to the time per iteration of the last call. the deadline
+ * is shared with the rest of the work, which costs scale - 1 times as much as
+ * a call, and the time of the calls is counted against it.
+ */
+int
+budget_search(Budget *b, int max, double scale, size_t (*func)(void *, int), void *arg, double *cost) {
+    double t, pt, c;
+    size_t size, best_size, prev;
+    int k, pk, best, next;
+
+    k = 1 < max ? 1 : max;
+    pk = 0;
+    best = k;
+    best_size = prev = 0;
+    pt = 0;
+    for (;;) {
+        if (b->cancelled
+            && best_size != 0) {
+            break;
+        }
+        t = monotonic();
+        size = func(arg, k);
+        t = monotonic() - t;
+        /*
+         * the greedy pass and the block splitting cost about as much as an
+         * iteration, until two calls tell the cost of an iteration
+         */
+        if (pk > 0
+            && t > pt) {
+            c = (t - pt) / (k - pk);
+            b->overhead = t / c - k;
+            if (b->overhead < 1) {
+                b->overhead = 1;
+            } else if (b->overhead > OVERHEAD_MAX) {
+                b->overhead = OVERHEAD_MAX;
+            }
+        }
+        *cost = t / (k + b->overhead);
+        pt = t;
+        if (size == 0) {
+            break;
+        } else if (best_size == 0
+                   || size < best_size) {
+            best = k;
+            best_size = size;
+        }
+        if (k >= max
+            || (b->min_gain > 0
+                && prev != 0
+                && (size >= prev
+                    || (double)(prev - size) / (double)prev / (k - pk) < b->min_gain))) {
+            break;
+        }
+
+        next = k < max / 2 ? k * 2 : max;
+        if (b->deadline > 0) {
+            t = (b->limit - monotonic()) / (*cost * scale) - b->overhead;
+            if (t < next) {
+                next = t > k ? (int)t : k;
+            }
+            if (next <= k) {
+                break;
+            }
+        }
+        pk = k;
+        prev = size;
+        k = next;
+    }
+    if (best < b->iterations) {
+        b->iterations = best;
+    }
+    return best;
+}
+
+/* return up to k iterations which cost fits in the rest of the deadline */
+int
+budget_fit(Budget *b, int k, double cost) {
+    double t;
+
+    if (b->deadline > 0) {
+        t = (b->limit - monotonic()) / cost - b->overhead;
+        if (t < k) {
+            k = t > 1 ? (int)t : 1;
+        }
+    }
+    if (k < b->iterations) {
+        b->iterations = k;
+    }
+    return k;
+}
+
+
+PyObject *
+stats_new(const Stats *s, int iterations) {
+    return Py_BuildValue("{s:n,s:n,s:i,s:d,s:d}",
+                         "bytes_in",    (Py_ssize_t)s->bytes_in,
+                         "bytes_out",   (Py_ssize_t)s->bytes_out,
+                         "iterations",  iterations,
+                         "time",        s->time,
+                         "search_time", s->search_time);
+}
+
+int
+stats_parse_callback(PyObject *callback) {
+    if (callback != Py_None
+        && !PyCallable_Check(callback)) {
+        PyErr_SetString(PyExc_TypeError, "stats_callback must be callable");
+        return -1;
+    }
+    return 0;
+}
+
+int
+stats_report(PyObject *callback, PyObject *stats) {
+    PyObject *v;
+
+    if (callback == NULL
+        || callback == Py_None) {
+        return 0;
+    }
+    v = PyObject_CallFunctionObjArgs(callback, stats, NULL);
+    if (v == NULL) {
+        return -1;
+    }
+    Py_DECREF(v);
+    return 0;
+}
+
+
+/* input buffer which keeps the last ZOPFLI_WINDOW_SIZE bytes as history */
 typedef struct {
-    PyObject_HEAD
-    ZopfliFormat   format;
-    ZopfliOptions  options;
-    PyObject      *data;
-    int            flushed;
-#ifdef WITH_THREAD
-    PyThread_type_lock lock;
+    unsigned char *buf;
+    size_t         dictsize;
+    size_t         size;
+    size_t         alloc;
+} Window;
+
+static int
+window_append(Window *w, const unsigned char *p, size_t n) {
+    unsigned char *buf;
+    size_t alloc;
+
+    if (w->alloc < w->size + n) {
+        alloc = w->alloc ? w->alloc : 4096;
+        while (alloc < w->size + n) {
+            alloc *= 2;
+        }
+        buf = realloc(w->buf, alloc);
+        if (buf == NULL) {
+            PyErr_NoMemory();
+            return -1;
+        }
+        w->buf = buf;
+        w->alloc = alloc;
+    }
+    memcpy(w->buf + w->size, p, n);
+    w->size += n;
+    return 0;
+}
+
+static void
+window_slide(Window *w, size_t end) {
+    size_t off;
+
+    off = end > ZOPFLI_WINDOW_SIZE ? end - ZOPFLI_WINDOW_SIZE : 0;
+    if (off > 0) {
+        memmove(w->buf, w->buf + off, w->size - off);
+        w->size -= off;
+    }
+    w->dictsize = end - off;
+}
+
+static void
+window_free(Window *w) {
+    free(w->buf);
+    memset(w, 0, sizeof(*w));
+}
+
+
+/* deflate bit stream */
+typedef struct {
+    unsigned char  bp;
+    unsigned char *out;
+    size_t         outsize;
+} Output;
+
+/* append p to the output, and return -1 if out of memory */
+static int
+output_append(Output *o, const unsigned char *p, size_t n) {
+    unsigned char *out;
+    size_t alloc;
+
+    if (n == 0) {
+        return 0;
+    }
+    /* keep the allocation size expected by ZOPFLI_APPEND_DATA() */
+    alloc = 1;
+    while (alloc < o->outsize + n) {
+        alloc *= 2;
+    }
+    out = realloc(o->out, alloc);
+    if (out == NULL) {
+        return -1;
+    }
+    o->out = out;
+    memcpy(o->out + o->outsize, p, n);
+    o->outsize += n;
+    return 0;
+}
+
+static PyObject *
+output_take(Output *o, int final) {
+    PyObject *v;
+    size_t n;
+
+    /* keep the last byte while it is partially filled */
+    n = o->outsize;
+    if (!final
+        && o->bp != 0) {
+        --n;
+    }
+    v = PyBytes_FromStringAndSize((char *)o->out, n);
+    if (v == NULL) {
+        return NULL;
+    }
+    o->outsize -= n;
+    if (o->outsize == 0) {
+        free(o->out);
+        o->out = NULL;
+    } else {
+        memmove(o->out, o->out + n, o->outsize);
+    }
+    if (final) {
+        o->bp = 0;
+    }
+    return v;
+}
+
+/* copy the output up to size bytes to buf, and return the copied size */
+static size_t
+output_read(Output *o, unsigned char *buf, size_t size, int final) {
+    size_t n;
+
+    /* keep the last byte while it is partially filled */
+    n = o->outsize;
+    if (!final
+        && o->bp != 0) {
+        --n;
+    }
+    if (n > size) {
+        n = size;
+    }
+    memcpy(buf, o->out, n);
+    o->outsize -= n;
+    if (o->outsize == 0) {
+        free(o->out);
+        o->out = NULL;
+    } else {
+        memmove(o->out, o->out + n, o->outsize);
+    }
+    if (final
+        && o->outsize == 0) {
+        o->bp = 0;
+    }
+    return n;
+}
+
+/* write the output to fd, and return -1 with errno on error */
+static int
+output_write(Output *o, int fd, int final) {
+    size_t n, off;
+    Py_ssize_t rv;
+
+    /* keep the last byte while it is partially filled */
+    n = o->outsize;
+    if (!final
+        && o->bp != 0) {
+        --n;
+    }
+    for (off = 0; off < n; off += (size_t)rv) {
+#ifdef _WIN32
+        rv = _write(fd, o->out + off, (unsigned int)(n - off < INT_MAX ? n - off : INT_MAX));
+#else
+        rv = write(fd, o->out + off, n - off);
 #endif
-} Compressor;
+        if (rv < 0) {
+            if (errno != EINTR) {
+                return -1;
+            }
+            rv = 0;
+        }
+    }
+    o->outsize -= n;
+    if (o->outsize == 0) {
+        free(o->out);
+        o->out = NULL;
+    } else {
+        memmove(o->out, o->out + n, o->outsize);
+    }
+    if (final) {
+        o->bp = 0;
+    }
+    return 0;
+}
 
 static void
-Compressor_dealloc(Compressor *self) {
-    Py_XDECREF(self->data);
-    FREE_LOCK(self);
+output_free(Output *o) {
+    free(o->out);
+    memset(o, 0, sizeof(*o));
+}
+
+
+/* read-only buffer which owns the output of zopfli */
+typedef struct {
+    PyObject_HEAD
+    unsigned char *buf;
+    Py_ssize_t     len;
+} Buffer;
+
+static void
+Buffer_dealloc(Buffer *self) {
+    free(self->buf);
     Py_TYPE(self)->tp_free((PyObject *)self);
 }
 
-PyDoc_STRVAR(Compressor__doc__,
-"ZopfliCompressor(format=ZOPFLI_FORMAT_DEFLATE, verbose=False,"
-" iterations=15, block_splitting=True, block_splitting_max=15)\n"
+static int
+Buffer_getbuffer(Buffer *self, Py_buffer *view, int flags) {
+    return PyBuffer_FillInfo(view, (PyObject *)self, self->buf, self->len, 1, flags);
+}
+
+static PyBufferProcs Buffer_as_buffer = {
+    .bf_getbuffer = (getbufferproc)Buffer_getbuffer,
+};
+
+static PyTypeObject Buffer_Type = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name      = MODULE ".ZopfliBuffer",
+    .tp_basicsize = sizeof(Buffer),
+    .tp_dealloc   = (destructor)Buffer_dealloc,
+    .tp_as_buffer = &Buffer_as_buffer,
+    .tp_flags     = Py_TPFLAGS_DEFAULT,
+};
+
+/* return a memoryview which takes over the whole output */
+static PyObject *
+output_view(Output *o) {
+    Buffer *b;
+    PyObject *v, *mv;
+    unsigned char *p;
+
+    if (o->outsize == 0) {
+        output_free(o);
+        v = PyBytes_FromString("");
+    } else {
+        b = PyObject_New(Buffer, &Buffer_Type);
+        if (b == NULL) {
+            return NULL;
+        }
+        /* release the unused space */
+        p = realloc(o->out, o->outsize);
+        b->buf = p != NULL ? p : o->out;
+        b->len = (Py_ssize_t)o->outsize;
+        memset(o, 0, sizeof(*o));
+        v = (PyObject *)b;
+    }
+    if (v == NULL) {
+        return NULL;
+    }
+    mv = PyMemoryView_FromObject(v);
+    Py_DECREF(v);
+    return mv;
+}
+
+
+typedef struct {
+    void             (*func)(void *, size_t);
+    void              *arg;
+    size_t             n;
+    size_t             next;
+    int                running;
+    PyThread_type_lock mutex;
+    PyThread_type_lock done;
+} Pool;
+
+static void
+pool_worker(void *arg) {
+    Pool *pool;
+    size_t i;
+    int last;
+
+    pool = arg;
+    for (;;) {
+        PyThread_acquire_lock(pool->mutex, WAIT_LOCK);
+        i = pool->next < pool->n ? pool->next++ : pool->n;
+        PyThread_release_lock(pool->mutex);
+        if (i == pool->n) {
+            break;
+        }
+        pool->func(pool->arg, i);
+    }
+
+    PyThread_acquire_lock(pool->mutex, WAIT_LOCK);
+    last = --pool->running == 0;
+    PyThread_release_lock(pool->mutex);
+    if (last) {
+        PyThread_release_lock(pool->done);
+    }
+}
+
+/* call func(arg, i) for each i in [0, n) on up to threads native threads */
+static void
+parallel_run(int threads, size_t n, void (*func)(void *, size_t), void *arg) {
+    Pool pool = {0};
+    size_t i;
+    int t;
+
+    pool.func = func;
+    pool.arg = arg;
+    pool.n = n;
+    if (threads > 1
+        && n > 1) {
+        pool.mutex = PyThread_allocate_lock();
+        pool.done = PyThread_allocate_lock();
+    }
+    if (pool.mutex == NULL
+        || pool.done == NULL) {
+        for (i = 0; i < n; ++i) {
+            func(arg, i);
+        }
+        goto out;
+    }
+
+    PyThread_acquire_lock(pool.done, WAIT_LOCK);
+    pool.running = 1;
+    for (t = 1; t < threads && (size_t)t < n; ++t) {
+        PyThread_acquire_lock(pool.mutex, WAIT_LOCK);
+        ++pool.running;
+        PyThread_release_lock(pool.mutex);
+        if (PyThread_start_new_thread(pool_worker, &pool) == PYTHREAD_INVALID_THREAD_ID) {
+            PyThread_acquire_lock(pool.mutex, WAIT_LOCK);
+            --pool.running;
+            PyThread_release_lock(pool.mutex);
+            break;
+        }
+    }
+    pool_worker(&pool);
+    PyThread_acquire_lock(pool.done, WAIT_LOCK);
+    PyThread_release_lock(pool.done);
+out:
+    if (pool.mutex != NULL) {
+        PyThread_free_lock(pool.mutex);
+    }
+    if (pool.done != NULL) {
+        PyThread_free_lock(pool.done);
+    }
+}
+
+
+typedef struct {
+    const ZopfliOptions *options;
+    const Budget        *budget;
+    const unsigned char *in;
+    size_t               start;
+    size_t               end;
+    size_t               blocksize;
+    size_t               n;
+    int                  final;
+    Output              *outputs;
+} Blocks;
+
+static void
+deflate_block(void *arg, size_t i) {
+    Blocks *b;
+    Output *o;
+    size_t start, end;
+    int final;
+
+    b = arg;
+    if (b->budget->cancelled) {
+        return;
+    }
+    o = &b->outputs[i];
+    start = b->start + i * b->blocksize;
+    end = b->end - start < b->blocksize ? b->end : start + b->blocksize;
+    final = b->final && end == b->end;
+    ZopfliDeflatePart(b->options, 2, final, b->in, start, end,
+                      &o->bp, &o->out, &o->outsize);
+    if (i + 1 < b->n) {
+        /* align to a byte boundary with an empty stored block */
+        ZopfliDeflatePart(b->options, 0, 0, b->in, end, end,
+                          &o->bp, &o->out, &o->outsize);
+    }
+}
+
+/* return -1 if out of memory */
+static int
+deflate_range(const ZopfliOptions *options, int final, const unsigned char *in, size_t start, size_t end, Output *o,
+              size_t blocksize, int threads, const Budget *budget) {
+    Blocks b;
+    size_t i, n;
+    int rv;
+
+    n = (end - start + blocksize - 1) / blocksize;
+    b.outputs = threads > 1 && n > 1 ? calloc(n, sizeof(Output)) : NULL;
+    if (b.outputs == NULL) {
+        i = start;
+        do {
+            if (budget->cancelled) {
+                break;
+            }
+            n = end - i < blocksize ? end - i : blocksize;
+            if (n == 0
+                && !final) {
+                break;
+            }
+            ZopfliDeflatePart(options, 2, final && i + n == end, in, i, i + n,
+                              &o->bp, &o->out, &o->outsize);
+            i += n;
+        } while (i < end);
+        return 0;
+    }
+
+    /* blocks are compressed independently, and concatenated after that */
+    b.options = options;
+    b.budget = budget;
+    b.in = in;
+    b.start = start;
+    b.end = end;
+    b.blocksize = blocksize;
+    b.n = n;
+    b.final = final;
+    b.outputs[0] = *o;
+    parallel_run(threads, n, deflate_block, &b);
+    *o = b.outputs[0];
+    rv = 0;
+    for (i = 1; i < n; ++i) {
+        if (rv == 0
+            && (rv = output_append(o, b.outputs[i].out, b.outputs[i].outsize)) == 0) {
+            o->bp = b.outputs[i].bp;
+        }
+        free(b.outputs[i].out);
+    }
+    free(b.outputs);
+    return rv;
+}
+
+
+typedef struct {
+    ZopfliOptions        options;
+    const unsigned char *in;
+    size_t               start;
+    size_t               end;
+    int                  final;
+    const Output        *o;
+    Output               best;
+} Trial;
+
+static size_t
+deflate_trial(void *arg, int k) {
+    Trial *t;
+    Output o = {0};
+    size_t size;
+
+    t = arg;
+    /* continue from the partially filled last byte */
+    o.bp = t->o->bp;
+    if (o.bp != 0
+        && output_append(&o, t->o->out + t->o->outsize - 1, 1) < 0) {
+        return 0;
+    }
+    t->options.numiterations = k;
+    ZopfliDeflatePart(&t->options, 2, t->final, t->in, t->start, t->end,
+                      &o.bp, &o.out, &o.outsize);
+    size = o.outsize;
+    if (t->best.out == NULL
+        || size < t->best.outsize) {
+        output_free(&t->best);
+        t->best = o;
+    } else {
+        output_free(&o);
+    }
+    return size;
+}
+
+/* size of the data which the iterations are chosen on */
+#define SEARCH_SIZE (64 * 1024)
+
+/* bytes compressed one after another when n bytes are compressed on threads */
+static size_t
+deflate_span(size_t n, size_t blocksize, int threads) {
+    size_t m;
+
+    m = blocksize * threads;
+    return n / m * blocksize + (n % m < blocksize ? n % m : blocksize);
+}
+
+/*
+ * the iterations are chosen on the first SEARCH_SIZE bytes, and its smallest
+ * output is kept. the rest is compressed with the iterations reduced to meet
+ * the deadline. return -1 if out of memory.
+ */
+static int
+deflate_budget(const ZopfliOptions *options, int final, Window *w, size_t end, Output *o,
+               size_t blocksize, int threads, Budget *b, Stats *s) {
+    Trial t = {0};
+    ZopfliOptions opts;
+    double cost, start;
+    size_t i, n, size;
+    int k;
+
+    i = w->dictsize;
+    n = end - i < blocksize ? end - i : blocksize;
+    if (n > SEARCH_SIZE) {
+        n = SEARCH_SIZE;
+    }
+    t.options = *options;
+    t.in = w->buf;
+    t.start = i;
+    t.end = i + n;
+    t.final = final && i + n == end;
+    t.o = o;
+    start = monotonic();
+    k = budget_search(b, options->numiterations, 1 + (double)deflate_span(end - i - n, blocksize, threads) / n,
+                      deflate_trial, &t, &cost);
+    s->search_time += monotonic() - start;
+    if (t.best.out == NULL) {
+        return -1;
+    }
+    if (o->bp != 0) {
+        --o->outsize;
+    }
+    if (output_append(o, t.best.out, t.best.outsize) < 0) {
+        output_free(&t.best);
+        return -1;
+    }
+    o->bp = t.best.bp;
+    output_free(&t.best);
+    s->segments += 1;
+    cost /= n;
+
+    /* without min_gain, the iterations are only limited by the deadline */
+    if (b->min_gain <= 0) {
+        k = options->numiterations;
+    }
+    opts = *options;
+    for (i += n; i < end && !b->cancelled; i += n) {
+        n = end - i < blocksize * threads ? end - i : blocksize * threads;
+        size = n < blocksize ? n : blocksize;
+        opts.numiterations = budget_fit(b, k, cost * deflate_span(end - i, blocksize, threads));
+        start = monotonic();
+        if (deflate_range(&opts, final && i + n == end, w->buf, i, i + n, o, blocksize, threads, b) < 0) {
+            return -1;
+        }
+        s->segments += (n + blocksize - 1) / blocksize;
+        cost = (monotonic() - start) / (opts.numiterations + b->overhead) / size;
+    }
+    return 0;
+}
+
+/* return -1 if out of memory */
+static int
+deflate_window(const ZopfliOptions *options, int final, Window *w, size_t end, Output *o,
+               size_t blocksize, int threads, Budget *b, Stats *s) {
+    double start;
+    size_t n;
+    int rv;
+
+    start = monotonic();
+    if (budget_active(b)
+        && end > w->dictsize) {
+        rv = deflate_budget(options, final, w, end, o, blocksize, threads, b, s);
+    } else {
+        rv = deflate_range(options, final, w->buf, w->dictsize, end, o, blocksize, threads, b);
+        n = (end - w->dictsize + blocksize - 1) / blocksize;
+        s->segments += n == 0 && final ? 1 : n;
+    }
+    s->time += monotonic() - start;
+    return rv;
+}
+
+
+#define BUDGET_DOC                                                              \
+"If deadline is positive, the iterations are reduced to finish each call\n"    \
+"within deadline seconds. If min_gain is positive, the iterations stop when\n" \
+"an iteration reduces the size by less than min_gain. The iterations are\n"     \
+"chosen on the first 64 KiB of each call, and the iterations_used attribute\n" \
+"is the fewest iterations used for a block in the last call."
+
+#define CANCEL_DOC                                                              \
+"Stop the compression in progress in another thread at the next block\n"       \
+"boundary. The compressor object cannot be used after this method is called."
+
+#define STATS_DOC                                                               \
+"The stats attribute is a dict of the statistics after the flush() method\n"   \
+"is called, and stats_callback is called with it if not None. The segments\n"  \
+"in it is the number of parts of the data which are compressed separately\n"   \
+"by ZopfliDeflatePart(), and each of them can be split into several deflate\n" \
+"blocks."
+
+#define ZDICT_DOC                                                               \
+"If zdict is given, it is used as the preset dictionary, and the last\n"       \
+"32 KiB of it is the history for the data."
+
+static int
+check_cancelled(const Budget *b, const char *name) {
+    if (b->cancelled) {
+        PyErr_Format(PyExc_RuntimeError, "%s has been cancelled", name);
+        return -1;
+    }
+    return 0;
+}
+
+/* common stats with the number of segments */
+static PyObject *
+deflate_stats(const Stats *s, const Budget *b) {
+    PyObject *v, *n;
+
+    v = stats_new(s, b->iterations);
+    if (v == NULL) {
+        return NULL;
+    }
+    n = PyLong_FromSize_t(s->segments);
+    if (n == NULL
+        || PyDict_SetItemString(v, "segments", n) < 0) {
+        Py_XDECREF(n);
+        Py_DECREF(v);
+        return NULL;
+    }
+    Py_DECREF(n);
+    return v;
+}
+
+static int
+parse_budget(Budget *b) {
+    if (b->deadline < 0) {
+        PyErr_SetString(PyExc_ValueError, "deadline must be non-negative");
+        return -1;
+    } else if (b->min_gain < 0) {
+        PyErr_SetString(PyExc_ValueError, "min_gain must be non-negative");
+        return -1;
+    }
+    return 0;
+}
+
+
+/* header and trailer of the gzip and zlib formats, or -1 if out of memory */
+static int
+container_header(ZopfliFormat format, Output *o, const unsigned long *dictid) {
+    static const unsigned char gzip[] = {31, 139, 8, 0, 0, 0, 0, 0, 2, 3};
+    static const unsigned char zlib[] = {120, 218};
+    static const unsigned char zlib_fdict[] = {120, 249};
+    unsigned char b[4];
+    int i;
+
+    switch (format) {
+    case ZOPFLI_FORMAT_GZIP:
+        return output_append(o, gzip, sizeof(gzip));
+    case ZOPFLI_FORMAT_ZLIB:
+        if (dictid == NULL) {
+            return output_append(o, zlib, sizeof(zlib));
+        }
+        for (i = 0; i < 4; ++i) {
+            b[i] = (unsigned char)(*dictid >> (8 * (3 - i)));
+        }
+        if (output_append(o, zlib_fdict, sizeof(zlib_fdict)) < 0) {
+            return -1;
+        }
+        return output_append(o, b, 4);
+    default:
+        return 0;
+    }
+}
+
+/* update checksum with p, or return the initial value if p is NULL */
+static unsigned long
+container_checksum(ZopfliFormat format, unsigned long checksum, const unsigned char *p, size_t n) {
+    switch (format) {
+    case ZOPFLI_FORMAT_GZIP:
+        return p != NULL ? crc32_update(checksum, p, n) : 0;
+    case ZOPFLI_FORMAT_ZLIB:
+        return p != NULL ? adler32_update(checksum, p, n) : 1;
+    default:
+        return 0;
+    }
+}
+
+static int
+container_trailer(ZopfliFormat format, Output *o, unsigned long checksum, size_t insize) {
+    unsigned char b[8];
+    int i;
+
+    switch (format) {
+    case ZOPFLI_FORMAT_GZIP:
+        for (i = 0; i < 4; ++i) {
+            b[i] = (unsigned char)(checksum >> (8 * i));
+            b[i + 4] = (unsigned char)(insize >> (8 * i));
+        }
+        return output_append(o, b, 8);
+    case ZOPFLI_FORMAT_ZLIB:
+        for (i = 0; i < 4; ++i) {
+            b[i] = (unsigned char)(checksum >> (8 * (3 - i)));
+        }
+        return output_append(o, b, 4);
+    default:
+        return 0;
+    }
+}
+
+static int
+parse_format(ZopfliFormat format) {
+    switch (format) {
+    case ZOPFLI_FORMAT_GZIP:
+    case ZOPFLI_FORMAT_ZLIB:
+    case ZOPFLI_FORMAT_DEFLATE:
+        return 0;
+    default:
+        PyErr_SetString(PyExc_ValueError, "unknown format");
+        return -1;
+    }
+}
+
+static int
+parse_zdict(ZopfliFormat format, PyObject *zdict) {
+    if (zdict == NULL) {
+        return 0;
+    } else if (format == ZOPFLI_FORMAT_GZIP) {
+        PyErr_SetString(PyExc_ValueError, "zdict is not supported in the gzip format");
+        return -1;
+    } else if (!PyObject_CheckBuffer(zdict)) {
+        PyErr_SetString(PyExc_TypeError, "zdict must be a bytes-like object");
+        return -1;
+    }
+    return 0;
+}
+
+/* prime the window with the preset dictionary, and set its Adler-32 to dictid */
+static int
+window_prime(Window *w, PyObject *zdict, unsigned long *dictid) {
+    Py_buffer in = {0};
+    int rv;
+
+    if (PyObject_GetBuffer(zdict, &in, PyBUF_CONTIG_RO) < 0) {
+        return -1;
+    }
+    *dictid = adler32_update(1, in.buf, (size_t)in.len);
+    rv = window_append(w, in.buf, (size_t)in.len);
+    if (rv == 0) {
+        window_slide(w, w->size);
+    }
+    PyBuffer_Release(&in);
+    return rv;
+}
+
+
+typedef struct {
+    PyObject_HEAD
+    ZopfliFormat   format;
+    ZopfliOptions  options;
+    Py_ssize_t     chunk_size;
+    int            threads;
+    Budget         budget;
+    Stats          counters;
+    PyObject      *stats;
+    PyObject      *stats_callback;
+    Window         window;
+    Output         output;
+    unsigned long  dictid;
+    int            fdict;
+    unsigned long  checksum;
+    size_t         insize;
+    int            flushed;
+#ifdef WITH_THREAD
+    PyThread_type_lock lock;
+#endif
+} Compressor;
+
+static int
+Compressor_traverse(Compressor *self, visitproc visit, void *arg) {
+    Py_VISIT(self->stats_callback);
+    return 0;
+}
+
+static int
+Compressor_clear(Compressor *self) {
+    window_free(&self->window);
+    Py_CLEAR(self->stats);
+    Py_CLEAR(self->stats_callback);
+    return 0;
+}
+
+static void
+Compressor_dealloc(Compressor *self) {
+    PyObject_GC_UnTrack(self);
+    Compressor_clear(self);
+    output_free(&self->output);
+    FREE_LOCK(self);
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+PyDoc_STRVAR(Compressor__doc__,
+"ZopfliCompressor(format=ZOPFLI_FORMAT_DEFLATE, verbose=False,"
+" iterations=15, block_splitting=True, block_splitting_max=15,"
+" chunk_size=0, threads=1, deadline=0.0, min_gain=0.0, stats_callback=None,"
+" zdict=None)\n"
+"\n"
+"Create a compressor object which is using the ZopfliCompress()\n"
+"function for compressing data.\n"
+"\n"
+ZDICT_DOC
+" The FDICT flag and the\n"
+"Adler-32 of zdict are set to the zlib header.\n"
+"\n"
+"If chunk_size is positive, data is compressed in segments of chunk_size\n"
+"bytes as soon as they are available, and the last 32 KiB of each segment\n"
+"is used as the history for the next one.\n"
+"\n"
+"If threads is greater than 1, blocks are compressed in parallel on up to\n"
+"threads native threads, and each of them is aligned to a byte boundary.\n"
+"\n"
+BUDGET_DOC
+"\n"
+"\n"
+STATS_DOC);
+
+static int
+Compressor_init(Compressor *self, PyObject *args, PyObject *kwargs) {
+    static char *kwlist[] = {
+        "format",
+        "verbose",
+        "iterations",
+        "block_splitting",
+        "block_splitting_max",
+        "chunk_size",
+        "threads",
+        "deadline",
+        "min_gain",
+        "stats_callback",
+        "zdict",
+        NULL,
+    };
+    PyObject *verbose, *blocksplitting, *stats_callback, *zdict;
+
+    self->format = ZOPFLI_FORMAT_DEFLATE;
+    ZopfliInitOptions(&self->options);
+    verbose = Py_False;
+    blocksplitting = Py_True;
+    self->chunk_size = 0;
+    self->threads = 1;
+    memset(&self->budget, 0, sizeof(self->budget));
+    stats_callback = Py_None;
+    zdict = NULL;
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs,
+                                     "|iOiOiniddOO:ZopfliCompressor", kwlist,
+                                     &self->format,
+                                     &verbose,
+                                     &self->options.numiterations,
+                                     &blocksplitting,
+                                     &self->options.blocksplittingmax,
+                                     &self->chunk_size,
+                                     &self->threads,
+                                     &self->budget.deadline,
+                                     &self->budget.min_gain,
+                                     &stats_callback,
+                                     &zdict)) {
+        return -1;
+    }
+
+    if (parse_format(self->format) < 0
+        || parse_zdict(self->format, zdict) < 0) {
+        return -1;
+    }
+    if (self->chunk_size < 0) {
+        PyErr_SetString(PyExc_ValueError, "chunk_size must be non-negative");
+        return -1;
+    }
+    if (self->threads < 1) {
+        PyErr_SetString(PyExc_ValueError, "threads must be positive");
+        return -1;
+    }
+    if (parse_budget(&self->budget) < 0
+        || stats_parse_callback(stats_callback) < 0) {
+        return -1;
+    }
+
+    PARSE_BOOL(self, verbose);
+    PARSE_BOOL(self, blocksplitting);
+
+    Compressor_clear(self);
+    Py_INCREF(stats_callback);
+    self->stats_callback = stats_callback;
+    memset(&self->counters, 0, sizeof(self->counters));
+    output_free(&self->output);
+    self->fdict = zdict != NULL;
+    if (self->fdict
+        && window_prime(&self->window, zdict, &self->dictid) < 0) {
+        return -1;
+    }
+    self->checksum = container_checksum(self->format, 0, NULL, 0);
+    self->insize = 0;
+    if (self->chunk_size > 0
+        && container_header(self->format, &self->output, self->fdict ? &self->dictid : NULL) < 0) {
+        PyErr_NoMemory();
+        return -1;
+    }
+
+    self->flushed = 0;
+#ifdef WITH_THREAD
+    ALLOCATE_LOCK(self);
+    if (PyErr_Occurred() != NULL) {
+        return -1;
+    }
+#endif
+    return 0;
+}
+
+static void
+stream_update(Compressor *self, const unsigned char *p, size_t n) {
+    self->checksum = container_checksum(self->format, self->checksum, p, n);
+    self->insize += n;
+}
+
+static int
+stream_compress(Compressor *self, PyObject *data) {
+    Py_buffer in = {0};
+    const unsigned char *p;
+    size_t n, size, blocksize, pending;
+    int rv;
+
+    if (PyObject_GetBuffer(data, &in, PyBUF_CONTIG_RO) < 0) {
+        return -1;
+    }
+    p = in.buf;
+    n = (size_t)in.len;
+    stream_update(self, p, n);
+    budget_start(&self->budget, self->options.numiterations);
+    /* compress a segment per thread at once */
+    blocksize = (size_t)self->chunk_size;
+    size = blocksize * self->threads;
+    while (n > 0) {
+        pending = size - (self->window.size - self->window.dictsize);
+        if (pending > n) {
+            pending = n;
+        }
+        if (window_append(&self->window, p, pending) < 0) {
+            PyBuffer_Release(&in);
+            return -1;
+        }
+        p += pending;
+        n -= pending;
+        if (self->window.size - self->window.dictsize < size) {
+            break;
+        }
+
+        Py_BEGIN_ALLOW_THREADS
+        rv = deflate_window(&self->options, 0, &self->window, self->window.size, &self->output,
+                            blocksize < ZOPFLI_MASTER_BLOCK_SIZE ? blocksize : ZOPFLI_MASTER_BLOCK_SIZE, self->threads,
+                            &self->budget, &self->counters);
+        window_slide(&self->window, self->window.size);
+        Py_END_ALLOW_THREADS
+        if (rv < 0) {
+            PyErr_NoMemory();
+            PyBuffer_Release(&in);
+            return -1;
+        } else if (check_cancelled(&self->budget, "Compressor") < 0) {
+            PyBuffer_Release(&in);
+            return -1;
+        }
+    }
+    PyBuffer_Release(&in);
+    return 0;
+}
+
+/* compress data into self->output */
+static int
+compressor_compress(Compressor *self, PyObject *data) {
+    Py_buffer in = {0};
+    int rv;
+
+    if (self->flushed) {
+        PyErr_SetString(PyExc_ValueError, "Compressor has been flushed");
+        return -1;
+    } else if (check_cancelled(&self->budget, "Compressor") < 0) {
+        return -1;
+    }
+    if (self->chunk_size > 0) {
+        return stream_compress(self, data);
+    }
+    if (PyObject_GetBuffer(data, &in, PyBUF_CONTIG_RO) < 0) {
+        return -1;
+    }
+    rv = window_append(&self->window, in.buf, (size_t)in.len);
+    PyBuffer_Release(&in);
+    return rv;
+}
+
+PyDoc_STRVAR(Compressor_compress__doc__,
+"compress(data) -> bytes");
+
+static PyObject *
+Compressor_compress(Compressor *self, PyObject *data) {
+    PyObject *v;
+
+    v = NULL;
+    ACQUIRE_LOCK(self);
+    if (compressor_compress(self, data) == 0) {
+        v = output_take(&self->output, 0);
+        if (v != NULL) {
+            self->counters.bytes_out += PyBytes_GET_SIZE(v);
+        }
+    }
+    RELEASE_LOCK(self);
+    return v;
+}
+
+PyDoc_STRVAR(Compressor_compress_into__doc__,
+"compress_into(data, buffer) -> int\n"
+"\n"
+"Same as the compress() method, but write the compressed data into the\n"
+"writable buffer, and return the number of bytes written. The data which\n"
+"does not fit in buffer is written by the next call.");
+
+static PyObject *
+Compressor_compress_into(Compressor *self, PyObject *args) {
+    PyObject *data, *v;
+    Py_buffer out = {0};
+    size_t n;
+
+    if (!PyArg_ParseTuple(args, "Ow*:compress_into", &data, &out)) {
+        return NULL;
+    }
+
+    v = NULL;
+    ACQUIRE_LOCK(self);
+    if (compressor_compress(self, data) == 0) {
+        n = output_read(&self->output, out.buf, (size_t)out.len, 0);
+        self->counters.bytes_out += n;
+        v = PyLong_FromSize_t(n);
+    }
+    RELEASE_LOCK(self);
+    PyBuffer_Release(&out);
+    return v;
+}
+
+static int
+stream_flush(Compressor *self) {
+    size_t blocksize;
+    int rv;
+
+    blocksize = (size_t)self->chunk_size;
+    budget_start(&self->budget, self->options.numiterations);
+    Py_BEGIN_ALLOW_THREADS
+    rv = deflate_window(&self->options, 1, &self->window, self->window.size, &self->output,
+                        blocksize < ZOPFLI_MASTER_BLOCK_SIZE ? blocksize : ZOPFLI_MASTER_BLOCK_SIZE, self->threads,
+                        &self->budget, &self->counters);
+    if (rv == 0) {
+        rv = container_trailer(self->format, &self->output, self->checksum, self->insize);
+    }
+    Py_END_ALLOW_THREADS
+    window_free(&self->window);
+    if (rv < 0) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    return check_cancelled(&self->budget, "Compressor");
+}
+
+/* finish the compression into self->output */
+static int
+compressor_flush(Compressor *self) {
+    int rv;
+
+    if (self->flushed) {
+        PyErr_SetString(PyExc_ValueError, "repeated call to flush()");
+        return -1;
+    } else if (check_cancelled(&self->budget, "Compressor") < 0) {
+        return -1;
+    }
+    self->flushed = 1;
+    if (self->chunk_size > 0) {
+        rv = stream_flush(self);
+        goto out;
+    }
+
+    /* same as ZopfliCompress(), but can be cancelled between blocks */
+    budget_start(&self->budget, self->options.numiterations);
+    Py_BEGIN_ALLOW_THREADS
+    stream_update(self, self->window.buf + self->window.dictsize, self->window.size - self->window.dictsize);
+    if ((rv = container_header(self->format, &self->output, self->fdict ? &self->dictid : NULL)) == 0
+        && (rv = deflate_window(&self->options, 1, &self->window, self->window.size, &self->output,
+                                ZOPFLI_MASTER_BLOCK_SIZE, self->threads, &self->budget, &self->counters)) == 0) {
+        rv = container_trailer(self->format, &self->output, self->checksum, self->insize);
+    }
+    Py_END_ALLOW_THREADS
+    window_free(&self->window);
+    if (rv < 0) {
+        PyErr_NoMemory();
+    } else {
+        rv = check_cancelled(&self->budget, "Compressor");
+    }
+out:
+    if (rv == 0) {
+        self->counters.bytes_in = self->insize;
+        self->counters.bytes_out += self->output.outsize;
+        self->stats = deflate_stats(&self->counters, &self->budget);
+        if (self->stats != NULL) {
+            return 0;
+        }
+    }
+    output_free(&self->output);
+    return -1;
+}
+
+PyDoc_STRVAR(Compressor_flush__doc__,
+"flush(memoryview=False) -> bytes\n"
+"\n"
+"If memoryview is true, return a memoryview of the compressed data which\n"
+"is not copied. The compressor object cannot be used after this method is\n"
+"called.");
+
+static PyObject *
+Compressor_flush(Compressor *self, PyObject *args, PyObject *kwargs) {
+    static char *kwlist[] = {
+        "memoryview",
+        NULL,
+    };
+    PyObject *v;
+    int view;
+
+    view = 0;
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|p:flush", kwlist, &view)) {
+        return NULL;
+    }
+
+    v = NULL;
+    ACQUIRE_LOCK(self);
+    if (compressor_flush(self) == 0) {
+        v = view ? output_view(&self->output) : output_take(&self->output, 1);
+        output_free(&self->output);
+    }
+    RELEASE_LOCK(self);
+    if (v != NULL
+        && stats_report(self->stats_callback, self->stats) < 0) {
+        Py_CLEAR(v);
+    }
+    return v;
+}
+
+PyDoc_STRVAR(Compressor_flush_into__doc__,
+"flush_into(buffer) -> int\n"
+"\n"
+"Same as the flush() method, but write the compressed data into the\n"
+"writable buffer, and return the number of bytes written. The data which\n"
+"does not fit in buffer is written by the subsequent calls to this method,\n"
+"and 0 is returned at the end.");
+
+static PyObject *
+Compressor_flush_into(Compressor *self, PyObject *args) {
+    PyObject *v;
+    Py_buffer out = {0};
+    size_t n;
+    int report;
+
+    if (!PyArg_ParseTuple(args, "w*:flush_into", &out)) {
+        return NULL;
+    }
+
+    v = NULL;
+    report = 0;
+    ACQUIRE_LOCK(self);
+    if (!self->flushed) {
+        if (compressor_flush(self) < 0) {
+            goto out;
+        }
+        report = 1;
+    }
+    n = output_read(&self->output, out.buf, (size_t)out.len, 1);
+    v = PyLong_FromSize_t(n);
+out:
+    RELEASE_LOCK(self);
+    PyBuffer_Release(&out);
+    if (v != NULL
+        && report
+        && stats_report(self->stats_callback, self->stats) < 0) {
+        Py_CLEAR(v);
+    }
+    return v;
+}
+
+PyDoc_STRVAR(Compressor_cancel__doc__,
+"cancel() -> None\n"
+"\n"
+CANCEL_DOC);
+
+static PyObject *
+Compressor_cancel(Compressor *self) {
+    /* the lock is held while compressing */
+    self->budget.cancelled = 1;
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef Compressor_methods[] = {
+    {"compress",      (PyCFunction)Compressor_compress,      METH_O,                       Compressor_compress__doc__},
+    {"compress_into", (PyCFunction)Compressor_compress_into, METH_VARARGS,                 Compressor_compress_into__doc__},
+    {"flush",         (PyCFunction)Compressor_flush,         METH_VARARGS | METH_KEYWORDS, Compressor_flush__doc__},
+    {"flush_into",    (PyCFunction)Compressor_flush_into,    METH_VARARGS,                 Compressor_flush_into__doc__},
+    {"cancel",        (PyCFunction)Compressor_cancel,        METH_NOARGS,                  Compressor_cancel__doc__},
+    {0},
+};
+
+static PyMemberDef Compressor_members[] = {
+    {"iterations_used", T_INT,    offsetof(Compressor, budget.iterations), READONLY},
+    {"stats",           T_OBJECT, offsetof(Compressor, stats),             READONLY},
+    {0},
+};
+
+PyTypeObject Compressor_Type = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name      = MODULE ".ZopfliCompressor",
+    .tp_basicsize = sizeof(Compressor),
+    .tp_dealloc   = (destructor)Compressor_dealloc,
+    .tp_flags     = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE | Py_TPFLAGS_HAVE_GC,
+    .tp_doc       = Compressor__doc__,
+    .tp_traverse  = (traverseproc)Compressor_traverse,
+    .tp_clear     = (inquiry)Compressor_clear,
+    .tp_methods   = Compressor_methods,
+    .tp_members   = Compressor_members,
+    .tp_init      = (initproc)Compressor_init,
+    .tp_new       = PyType_GenericNew,
+};
+
+
+typedef struct {
+    PyObject_HEAD
+    ZopfliOptions  options;
+    int            threads;
+    Budget         budget;
+    Stats          counters;
+    PyObject      *stats;
+    PyObject      *stats_callback;
+    Window         window;
+    Output         output;
+    PyObject      *data;
+    int            flushed;
+#ifdef WITH_THREAD
+    PyThread_type_lock lock;
+#endif
+} Deflater;
+
+static int
+Deflater_traverse(Deflater *self, visitproc visit, void *arg) {
+    Py_VISIT(self->data);
+    Py_VISIT(self->stats_callback);
+    return 0;
+}
+
+static int
+Deflater_clear(Deflater *self) {
+    window_free(&self->window);
+    Py_CLEAR(self->data);
+    Py_CLEAR(self->stats);
+    Py_CLEAR(self->stats_callback);
+    return 0;
+}
+
+static void
+Deflater_dealloc(Deflater *self) {
+    PyObject_GC_UnTrack(self);
+    Deflater_clear(self);
+    output_free(&self->output);
+    FREE_LOCK(self);
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+PyDoc_STRVAR(Deflater__doc__,
+"ZopfliDeflater(verbose=False, iterations=15, block_splitting=True,"
+" block_splitting_max=15, threads=1, deadline=0.0, min_gain=0.0,"
+" stats_callback=None, zdict=None)\n"
+"\n"
+"Create a compressor object which is using the ZopfliDeflatePart()\n"
+"function for compressing data.\n"
+"\n"
+"The last 32 KiB of the data is used as the history for the next\n"
+"call to the compress() method.\n"
+"\n"
+ZDICT_DOC "\n"
+"\n"
+"If threads is greater than 1, blocks are compressed in parallel on up to\n"
+"threads native threads, and each of them is aligned to a byte boundary.\n"
+"\n"
+BUDGET_DOC
+"\n"
+"\n"
+STATS_DOC);
+
+static int
+Deflater_init(Deflater *self, PyObject *args, PyObject *kwargs) {
+    static char *kwlist[] = {
+        "verbose",
+        "iterations",
+        "block_splitting",
+        "block_splitting_max",
+        "threads",
+        "deadline",
+        "min_gain",
+        "stats_callback",
+        "zdict",
+        NULL,
+    };
+    PyObject *verbose, *blocksplitting, *stats_callback, *zdict;
+    unsigned long dictid;
+
+    ZopfliInitOptions(&self->options);
+    verbose = Py_False;
+    blocksplitting = Py_True;
+    self->threads = 1;
+    memset(&self->budget, 0, sizeof(self->budget));
+    stats_callback = Py_None;
+    zdict = NULL;
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs,
+                "|OiOiiddOO:ZopfliDeflater", kwlist,
+                &verbose,
+                &self->options.numiterations,
+                &blocksplitting,
+                &self->options.blocksplittingmax,
+                &self->threads,
+                &self->budget.deadline,
+                &self->budget.min_gain,
+                &stats_callback,
+                &zdict)) {
+        return -1;
+    }
+
+    if (self->threads < 1) {
+        PyErr_SetString(PyExc_ValueError, "threads must be positive");
+        return -1;
+    }
+    if (parse_budget(&self->budget) < 0
+        || stats_parse_callback(stats_callback) < 0
+        || parse_zdict(ZOPFLI_FORMAT_DEFLATE, zdict) < 0) {
+        return -1;
+    }
+
+    PARSE_BOOL(self, verbose);
+    PARSE_BOOL(self, blocksplitting);
+
+    Deflater_clear(self);
+    Py_INCREF(stats_callback);
+    self->stats_callback = stats_callback;
+    memset(&self->counters, 0, sizeof(self->counters));
+    output_free(&self->output);
+    if (zdict != NULL
+        && window_prime(&self->window, zdict, &dictid) < 0) {
+        return -1;
+    }
+    self->flushed = 0;
+#ifdef WITH_THREAD
+    ALLOCATE_LOCK(self);
+    if (PyErr_Occurred() != NULL) {
+        return -1;
+    }
+#endif
+    return 0;
+}
+
+/* compress the pending data into self->output */
+static int
+deflate_part(Deflater *self, int final) {
+    Py_buffer in = {0};
+    int rv;
+
+    if (self->data == NULL) {
+        return 0;
+    }
+
+    rv = -1;
+    if (PyObject_GetBuffer(self->data, &in, PyBUF_CONTIG_RO) < 0) {
+        goto out;
+    }
+    if (window_append(&self->window, in.buf, in.len) < 0) {
+        goto out;
+    }
+
+    self->counters.bytes_in += in.len;
+    budget_start(&self->budget, self->options.numiterations);
+    Py_BEGIN_ALLOW_THREADS
+    rv = deflate_window(&self->options, final, &self->window, self->window.size, &self->output,
+                        ZOPFLI_MASTER_BLOCK_SIZE, self->threads, &self->budget, &self->counters);
+    window_slide(&self->window, self->window.size);
+    Py_END_ALLOW_THREADS
+    if (rv < 0) {
+        PyErr_NoMemory();
+    } else {
+        rv = check_cancelled(&self->budget, "Deflater");
+    }
+out:
+    PyBuffer_Release(&in);
+    Py_CLEAR(self->data);
+    return rv;
+}
+
+static int
+deflater_compress(Deflater *self, PyObject *data) {
+    if (self->flushed) {
+        PyErr_SetString(PyExc_ValueError, "Deflater has been flushed");
+        return -1;
+    } else if (check_cancelled(&self->budget, "Deflater") < 0
+               || deflate_part(self, 0) < 0) {
+        return -1;
+    }
+    Py_INCREF(data);
+    self->data = data;
+    return 0;
+}
+
+PyDoc_STRVAR(Deflater_compress__doc__,
+"compress(data) -> bytes");
+
+static PyObject *
+Deflater_compress(Deflater *self, PyObject *data) {
+    PyObject *v;
+
+    v = NULL;
+    ACQUIRE_LOCK(self);
+    if (deflater_compress(self, data) == 0) {
+        v = output_take(&self->output, 0);
+        if (v != NULL) {
+            self->counters.bytes_out += PyBytes_GET_SIZE(v);
+        }
+    }
+    RELEASE_LOCK(self);
+    return v;
+}
+
+PyDoc_STRVAR(Deflater_compress_into__doc__,
+"compress_into(data, buffer) -> int\n"
+"\n"
+"Same as the compress() method, but write the compressed data into the\n"
+"writable buffer, and return the number of bytes written. The data which\n"
+"does not fit in buffer is written by the next call.");
+
+static PyObject *
+Deflater_compress_into(Deflater *self, PyObject *args) {
+    PyObject *data, *v;
+    Py_buffer out = {0};
+    size_t n;
+
+    if (!PyArg_ParseTuple(args, "Ow*:compress_into", &data, &out)) {
+        return NULL;
+    }
+
+    v = NULL;
+    ACQUIRE_LOCK(self);
+    if (deflater_compress(self, data) == 0) {
+        n = output_read(&self->output, out.buf, (size_t)out.len, 0);
+        self->counters.bytes_out += n;
+        v = PyLong_FromSize_t(n);
+    }
+    RELEASE_LOCK(self);
+    PyBuffer_Release(&out);
+    return v;
+}
+
+/* finish the compression into self->output */
+static int
+deflater_flush(Deflater *self) {
+    int rv;
+
+    if (self->flushed) {
+        PyErr_SetString(PyExc_ValueError, "repeated call to flush()");
+        return -1;
+    } else if (check_cancelled(&self->budget, "Deflater") < 0) {
+        return -1;
+    }
+    self->flushed = 1;
+    rv = deflate_part(self, 1);
+    window_free(&self->window);
+    if (rv == 0) {
+        self->counters.bytes_out += self->output.outsize;
+        self->stats = deflate_stats(&self->counters, &self->budget);
+        if (self->stats != NULL) {
+            return 0;
+        }
+    }
+    output_free(&self->output);
+    return -1;
+}
+
+PyDoc_STRVAR(Deflater_flush__doc__,
+"flush(memoryview=False) -> bytes\n"
+"\n"
+"If memoryview is true, return a memoryview of the compressed data which\n"
+"is not copied. The compressor object cannot be used after this method is\n"
+"called.");
+
+static PyObject *
+Deflater_flush(Deflater *self, PyObject *args, PyObject *kwargs) {
+    static char *kwlist[] = {
+        "memoryview",
+        NULL,
+    };
+    PyObject *v;
+    int view;
+
+    view = 0;
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|p:flush", kwlist, &view)) {
+        return NULL;
+    }
+
+    v = NULL;
+    ACQUIRE_LOCK(self);
+    if (deflater_flush(self) == 0) {
+        v = view ? output_view(&self->output) : output_take(&self->output, 1);
+        output_free(&self->output);
+    }
+    RELEASE_LOCK(self);
+    if (v != NULL
+        && stats_report(self->stats_callback, self->stats) < 0) {
+        Py_CLEAR(v);
+    }
+    return v;
+}
+
+PyDoc_STRVAR(Deflater_flush_into__doc__,
+"flush_into(buffer) -> int\n"
+"\n"
+"Same as the flush() method, but write the compressed data into the\n"
+"writable buffer, and return the number of bytes written. The data which\n"
+"does not fit in buffer is written by the subsequent calls to this method,\n"
+"and 0 is returned at the end.");
+
+static PyObject *
+Deflater_flush_into(Deflater *self, PyObject *args) {
+    PyObject *v;
+    Py_buffer out = {0};
+    size_t n;
+    int report;
+
+    if (!PyArg_ParseTuple(args, "w*:flush_into", &out)) {
+        return NULL;
+    }
+
+    v = NULL;
+    report = 0;
+    ACQUIRE_LOCK(self);
+    if (!self->flushed) {
+        if (deflater_flush(self) < 0) {
+            goto out;
+        }
+        report = 1;
+    }
+    n = output_read(&self->output, out.buf, (size_t)out.len, 1);
+    v = PyLong_FromSize_t(n);
+out:
+    RELEASE_LOCK(self);
+    PyBuffer_Release(&out);
+    if (v != NULL
+        && report
+        && stats_report(self->stats_callback, self->stats) < 0) {
+        Py_CLEAR(v);
+    }
+    return v;
+}
+
+PyDoc_STRVAR(Deflater_cancel__doc__,
+"cancel() -> None\n"
+"\n"
+CANCEL_DOC);
+
+static PyObject *
+Deflater_cancel(Deflater *self) {
+    /* the lock is held while compressing */
+    self->budget.cancelled = 1;
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef Deflater_methods[] = {
+    {"compress",      (PyCFunction)Deflater_compress,      METH_O,                       Deflater_compress__doc__},
+    {"compress_into", (PyCFunction)Deflater_compress_into, METH_VARARGS,                 Deflater_compress_into__doc__},
+    {"flush",         (PyCFunction)Deflater_flush,         METH_VARARGS | METH_KEYWORDS, Deflater_flush__doc__},
+    {"flush_into",    (PyCFunction)Deflater_flush_into,    METH_VARARGS,                 Deflater_flush_into__doc__},
+    {"cancel",        (PyCFunction)Deflater_cancel,        METH_NOARGS,                  Deflater_cancel__doc__},
+    {0},
+};
+
+static PyMemberDef Deflater_members[] = {
+    {"iterations_used", T_INT,    offsetof(Deflater, budget.iterations), READONLY},
+    {"stats",           T_OBJECT, offsetof(Deflater, stats),             READONLY},
+    {0},
+};
+
+PyTypeObject Deflater_Type = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name      = MODULE ".ZopfliDeflater",
+    .tp_basicsize = sizeof(Deflater),
+    .tp_dealloc   = (destructor)Deflater_dealloc,
+    .tp_flags     = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE | Py_TPFLAGS_HAVE_GC,
+    .tp_doc       = Deflater__doc__,
+    .tp_traverse  = (traverseproc)Deflater_traverse,
+    .tp_clear     = (inquiry)Deflater_clear,
+    .tp_methods   = Deflater_methods,
+    .tp_members   = Deflater_members,
+    .tp_init      = (initproc)Deflater_init,
+    .tp_new       = PyType_GenericNew,
+};
+
+
+/*
+ * compress data at once without copying it. If fd is not negative, the
+ * output is written to fd after each segment, and None is returned.
+ */
+static PyObject *
+compress_data(ZopfliFormat format, Py_buffer *in, int fd, PyObject *verbose, PyObject *blocksplitting,
+              ZopfliOptions *options, int threads, Budget *b) {
+    PyObject *v;
+    Window w = {0};
+    Output o = {0};
+    Stats s = {0};
+    unsigned long checksum;
+    size_t end, size;
+    int err, nomem;
+
+    v = NULL;
+    if (parse_format(format) < 0) {
+        goto out;
+    } else if (threads < 1) {
+        PyErr_SetString(PyExc_ValueError, "threads must be positive");
+        goto out;
+    } else if (parse_budget(b) < 0
+               || (options->verbose = PyObject_IsTrue(verbose)) < 0
+               || (options->blocksplitting = PyObject_IsTrue(blocksplitting)) < 0) {
+        goto out;
+    }
+
+    w.buf = in->buf;
+    w.size = w.alloc = (size_t)in->len;
+    /* same as a single segment for the whole data when fd is negative */
+    size = fd < 0 ? w.size : (size_t)ZOPFLI_MASTER_BLOCK_SIZE * threads;
+    err = 0;
+    budget_start(b, options->numiterations);
+    Py_BEGIN_ALLOW_THREADS
+    nomem = container_header(format, &o, NULL) < 0;
+    checksum = container_checksum(format, container_checksum(format, 0, NULL, 0), w.buf, w.size);
+    while (!nomem) {
+        end = w.size - w.dictsize > size ? w.dictsize + size : w.size;
+        if (deflate_window(options, end == w.size, &w, end, &o, ZOPFLI_MASTER_BLOCK_SIZE, threads, b, &s) < 0) {
+            nomem = 1;
+            break;
+        }
+        w.dictsize = end;
+        if (fd >= 0
+            && output_write(&o, fd, 0) < 0) {
+            err = errno;
+            break;
+        } else if (end == w.size) {
+            break;
+        }
+    }
+    if (!nomem
+        && err == 0
+        && container_trailer(format, &o, checksum, w.size) < 0) {
+        nomem = 1;
+    }
+    if (fd >= 0
+        && !nomem
+        && err == 0
+        && output_write(&o, fd, 1) < 0) {
+        err = errno;
+    }
+    Py_END_ALLOW_THREADS
+    if (nomem) {
+        PyErr_NoMemory();
+    } else if (fd < 0) {
+        v = output_take(&o, 1);
+    } else if (err != 0) {
+        errno = err;
+        PyErr_SetFromErrno(PyExc_OSError);
+    } else {
+        Py_INCREF(Py_None);
+        v = Py_None;
+    }
+    output_free(&o);
+out:
+    PyBuffer_Release(in);
+    return v;
+}
+
+#define COMPRESS_DOC                                                             \
+"data can be any object which supports the buffer protocol, and is not\n"       \
+"copied before the compression. The other parameters are the same as those\n"   \
+"of the ZopfliCompressor class."
+
+PyDoc_STRVAR(compress__doc__,
+"compress(data, format=ZOPFLI_FORMAT_DEFLATE, verbose=False, iterations=15,"
+" block_splitting=True, block_splitting_max=15, threads=1, deadline=0.0,"
+" min_gain=0.0) -> bytes\n"
 "\n"
-"Create a compressor object which is using the ZopfliCompress()\n"
-"function for compressing data.");
+"Compress data at once.\n"
+"\n"
+COMPRESS_DOC);
 
-static int
-Compressor_init(Compressor *self, PyObject *args, PyObject *kwargs) {
+static PyObject *
+zopfli_compress(PyObject *self, PyObject *args, PyObject *kwargs) {
     static char *kwlist[] = {
+        "data",
         "format",
         "verbose",
         "iterations",
         "block_splitting",
         "block_splitting_max",
+        "threads",
+        "deadline",
+        "min_gain",
         NULL,
     };
-    PyObject *verbose, *blocksplitting, *io;
+    ZopfliFormat format;
+    ZopfliOptions options;
+    PyObject *verbose, *blocksplitting;
+    Py_buffer in = {0};
+    Budget b = {0};
+    int threads;
 
-    self->format = ZOPFLI_FORMAT_DEFLATE;
-    ZopfliInitOptions(&self->options);
+    format = ZOPFLI_FORMAT_DEFLATE;
+    ZopfliInitOptions(&options);
     verbose = Py_False;
     blocksplitting = Py_True;
+    threads = 1;
     if (!PyArg_ParseTupleAndKeywords(args, kwargs,
-                                     "|iOiOi:ZopfliCompressor", kwlist,
-                                     &self->format,
+                                     "y*|iOiOiidd:compress", kwlist,
+                                     &in,
+                                     &format,
                                      &verbose,
-                                     &self->options.numiterations,
+                                     &options.numiterations,
                                      &blocksplitting,
-                                     &self->options.blocksplittingmax)) {
-        return -1;
-    }
-
-    switch (self->format) {
-    case ZOPFLI_FORMAT_GZIP:
-    case ZOPFLI_FORMAT_ZLIB:
-    case ZOPFLI_FORMAT_DEFLATE:
-        break;
-    default:
-        PyErr_SetString(PyExc_ValueError, "unknown format");
-        return -1;
+                                     &options.blocksplittingmax,
+                                     &threads,
+                                     &b.deadline,
+                                     &b.min_gain)) {
+        return NULL;
     }
+    return compress_data(format, &in, -1, verbose, blocksplitting, &options, threads, &b);
+}
 
-    PARSE_BOOL(self, verbose);
-    PARSE_BOOL(self, blocksplitting);
-
-    io = PyImport_ImportModule("io");
-    if (io == NULL) {
-        return -1;
-    }
-    Py_XDECREF(self->data);
-    self->data = PyObject_CallMethod(io, "BytesIO", NULL);
-    Py_DECREF(io);
-    if (self->data == NULL) {
-        return -1;
-    }
+/* same as zopfli_compress(), but format is fixed */
+static PyObject *
+compress_format(ZopfliFormat format, PyObject *args, PyObject *kwargs, const char *fmt) {
+    static char *kwlist[] = {
+        "data",
+        "verbose",
+        "iterations",
+        "block_splitting",
+        "block_splitting_max",
+        "threads",
+        "deadline",
+        "min_gain",
+        NULL,
+    };
+    ZopfliOptions options;
+    PyObject *verbose, *blocksplitting;
+    Py_buffer in = {0};
+    Budget b = {0};
+    int threads;
 
-    self->flushed = 0;
-#ifdef WITH_THREAD
-    ALLOCATE_LOCK(self);
-    if (PyErr_Occurred() != NULL) {
-        return -1;
+    ZopfliInitOptions(&options);
+    verbose = Py_False;
+    blocksplitting = Py_True;
+    threads = 1;
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, fmt, kwlist,
+                                     &in,
+                                     &verbose,
+                                     &options.numiterations,
+                                     &blocksplitting,
+                                     &options.blocksplittingmax,
+                                     &threads,
+                                     &b.deadline,
+                                     &b.min_gain)) {
+        return NULL;
     }
-#endif
-    return 0;
+    return compress_data(format, &in, -1, verbose, blocksplitting, &options, threads, &b);
 }
 
-PyDoc_STRVAR(Compressor_compress__doc__,
-"compress(data) -> bytes");
+PyDoc_STRVAR(gzip_compress__doc__,
+"gzip_compress(data, verbose=False, iterations=15, block_splitting=True,"
+" block_splitting_max=15, threads=1, deadline=0.0, min_gain=0.0) -> bytes\n"
+"\n"
+"Compress data at once in the gzip format.\n"
+"\n"
+COMPRESS_DOC);
 
 static PyObject *
-Compressor_compress(Compressor *self, PyObject *data) {
-    PyObject *v, *n;
+zopfli_gzip_compress(PyObject *self, PyObject *args, PyObject *kwargs) {
+    return compress_format(ZOPFLI_FORMAT_GZIP, args, kwargs, "y*|OiOiidd:gzip_compress");
+}
 
-    v = NULL;
-    ACQUIRE_LOCK(self);
-    if (self->flushed) {
-        PyErr_SetString(PyExc_ValueError, "Compressor has been flushed");
-        goto out;
-    }
-    n = PyObject_CallMethod(self->data, "write", "O", data);
-    if (n == NULL) {
-        goto out;
-    }
-    Py_DECREF(n);
-    v = PyBytes_FromString("");
-out:
-    RELEASE_LOCK(self);
-    return v;
+PyDoc_STRVAR(zlib_compress__doc__,
+"zlib_compress(data, verbose=False, iterations=15, block_splitting=True,"
+" block_splitting_max=15, threads=1, deadline=0.0, min_gain=0.0) -> bytes\n"
+"\n"
+"Compress data at once in the zlib format.\n"
+"\n"
+COMPRESS_DOC);
+
+static PyObject *
+zopfli_zlib_compress(PyObject *self, PyObject *args, PyObject *kwargs) {
+    return compress_format(ZOPFLI_FORMAT_ZLIB, args, kwargs, "y*|OiOiidd:zlib_compress");
 }
 
-PyDoc_STRVAR(Compressor_flush__doc__,
-"flush() -> bytes\n"
+PyDoc_STRVAR(compress_fd__doc__,
+"compress_fd(data, fd, format=ZOPFLI_FORMAT_DEFLATE, verbose=False,"
+" iterations=15, block_splitting=True, block_splitting_max=15, threads=1,"
+" deadline=0.0, min_gain=0.0) -> None\n"
 "\n"
-"The compressor object cannot be used after this method is called.");
+"Same as the compress() function, but write the compressed data to the\n"
+"file descriptor fd in segments of ZOPFLI_MASTER_BLOCK_SIZE * threads bytes\n"
+"of data.");
 
 static PyObject *
-Compressor_flush(Compressor *self) {
-    PyObject *v, *b;
+zopfli_compress_fd(PyObject *self, PyObject *args, PyObject *kwargs) {
+    static char *kwlist[] = {
+        "data",
+        "fd",
+        "format",
+        "verbose",
+        "iterations",
+        "block_splitting",
+        "block_splitting_max",
+        "threads",
+        "deadline",
+        "min_gain",
+        NULL,
+    };
+    ZopfliFormat format;
+    ZopfliOptions options;
+    PyObject *verbose, *blocksplitting;
     Py_buffer in = {0};
-    unsigned char *out;
-    size_t outsize;
+    Budget b = {0};
+    int fd, threads;
 
-    v = NULL;
-    b = NULL;
-    ACQUIRE_LOCK(self);
-    if (self->flushed) {
-        PyErr_SetString(PyExc_ValueError, "repeated call to flush()");
-        goto out;
-    }
-    b = PyObject_CallMethod(self->data, "getbuffer", NULL);
-    if (b == NULL
-        || PyObject_GetBuffer(b, &in, PyBUF_CONTIG_RO) < 0) {
-        goto out;
+    format = ZOPFLI_FORMAT_DEFLATE;
+    ZopfliInitOptions(&options);
+    verbose = Py_False;
+    blocksplitting = Py_True;
+    threads = 1;
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs,
+                                     "y*i|iOiOiidd:compress_fd", kwlist,
+                                     &in,
+                                     &fd,
+                                     &format,
+                                     &verbose,
+                                     &options.numiterations,
+                                     &blocksplitting,
+                                     &options.blocksplittingmax,
+                                     &threads,
+                                     &b.deadline,
+                                     &b.min_gain)) {
+        return NULL;
+    } else if (fd < 0) {
+        PyBuffer_Release(&in);
+        PyErr_SetString(PyExc_ValueError, "fd must be non-negative");
+        return NULL;
     }
-
-    out = NULL;
-    outsize = 0;
-    Py_BEGIN_ALLOW_THREADS
-    ZopfliCompress(&self->options, self->format, in.buf, in.len,
-                   &out, &outsize);
-    Py_END_ALLOW_THREADS
-
-    v = PyBytes_FromStringAndSize((char *)out, outsize);
-    free(out);
-    PyBuffer_Release(&in);
-out:
-    self->flushed = 1;
-    Py_XDECREF(b);
-    RELEASE_LOCK(self);
-    return v;
+    return compress_data(format, &in, fd, verbose, blocksplitting, &options, threads, &b);
 }
 
-static PyMethodDef Compressor_methods[] = {
-    {"compress", (PyCFunction)Compressor_compress, METH_O,      Compressor_compress__doc__},
-    {"flush",    (PyCFunction)Compressor_flush,    METH_NOARGS, Compressor_flush__doc__},
-    {0},
-};
-
-PyTypeObject Compressor_Type = {
-    PyVarObject_HEAD_INIT(NULL, 0)
-    .tp_name      = MODULE ".ZopfliCompressor",
-    .tp_basicsize = sizeof(Compressor),
-    .tp_dealloc   = (destructor)Compressor_dealloc,
-    .tp_flags     = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE,
-    .tp_doc       = Compressor__doc__,
-    .tp_methods   = Compressor_methods,
-    .tp_init      = (initproc)Compressor_init,
-    .tp_new       = PyType_GenericNew,
-};
+/* return the number of CPUs, or 1 if it is undetermined */
+static int
+cpu_count(void) {
+    PyObject *os, *v;
+    long n;
 
+    os = PyImport_ImportModule("os");
+    if (os == NULL) {
+        return -1;
+    }
+    v = PyObject_CallMethod(os, "cpu_count", NULL);
+    Py_DECREF(os);
+    if (v == NULL) {
+        return -1;
+    }
+    n = v != Py_None ? PyLong_AsLong(v) : 1;
+    Py_DECREF(v);
+    if (n < 0) {
+        return -1;
+    }
+    return n < INT_MAX ? (int)n : INT_MAX;
+}
 
 typedef struct {
-    PyObject_HEAD
-    ZopfliOptions  options;
-    unsigned char  bp;
-    unsigned char *out;
-    size_t         outsize;
-    PyObject      *data;
-    int            flushed;
-#ifdef WITH_THREAD
-    PyThread_type_lock lock;
-#endif
-} Deflater;
+    ZopfliFormat         format;
+    const ZopfliOptions *options;
+    const Budget        *budget;
+    Py_buffer           *in;
+    Output              *outputs;
+    volatile int         nomem;
+} Payloads;
 
 static void
-Deflater_dealloc(Deflater *self) {
-    free(self->out);
-    Py_XDECREF(self->data);
-    FREE_LOCK(self);
-    Py_TYPE(self)->tp_free((PyObject *)self);
+compress_payload(void *arg, size_t i) {
+    Payloads *p;
+    Window w = {0};
+    Output *o;
+    Budget b;
+    Stats s = {0};
+    unsigned long checksum;
+
+    p = arg;
+    w.buf = p->in[i].buf;
+    w.size = w.alloc = (size_t)p->in[i].len;
+    o = &p->outputs[i];
+    /* the budget is applied to each payload */
+    b = *p->budget;
+    budget_start(&b, p->options->numiterations);
+    checksum = container_checksum(p->format, container_checksum(p->format, 0, NULL, 0), w.buf, w.size);
+    if (container_header(p->format, o, NULL) < 0
+        || deflate_window(p->options, 1, &w, w.size, o, ZOPFLI_MASTER_BLOCK_SIZE, 1, &b, &s) < 0
+        || container_trailer(p->format, o, checksum, w.size) < 0) {
+        p->nomem = 1;
+    }
 }
 
-PyDoc_STRVAR(Deflater__doc__,
-"ZopfliDeflater(verbose=False, iterations=15, block_splitting=True,"
-" block_splitting_max=15)\n"
+PyDoc_STRVAR(compress_many__doc__,
+"compress_many(iterable, format=ZOPFLI_FORMAT_DEFLATE, workers=0,"
+" verbose=False, iterations=15, block_splitting=True, block_splitting_max=15,"
+" deadline=0.0, min_gain=0.0) -> list\n"
 "\n"
-"Create a compressor object which is using the ZopfliDeflatePart()\n"
-"function for compressing data.");
+"Compress each item of iterable at once on up to workers native threads, or\n"
+"the number of CPUs if workers is 0, and return a list of the compressed\n"
+"data in the same order as iterable. The GIL is released only once for all\n"
+"the items, and deadline and min_gain are applied to each of them.\n"
+"\n"
+"Each item can be any object which supports the buffer protocol, and is not\n"
+"copied before the compression. The other parameters are the same as those\n"
+"of the ZopfliCompressor class.");
 
-static int
-Deflater_init(Deflater *self, PyObject *args, PyObject *kwargs) {
+static PyObject *
+zopfli_compress_many(PyObject *self, PyObject *args, PyObject *kwargs) {
     static char *kwlist[] = {
+        "iterable",
+        "format",
+        "workers",
         "verbose",
         "iterations",
         "block_splitting",
         "block_splitting_max",
+        "deadline",
+        "min_gain",
         NULL,
     };
-    PyObject *verbose, *blocksplitting;
+    Payloads p = {0};
+    ZopfliOptions options;
+    PyObject *iterable, *verbose, *blocksplitting, *seq, *v, *b;
+    Budget budget = {0};
+    Py_ssize_t i, n;
+    int workers;
 
-    ZopfliInitOptions(&self->options);
+    p.format = ZOPFLI_FORMAT_DEFLATE;
+    ZopfliInitOptions(&options);
     verbose = Py_False;
     blocksplitting = Py_True;
+    workers = 0;
     if (!PyArg_ParseTupleAndKeywords(args, kwargs,
-                "|OiOi:ZopfliDeflater", kwlist,
-                &verbose,
-                &self->options.numiterations,
-                &blocksplitting,
-                &self->options.blocksplittingmax)) {
-        return -1;
+                                     "O|iiOiOidd:compress_many", kwlist,
+                                     &iterable,
+                                     &p.format,
+                                     &workers,
+                                     &verbose,
+                                     &options.numiterations,
+                                     &blocksplitting,
+                                     &options.blocksplittingmax,
+                                     &budget.deadline,
+                                     &budget.min_gain)) {
+        return NULL;
     }
 
-    PARSE_BOOL(self, verbose);
-    PARSE_BOOL(self, blocksplitting);
-
-    self->bp = 0;
-    free(self->out);
-    self->out = NULL;
-    self->outsize = 0;
-    Py_CLEAR(self->data);
-    self->flushed = 0;
-#ifdef WITH_THREAD
-    ALLOCATE_LOCK(self);
-    if (PyErr_Occurred() != NULL) {
-        return -1;
+    if (parse_format(p.format) < 0) {
+        return NULL;
+    } else if (workers < 0) {
+        PyErr_SetString(PyExc_ValueError, "workers must be non-negative");
+        return NULL;
+    } else if (parse_budget(&budget) < 0
+               || (options.verbose = PyObject_IsTrue(verbose)) < 0
+               || (options.blocksplitting = PyObject_IsTrue(blocksplitting)) < 0
+               || (workers == 0 && (workers = cpu_count()) < 0)) {
+        return NULL;
     }
-#endif
-    return 0;
-}
-
-static PyObject *
-deflate_part(Deflater *self, int final) {
-    PyObject *v;
-    Py_buffer in = {0};
-    size_t pos, off, n;
 
-    if (self->data == NULL) {
-        return PyBytes_FromString("");
+    seq = PySequence_Fast(iterable, "iterable must be iterable");
+    if (seq == NULL) {
+        return NULL;
     }
-
     v = NULL;
-    if (PyObject_GetBuffer(self->data, &in, PyBUF_CONTIG_RO) < 0) {
+    n = PySequence_Fast_GET_SIZE(seq);
+    p.options = &options;
+    p.budget = &budget;
+    p.in = PyMem_Calloc(n ? n : 1, sizeof(Py_buffer));
+    p.outputs = calloc(n ? n : 1, sizeof(Output));
+    if (p.in == NULL
+        || p.outputs == NULL) {
+        PyErr_NoMemory();
         goto out;
     }
-
-    pos = self->outsize;
-    Py_BEGIN_ALLOW_THREADS
-    ZopfliDeflatePart(&self->options, 2, final, in.buf, 0, in.len, &self->bp,
-                      &self->out, &self->outsize);
-    Py_END_ALLOW_THREADS
-    if (!final) {
-        /* exclude '256 (end of block)' symbol */
-        if (pos == 0) {
-            off = pos;
-            n = self->outsize - 1;
-        } else {
-            off = pos - 1;
-            n = self->outsize - pos;
-        }
-    } else {
-        /* include '256 (end of block)' symbol */
-        if (pos == 0) {
-            off = pos;
-            n = self->outsize;
-        } else {
-            off = pos - 1;
-            n = self->outsize - pos + 1;
+    for (i = 0; i < n; ++i) {
+        if (PyObject_GetBuffer(PySequence_Fast_GET_ITEM(seq, i), &p.in[i], PyBUF_CONTIG_RO) < 0) {
+            goto out;
         }
     }
-    v = PyBytes_FromStringAndSize((char *)self->out + off, n);
-out:
-    PyBuffer_Release(&in);
-    Py_CLEAR(self->data);
-    return v;
-}
-
-PyDoc_STRVAR(Deflater_compress__doc__,
-"compress(data) -> bytes");
-
-static PyObject *
-Deflater_compress(Deflater *self, PyObject *data) {
-    PyObject *v;
 
-    v = NULL;
-    ACQUIRE_LOCK(self);
-    if (self->flushed) {
-        PyErr_SetString(PyExc_ValueError, "Deflater has been flushed");
+    Py_BEGIN_ALLOW_THREADS
+    parallel_run(workers, (size_t)n, compress_payload, &p);
+    Py_END_ALLOW_THREADS
+    if (p.nomem) {
+        PyErr_NoMemory();
         goto out;
     }
-    v = deflate_part(self, 0);
+    v = PyList_New(n);
     if (v == NULL) {
         goto out;
     }
-    Py_INCREF(data);
-    self->data = data;
-out:
-    RELEASE_LOCK(self);
-    return v;
-}
-
-PyDoc_STRVAR(Deflater_flush__doc__,
-"flush() -> bytes\n"
-"\n"
-"The compressor object cannot be used after this method is called."
-"");
-
-static PyObject *
-Deflater_flush(Deflater *self) {
-    PyObject *v;
-
-    v = NULL;
-    ACQUIRE_LOCK(self);
-    if (self->flushed) {
-        PyErr_SetString(PyExc_ValueError, "repeated call to flush()");
-        goto out;
+    for (i = 0; i < n; ++i) {
+        b = output_take(&p.outputs[i], 1);
+        if (b == NULL) {
+            Py_CLEAR(v);
+            goto out;
+        }
+        PyList_SET_ITEM(v, i, b);
     }
-    self->flushed = 1;
-    v = deflate_part(self, 1);
 out:
-    RELEASE_LOCK(self);
+    for (i = 0; i < n; ++i) {
+        if (p.in != NULL) {
+            PyBuffer_Release(&p.in[i]);
+        }
+        if (p.outputs != NULL) {
+            output_free(&p.outputs[i]);
+        }
+    }
+    PyMem_Free(p.in);
+    free(p.outputs);
+    Py_DECREF(seq);
     return v;
 }
 
-static PyMethodDef Deflater_methods[] = {
-    {"compress", (PyCFunction)Deflater_compress, METH_O,      Deflater_compress__doc__},
-    {"flush",    (PyCFunction)Deflater_flush,    METH_NOARGS, Deflater_flush__doc__},
+static PyMethodDef zopfli_methods[] = {
+    {"compress",      (PyCFunction)zopfli_compress,      METH_VARARGS | METH_KEYWORDS, compress__doc__},
+    {"gzip_compress", (PyCFunction)zopfli_gzip_compress, METH_VARARGS | METH_KEYWORDS, gzip_compress__doc__},
+    {"zlib_compress", (PyCFunction)zopfli_zlib_compress, METH_VARARGS | METH_KEYWORDS, zlib_compress__doc__},
+    {"compress_fd",   (PyCFunction)zopfli_compress_fd,   METH_VARARGS | METH_KEYWORDS, compress_fd__doc__},
+    {"compress_many", (PyCFunction)zopfli_compress_many, METH_VARARGS | METH_KEYWORDS, compress_many__doc__},
     {0},
 };
 
-PyTypeObject Deflater_Type = {
-    PyVarObject_HEAD_INIT(NULL, 0)
-    .tp_name      = MODULE ".ZopfliDeflater",
-    .tp_basicsize = sizeof(Deflater),
-    .tp_dealloc   = (destructor)Deflater_dealloc,
-    .tp_flags     = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE,
-    .tp_doc       = Deflater__doc__,
-    .tp_methods   = Deflater_methods,
-    .tp_init      = (initproc)Deflater_init,
-    .tp_new       = PyType_GenericNew,
-};
-
 
 static struct PyModuleDef _zopflimodule = {
     PyModuleDef_HEAD_INIT,
-    .m_name = MODULE,
-    .m_size = -1,
+    .m_name    = MODULE,
+    .m_size    = -1,
+    .m_methods = zopfli_methods,
 };
 
 
@@ -387,6 +2279,8 @@ PyInit__zopfli(void) {
     if (m == NULL) {
         goto err;
     }
+    make_crc_table();
+
 #ifdef Py_GIL_DISABLED
     PyUnstable_Module_SetGIL(m, Py_MOD_GIL_NOT_USED);
 #endif
@@ -414,6 +2308,11 @@ PyInit__zopfli(void) {
 
 #undef ADD_TYPE
 
+    if (PyType_Ready(&Batch_Type) < 0
+        || PyType_Ready(&Buffer_Type) < 0) {
+        goto err;
+    }
+
     return m;
 err:
     return NULL;
@@ -56,9 +56,41 @@ extern "C" {
 # endif
 
 
+/* iteration budget */
+typedef struct {
+    double deadline;   /* seconds per call, or 0 */
+    double min_gain;   /* relative size reduction per iteration, or 0 */
+    double limit;
+    double overhead;   /* cost of a call besides the iterations, in iterations */
+    int    iterations; /* the fewest iterations used in the last call */
+    volatile int cancelled;
+} Budget;
+
+int budget_active(const Budget *b);
+void budget_start(Budget *b, int iterations);
+int budget_search(Budget *b, int max, double scale, size_t (*func)(void *, int), void *arg, double *cost);
+int budget_fit(Budget *b, int k, double cost);
+
+
+/* statistics of the last compression */
+typedef struct {
+    size_t bytes_in;
+    size_t bytes_out;
+    size_t segments;    /* parts compressed by ZopfliDeflatePart() */
+    double time;        /* seconds spent in compression */
+    double search_time; /* seconds spent in trials to choose the iterations */
+} Stats;
+
+double monotonic(void);
+PyObject *stats_new(const Stats *s, int iterations);
+int stats_parse_callback(PyObject *callback);
+int stats_report(PyObject *callback, PyObject *stats);
+
+
 extern PyTypeObject Compressor_Type;
 extern PyTypeObject Deflater_Type;
 extern PyTypeObject PNG_Type;
+extern PyTypeObject Batch_Type;
 
 
 # ifdef __cplusplus
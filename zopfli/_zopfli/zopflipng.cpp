@@ -8,8 +8,20 @@
 
 #include "_zopflimodule.h"
 
+#include <algorithm>
+#include <atomic>
+#include <cerrno>
+#include <condition_variable>
+#include <cstring>
+#include <mutex>
+#include <numeric>
+#include <string>
+#include <thread>
+#include <vector>
+
 #include "zopflipng/zopflipng_lib.h"
 #include "zopflipng/lodepng/lodepng.h"
+#include "zopflipng/lodepng/lodepng_util.h"
 
 
 template<typename T>
@@ -39,11 +51,53 @@ static inline PyObject* str_FromString(const char* s) {
 }
 
 
+enum Verify {
+    VERIFY_NONE,
+    VERIFY_HEADER,
+    VERIFY_FULL,
+};
+
+static const char* verify_names[] = {
+    "none",
+    "header",
+    "full",
+};
+
+struct Options : ZopfliPNGOptions {
+    Options()
+        : verify(VERIFY_FULL),
+          deadline(0.0),
+          min_gain(0.0),
+          threads(1),
+          filter_candidates(0) {
+    }
+
+    Verify verify;
+    double deadline;
+    double min_gain;
+    int    threads;
+    int    filter_candidates;
+};
+
+struct PNGStats : Stats {
+    PNGStats()
+        : Stats(),
+          strategy('\0') {
+    }
+
+    char                                 strategy;  // the chosen filter strategy, or '\0'
+    std::vector<std::pair<char, size_t>> estimates; // the size of each filter strategy with the fast compression
+};
+
+
 struct PNG {
     PyObject_HEAD
     PyObject*         filter_strategies;
     PyObject*         keep_chunks;
-    ZopfliPNGOptions* options;
+    PyObject*         stats;
+    PyObject*         stats_callback;
+    Options*          options;
+    Budget            budget;
 #ifdef WITH_THREAD
     PyThread_type_lock lock;
 #endif
@@ -52,12 +106,15 @@ struct PNG {
 static int PNG_traverse(PNG* self, visitproc visit, void* arg) {
     Py_VISIT(self->filter_strategies);
     Py_VISIT(self->keep_chunks);
+    Py_VISIT(self->stats_callback);
     return 0;
 }
 
 static int PNG_clear(PNG* self) {
     Py_CLEAR(self->filter_strategies);
     Py_CLEAR(self->keep_chunks);
+    Py_CLEAR(self->stats);
+    Py_CLEAR(self->stats_callback);
     return 0;
 }
 
@@ -173,13 +230,74 @@ err:
     return -1;
 }
 
+static int parse_verify(PNG* self, PyObject* verify) {
+    if (!str_Check(verify)) {
+        return -1;
+    }
+    for (size_t i = 0; i < sizeof(verify_names) / sizeof(*verify_names); ++i) {
+        if (PyUnicode_CompareWithASCIIString(verify, verify_names[i]) == 0) {
+            self->options->verify = static_cast<Verify>(i);
+            return 0;
+        }
+    }
+    PyErr_Format(PyExc_ValueError, "unknown verify mode: %R", verify);
+    return -1;
+}
+
+static int check_budget(PNG* self) {
+    if (self->options->threads < 1) {
+        PyErr_SetString(PyExc_ValueError, "threads must be positive");
+        return -1;
+    } else if (self->options->filter_candidates < 0) {
+        PyErr_SetString(PyExc_ValueError, "filter_candidates must be non-negative");
+        return -1;
+    } else if (self->options->deadline < 0) {
+        PyErr_SetString(PyExc_ValueError, "deadline must be non-negative");
+        return -1;
+    } else if (self->options->min_gain < 0) {
+        PyErr_SetString(PyExc_ValueError, "min_gain must be non-negative");
+        return -1;
+    }
+    return 0;
+}
+
 PyDoc_STRVAR(PNG__doc__,
 "ZopfliPNG(verbose=False, lossy_transparent=False, lossy_8bit=False,"
 " filter_strategies='', auto_filter_strategy=True, keep_color_type=False,"
-" keep_chunks=None, use_zopfli=True, iterations=15, iterations_large=5)\n"
+" keep_chunks=None, use_zopfli=True, iterations=15, iterations_large=5,"
+" verify='full', deadline=0.0, min_gain=0.0, stats_callback=None, threads=1,"
+" filter_candidates=0)\n"
 "\n"
 "Create a PNG optimizer which is using the ZopfliPNGOptimize()\n"
 "function for optimizing PNG files.\n"
+"\n"
+"If threads is greater than 1, filter_strategies are tried in parallel on\n"
+"up to threads native threads, and the smallest result is kept. It has no\n"
+"effect when auto_filter_strategy is true and filter_candidates is 0,\n"
+"because only the best strategy with the fast compression is compressed\n"
+"with Zopfli.\n"
+"\n"
+"If filter_candidates is positive, the filter strategies are ranked by the\n"
+"size with the fast compression first, and only the top filter_candidates\n"
+"of them are compressed with Zopfli. The filter strategies are the 8 ones\n"
+"except 'b' when auto_filter_strategy is true. The filter_estimates in the\n"
+"stats attribute is a dict of the size of each filter strategy with the fast\n"
+"compression, or None if filter_candidates is 0.\n"
+"\n"
+"verify is one of 'full' (decode the optimized PNG file), 'header'\n"
+"(check only the signature and the IHDR chunk), or 'none'.\n"
+"\n"
+"If deadline is positive, the iterations are reduced to finish each call\n"
+"within deadline seconds, and the remaining filter strategies are skipped\n"
+"once it has passed. If min_gain is positive, the iterations stop when an\n"
+"iteration reduces the size by less than min_gain. The iterations_used\n"
+"attribute is the limit of iterations and iterations_large in the last call\n"
+"to the optimize() method.\n"
+"\n"
+"The stats attribute is a dict of the statistics of the last call to the\n"
+"optimize() method, and stats_callback is called with it if not None. The\n"
+"filter_strategy in it is None if the strategy cannot be determined from the\n"
+"optimized PNG file.\n"
 "");
 
 static int PNG_init(PNG* self, PyObject* args, PyObject* kwargs) {
@@ -194,6 +312,12 @@ static int PNG_init(PNG* self, PyObject* args, PyObject* kwargs) {
         "use_zopfli",
         "iterations",
         "iterations_large",
+        "verify",
+        "deadline",
+        "min_gain",
+        "stats_callback",
+        "threads",
+        "filter_candidates",
         nullptr,
     };
 
@@ -205,10 +329,12 @@ static int PNG_init(PNG* self, PyObject* args, PyObject* kwargs) {
     PyObject* keep_color_type = Py_False;
     PyObject* keep_chunks = nullptr;
     PyObject* use_zopfli = Py_True;
+    PyObject* verify = nullptr;
+    PyObject* stats_callback = Py_None;
     clear(self->options);
-    self->options = new ZopfliPNGOptions;
+    self->options = new Options;
     if (!PyArg_ParseTupleAndKeywords(args, kwargs,
-                                     "|OOOOOOOOii:ZopfliPNG", const_cast<char**>(kwlist),
+                                     "|OOOOOOOOiiOddOii:ZopfliPNG", const_cast<char**>(kwlist),
                                      &verbose,
                                      &lossy_transparent,
                                      &lossy_8bit,
@@ -218,9 +344,19 @@ static int PNG_init(PNG* self, PyObject* args, PyObject* kwargs) {
                                      &keep_chunks,
                                      &use_zopfli,
                                      &self->options->num_iterations,
-                                     &self->options->num_iterations_large)) {
+                                     &self->options->num_iterations_large,
+                                     &verify,
+                                     &self->options->deadline,
+                                     &self->options->min_gain,
+                                     &stats_callback,
+                                     &self->options->threads,
+                                     &self->options->filter_candidates)) {
         return -1;
     }
+    if (check_budget(self) < 0
+        || stats_parse_callback(stats_callback) < 0) {
+        goto err;
+    }
 
 #define PARSE_BOOL(var, val)            \
     do {                                \
@@ -257,6 +393,14 @@ static int PNG_init(PNG* self, PyObject* args, PyObject* kwargs) {
 
 #undef PARSE_OBJECT
 
+    if (verify != nullptr
+        && parse_verify(self, verify) < 0) {
+        goto err;
+    }
+    Py_CLEAR(self->stats);
+    Py_INCREF(stats_callback);
+    Py_XSETREF(self->stats_callback, stats_callback);
+
 #ifdef WITH_THREAD
     ALLOCATE_LOCK(self);
     if (PyErr_Occurred() != nullptr) {
@@ -266,20 +410,340 @@ static int PNG_init(PNG* self, PyObject* args, PyObject* kwargs) {
 
     return 0;
 err:
-    Py_CLEAR(self->filter_strategies);
-    Py_CLEAR(self->keep_chunks);
+    PNG_clear(self);
     clear(self->options);
     return -1;
 }
 
+// error codes which are not used by LodePNG
+static const unsigned VERIFICATION_FAILED = ~0u;
+static const unsigned CANCELLED = ~0u - 1;
+static const unsigned SKIPPED = ~0u - 2;
+
+static const char filter_names[] = "01234mepb";
+
+// the enabled filter strategies in the same order as ZopfliPNGOptimize()
+static std::vector<ZopfliPNGFilterStrategy> filter_strategies(const Options& options) {
+    std::vector<ZopfliPNGFilterStrategy> strategies;
+    for (int i = 0; i < kNumFilterStrategies; ++i) {
+        ZopfliPNGFilterStrategy fs = static_cast<ZopfliPNGFilterStrategy>(i);
+        if (std::find(options.filter_strategies.begin(), options.filter_strategies.end(), fs) != options.filter_strategies.end()) {
+            strategies.push_back(fs);
+        }
+    }
+    return strategies;
+}
+
+// optimize in with each of strategies separately on up to options.threads
+// native threads. the remaining strategies are skipped once budget is
+// cancelled, or once its deadline has passed after a strategy finished
+static void optimize_each(const Options& options, const std::vector<ZopfliPNGFilterStrategy>& strategies, const std::vector<unsigned char>& in,
+                          const Budget* budget, std::vector<std::vector<unsigned char>>* outs, std::vector<unsigned>* errs) {
+    size_t n = strategies.size();
+    outs->assign(n, std::vector<unsigned char>());
+    errs->assign(n, SKIPPED);
+    std::atomic<size_t> next(0);
+    std::atomic<bool> done(false);
+    auto worker = [&] {
+        for (size_t i; (i = next++) < n;) {
+            if (budget->cancelled
+                || (budget->deadline > 0
+                    && done
+                    && monotonic() > budget->limit)) {
+                continue;
+            }
+            ZopfliPNGOptions opts = options;
+            opts.auto_filter_strategy = false;
+            opts.filter_strategies.assign(1, strategies[i]);
+            (*errs)[i] = ZopfliPNGOptimize(in, opts, opts.verbose, &(*outs)[i]);
+            done = true;
+        }
+    };
+    std::vector<std::thread> threads;
+    try {
+        for (size_t i = 1; i < std::min(n, static_cast<size_t>(options.threads)); ++i) {
+            threads.emplace_back(worker);
+        }
+    } catch (const std::system_error&) {
+        // the remaining strategies are tried on the running threads
+    }
+    worker();
+    for (auto& t : threads) {
+        t.join();
+    }
+}
+
+// the error of the last tried strategy, or CANCELLED if all of them are skipped
+static unsigned last_error(const std::vector<unsigned>& errs) {
+    auto it = std::find_if(errs.rbegin(), errs.rend(), [](unsigned v) { return v != SKIPPED; });
+    return it != errs.rend() ? *it : CANCELLED;
+}
+
+// same as ZopfliPNGOptimize(), but the filter strategies are tried one by
+// one on up to options.threads native threads, and the chosen one is stored
+// in strategy when it is known
+static unsigned optimize_png(const Options& options, const std::vector<unsigned char>& in, const Budget* budget, std::vector<unsigned char>* out,
+                             char* strategy) {
+    std::vector<ZopfliPNGFilterStrategy> strategies = filter_strategies(options);
+    size_t n = strategies.size();
+    if (options.auto_filter_strategy
+        || n <= 1) {
+        if (!options.auto_filter_strategy
+            && n == 1) {
+            *strategy = filter_names[strategies[0]];
+        }
+        return ZopfliPNGOptimize(in, options, options.verbose, out);
+    }
+
+    std::vector<std::vector<unsigned char>> outs;
+    std::vector<unsigned> errs;
+    optimize_each(options, strategies, in, budget, &outs, &errs);
+    // the first smallest one is kept, and the error of the last tried one is
+    // returned
+    size_t best = n;
+    for (size_t i = 0; i < n; ++i) {
+        if (!errs[i]
+            && (best == n || outs[i].size() < outs[best].size())) {
+            best = i;
+        }
+    }
+    if (best != n) {
+        out->swap(outs[best]);
+        *strategy = filter_names[strategies[best]];
+    }
+    return last_error(errs);
+}
+
+// rank the filter strategies by the size with the fast compression, and
+// limit pruned to the top options.filter_candidates of them
+static unsigned prune(const Options& options, const std::vector<unsigned char>& in, const Budget* budget, Options* pruned, PNGStats* stats) {
+    std::vector<ZopfliPNGFilterStrategy> strategies;
+    if (options.auto_filter_strategy) {
+        // AutoChooseFilterStrategy() does not try brute force
+        for (int i = 0; i < kStrategyBruteForce; ++i) {
+            strategies.push_back(static_cast<ZopfliPNGFilterStrategy>(i));
+        }
+    } else {
+        strategies = filter_strategies(options);
+    }
+    Options fast = options;
+    fast.use_zopfli = false;
+    std::vector<std::vector<unsigned char>> outs;
+    std::vector<unsigned> errs;
+    optimize_each(fast, strategies, in, budget, &outs, &errs);
+
+    std::vector<size_t> order;
+    for (size_t i = 0; i < strategies.size(); ++i) {
+        if (!errs[i]) {
+            order.push_back(i);
+            stats->estimates.emplace_back(filter_names[strategies[i]], outs[i].size());
+        }
+    }
+    if (order.empty()) {
+        return errs.empty() ? 0 : last_error(errs);
+    }
+    // ties are broken in the same order as ZopfliPNGOptimize()
+    std::stable_sort(order.begin(), order.end(), [&](size_t a, size_t b) { return outs[a].size() < outs[b].size(); });
+    order.resize(std::min(order.size(), static_cast<size_t>(options.filter_candidates)));
+    pruned->auto_filter_strategy = false;
+    pruned->filter_strategies.clear();
+    for (size_t i : order) {
+        pruned->filter_strategies.push_back(strategies[i]);
+    }
+    return 0;
+}
+
+struct Trial {
+    Options                           options;
+    const std::vector<unsigned char>* in;
+    const Budget*                     budget;
+    std::vector<unsigned char>*       out;
+    unsigned                          err;
+    char                              strategy;
+};
+
+static size_t optimize_trial(void* arg, int k) {
+    Trial* t = static_cast<Trial*>(arg);
+    Options options = t->options;
+    options.num_iterations = std::min(options.num_iterations, k);
+    options.num_iterations_large = std::min(options.num_iterations_large, k);
+    std::vector<unsigned char> out;
+    char strategy = '\0';
+    unsigned err = optimize_png(options, *t->in, t->budget, &out, &strategy);
+    if (err) {
+        if (t->out->empty()) {
+            t->err = err;
+        }
+        return 0;
+    }
+    size_t size = out.size();
+    if (t->out->empty()
+        || size < t->out->size()) {
+        t->out->swap(out);
+        t->strategy = strategy;
+    }
+    // the later trials only run the smallest filter strategy of the first one
+    if (t->strategy != '\0'
+        && t->options.filter_strategies.size() > 1) {
+        size_t i = std::strchr(filter_names, t->strategy) - filter_names;
+        t->options.filter_strategies.assign(1, static_cast<ZopfliPNGFilterStrategy>(i));
+    }
+    return size;
+}
+
+static unsigned optimize(const Options& options, std::vector<unsigned char>& buf, std::vector<unsigned char>* out, Budget* budget, PNGStats* stats) {
+    int max = std::max(options.num_iterations, options.num_iterations_large);
+    budget->deadline = options.deadline;
+    budget->min_gain = options.min_gain;
+    budget_start(budget, max);
+    *stats = PNGStats();
+    stats->bytes_in = buf.size();
+    double start = monotonic();
+    Options pruned = options;
+    unsigned err = 0;
+    if (budget->cancelled) {
+        err = CANCELLED;
+    } else if (options.filter_candidates > 0) {
+        err = prune(options, buf, budget, &pruned, stats);
+        stats->search_time = monotonic() - start;
+    }
+    if (err) {
+        // nothing to do
+    } else if (budget_active(budget)) {
+        Trial t = {pruned, &buf, budget, out, 0, '\0'};
+        double cost;
+        budget_search(budget, max, 1.0, optimize_trial, &t, &cost);
+        err = t.err;
+        stats->strategy = t.strategy;
+        stats->search_time = monotonic() - start;
+    } else {
+        err = optimize_png(pruned, buf, budget, out, &stats->strategy);
+    }
+    stats->time = monotonic() - start;
+    stats->bytes_out = out->size();
+    if (budget->cancelled) {
+        err = CANCELLED;
+    }
+    // release the input before verification
+    std::vector<unsigned char>().swap(buf);
+    if (err) {
+        return err;
+    }
+    unsigned w, h;
+    switch (options.verify) {
+    case VERIFY_FULL:
+        {
+            std::vector<unsigned char> image;
+            if (lodepng::decode(image, w, h, *out)) {
+                return VERIFICATION_FAILED;
+            }
+        }
+        break;
+    case VERIFY_HEADER:
+        {
+            lodepng::State state;
+            if (lodepng_inspect(&w, &h, &state, out->data(), out->size())) {
+                return VERIFICATION_FAILED;
+            }
+        }
+        break;
+    case VERIFY_NONE:
+        break;
+    }
+    return 0;
+}
+
+// the filter strategy used for png, or '\0' if it cannot be determined
+static char filter_strategy(const Options& options, const std::vector<unsigned char>& png) {
+    std::vector<ZopfliPNGFilterStrategy> fs = options.filter_strategies;
+    if (options.auto_filter_strategy) {
+        fs.clear();
+        // AutoChooseFilterStrategy() does not try brute force
+        for (int i = 0; i < kStrategyBruteForce; ++i) {
+            fs.push_back(static_cast<ZopfliPNGFilterStrategy>(i));
+        }
+    }
+    if (!fs.empty()
+        && std::all_of(fs.begin(), fs.end(), [&](ZopfliPNGFilterStrategy v) { return v == fs[0]; })) {
+        return filter_names[fs[0]];
+    }
+    // the filter type of each scanline
+    std::vector<unsigned char> types;
+    if (lodepng::getFilterTypes(types, png)
+        || types.empty()
+        || types[0] > kStrategyFour
+        || !std::all_of(types.begin(), types.end(), [&](unsigned char v) { return v == types[0]; })
+        || std::find(fs.begin(), fs.end(), types[0]) == fs.end()) {
+        return '\0';
+    }
+    return filter_names[types[0]];
+}
+
+static PyObject* png_estimates(const PNGStats& stats) {
+    PyObject* v = PyDict_New();
+    if (v == nullptr) {
+        return nullptr;
+    }
+    for (const auto& e : stats.estimates) {
+        PyObject* k = PyUnicode_FromStringAndSize(&e.first, 1);
+        PyObject* size = PyLong_FromSize_t(e.second);
+        int rv = k != nullptr && size != nullptr ? PyDict_SetItem(v, k, size) : -1;
+        Py_XDECREF(k);
+        Py_XDECREF(size);
+        if (rv < 0) {
+            Py_DECREF(v);
+            return nullptr;
+        }
+    }
+    return v;
+}
+
+static PyObject* png_stats(const PNGStats& stats, int iterations, const Options& options, const std::vector<unsigned char>& png) {
+    PyObject* v = stats_new(&stats, iterations);
+    if (v == nullptr) {
+        return nullptr;
+    }
+    char strategy = stats.strategy != '\0' ? stats.strategy : filter_strategy(options, png);
+    PyObject* s = strategy != '\0' ? PyUnicode_FromStringAndSize(&strategy, 1) : (Py_INCREF(Py_None), Py_None);
+    if (s == nullptr
+        || PyDict_SetItemString(v, "filter_strategy", s) < 0) {
+        Py_XDECREF(s);
+        Py_DECREF(v);
+        return nullptr;
+    }
+    Py_DECREF(s);
+    PyObject* e = options.filter_candidates > 0 ? png_estimates(stats) : (Py_INCREF(Py_None), Py_None);
+    if (e == nullptr
+        || PyDict_SetItemString(v, "filter_estimates", e) < 0) {
+        Py_XDECREF(e);
+        Py_DECREF(v);
+        return nullptr;
+    }
+    Py_DECREF(e);
+    return v;
+}
+
+static void set_error(unsigned err) {
+    if (err == VERIFICATION_FAILED) {
+        PyErr_SetString(PyExc_ValueError, "verification failed");
+    } else if (err == CANCELLED) {
+        PyErr_SetString(PyExc_RuntimeError, "PNG has been cancelled");
+    } else {
+        PyErr_SetString(PyExc_ValueError, lodepng_error_text(err));
+    }
+}
+
 PyDoc_STRVAR(PNG_optimize__doc__,
 "optimize(data) -> bytes");
 
 static PyObject* PNG_optimize(PNG* self, PyObject* data) {
     PyObject* v = nullptr;
+    PyObject* stats = nullptr;
+    PyObject* callback = nullptr;
     Py_buffer in = {};
     std::vector<unsigned char> out, buf;
     unsigned char* p;
+    PNGStats s;
     ACQUIRE_LOCK(self);
     if (PyObject_GetBuffer(data, &in, PyBUF_CONTIG_RO) < 0) {
         goto out;
@@ -288,30 +752,439 @@ static PyObject* PNG_optimize(PNG* self, PyObject* data) {
     buf.assign(p, p + in.len);
     unsigned err;
     Py_BEGIN_ALLOW_THREADS
-    err = ZopfliPNGOptimize(buf, *self->options, self->options->verbose, &out);
+    err = optimize(*self->options, buf, &out, &self->budget, &s);
     Py_END_ALLOW_THREADS
     if (err) {
-        PyErr_SetString(PyExc_ValueError, lodepng_error_text(err));
+        set_error(err);
         goto out;
     }
-    buf.clear();
-    unsigned w, h;
-    Py_BEGIN_ALLOW_THREADS
-    err = lodepng::decode(buf, w, h, out);
-    Py_END_ALLOW_THREADS
-    if (err) {
-        PyErr_SetString(PyExc_ValueError, "verification failed");
+    stats = png_stats(s, self->budget.iterations, *self->options, out);
+    if (stats == nullptr) {
         goto out;
     }
+    Py_XSETREF(self->stats, stats);
+    Py_INCREF(stats);
+    callback = self->stats_callback;
+    Py_INCREF(callback);
     v = PyBytes_FromStringAndSize(reinterpret_cast<char*>(&out[0]), out.size());
 out:
     PyBuffer_Release(&in);
     RELEASE_LOCK(self);
+    if (v != nullptr
+        && stats_report(callback, stats) < 0) {
+        Py_CLEAR(v);
+    }
+    Py_XDECREF(stats);
+    Py_XDECREF(callback);
+    return v;
+}
+
+PyDoc_STRVAR(PNG_optimize_file__doc__,
+"optimize_file(src, dst) -> None\n"
+"\n"
+"Optimize the PNG file src, and write it to dst. Both files are read and\n"
+"written without holding the GIL, and dst can be the same as src.");
+
+static PyObject* PNG_optimize_file(PNG* self, PyObject* args) {
+    PyObject* src;
+    PyObject* dst;
+    if (!PyArg_ParseTuple(args, "O&O&:optimize_file", PyUnicode_FSConverter, &src, PyUnicode_FSConverter, &dst)) {
+        return nullptr;
+    }
+
+    PyObject* v = nullptr;
+    PyObject* stats = nullptr;
+    PyObject* callback = nullptr;
+    std::string src_path = PyBytes_AS_STRING(src);
+    std::string dst_path = PyBytes_AS_STRING(dst);
+    std::vector<unsigned char> out, buf;
+    PNGStats s;
+    unsigned err;
+    int errnum = 0;
+    PyObject* path = nullptr;
+    ACQUIRE_LOCK(self);
+    Py_BEGIN_ALLOW_THREADS
+    if (lodepng::load_file(buf, src_path)) {
+        errnum = errno;
+        path = src;
+        err = 0;
+    } else {
+        err = optimize(*self->options, buf, &out, &self->budget, &s);
+        if (!err
+            && lodepng::save_file(out, dst_path)) {
+            errnum = errno;
+            path = dst;
+        }
+    }
+    Py_END_ALLOW_THREADS
+    if (path != nullptr) {
+        errno = errnum;
+        PyErr_SetFromErrnoWithFilenameObject(PyExc_OSError, path);
+        goto out;
+    } else if (err) {
+        set_error(err);
+        goto out;
+    }
+    stats = png_stats(s, self->budget.iterations, *self->options, out);
+    if (stats == nullptr) {
+        goto out;
+    }
+    Py_XSETREF(self->stats, stats);
+    Py_INCREF(stats);
+    callback = self->stats_callback;
+    Py_INCREF(callback);
+    Py_INCREF(Py_None);
+    v = Py_None;
+out:
+    RELEASE_LOCK(self);
+    Py_DECREF(src);
+    Py_DECREF(dst);
+    if (v != nullptr
+        && stats_report(callback, stats) < 0) {
+        Py_CLEAR(v);
+    }
+    Py_XDECREF(stats);
+    Py_XDECREF(callback);
     return v;
 }
 
+struct Batch {
+    struct Item {
+        Py_buffer                  in;
+        std::string                path;
+        bool                       done;
+        unsigned                   err;
+        std::vector<unsigned char> out;
+        PNGStats                   stats;
+        int                        iterations;
+    };
+
+    PyObject_HEAD
+    Options*                 options;
+    PyObject*                stats_callback;
+    std::vector<Item>*       items;
+    std::vector<std::thread>* threads;
+    std::mutex*              mutex;
+    std::condition_variable* cond;
+    size_t                   next;
+    size_t                   pos;
+    bool                     ordered;
+    bool                     cancelled;
+};
+
+static void Batch_worker(Batch* self) {
+    for (;;) {
+        size_t i;
+        {
+            std::lock_guard<std::mutex> lock(*self->mutex);
+            if (self->cancelled
+                || self->next == self->items->size()) {
+                break;
+            }
+            i = self->next++;
+        }
+
+        Batch::Item& item = (*self->items)[i];
+        std::vector<unsigned char> buf, out;
+        Budget budget = {};
+        PNGStats stats;
+        unsigned err = 0;
+        if (item.in.obj != nullptr) {
+            unsigned char* p = static_cast<unsigned char*>(item.in.buf);
+            buf.assign(p, p + item.in.len);
+        } else {
+            err = lodepng::load_file(buf, item.path);
+        }
+        if (!err) {
+            err = optimize(*self->options, buf, &out, &budget, &stats);
+        }
+
+        std::lock_guard<std::mutex> lock(*self->mutex);
+        item.err = err;
+        item.out.swap(out);
+        item.stats = stats;
+        item.iterations = budget.iterations;
+        item.done = true;
+        self->cond->notify_all();
+    }
+}
+
+static int Batch_traverse(Batch* self, visitproc visit, void* arg) {
+    if (self->items != nullptr) {
+        for (auto& item : *self->items) {
+            Py_VISIT(item.in.obj);
+        }
+    }
+    Py_VISIT(self->stats_callback);
+    return 0;
+}
+
+static int Batch_clear(Batch* self) {
+    Py_CLEAR(self->stats_callback);
+    return 0;
+}
+
+static void Batch_dealloc(Batch* self) {
+    PyObject_GC_UnTrack(self);
+    if (self->threads != nullptr) {
+        {
+            std::lock_guard<std::mutex> lock(*self->mutex);
+            self->cancelled = true;
+        }
+        Py_BEGIN_ALLOW_THREADS
+        for (auto& t : *self->threads) {
+            t.join();
+        }
+        Py_END_ALLOW_THREADS
+        clear(self->threads);
+    }
+    if (self->items != nullptr) {
+        for (auto& item : *self->items) {
+            PyBuffer_Release(&item.in);
+        }
+        clear(self->items);
+    }
+    clear(self->cond);
+    clear(self->mutex);
+    clear(self->options);
+    Batch_clear(self);
+    Py_TYPE(self)->tp_free(reinterpret_cast<PyObject*>(self));
+}
+
+static PyObject* Batch_next(Batch* self) {
+    std::vector<Batch::Item>& items = *self->items;
+    size_t i = items.size();
+    unsigned err = 0;
+    std::vector<unsigned char> out;
+    Py_BEGIN_ALLOW_THREADS
+    std::unique_lock<std::mutex> lock(*self->mutex);
+    self->cond->wait(lock, [&] {
+        if (self->pos == items.size()) {
+            return true;
+        } else if (self->ordered) {
+            if (items[self->pos].done) {
+                i = self->pos;
+            }
+        } else {
+            for (size_t j = 0; j < self->next; ++j) {
+                if (items[j].done) {
+                    i = j;
+                    break;
+                }
+            }
+        }
+        return i != items.size();
+    });
+    if (i != items.size()) {
+        items[i].done = false;
+        ++self->pos;
+        err = items[i].err;
+        out.swap(items[i].out);
+    }
+    lock.unlock();
+    Py_END_ALLOW_THREADS
+    if (i == items.size()) {
+        return nullptr;
+    }
+
+    PyBuffer_Release(&items[i].in);
+    if (err) {
+        set_error(err);
+        return nullptr;
+    }
+    if (self->stats_callback != nullptr
+        && self->stats_callback != Py_None) {
+        PyObject* stats = png_stats(items[i].stats, items[i].iterations, *self->options, out);
+        if (stats == nullptr) {
+            return nullptr;
+        }
+        int rv = stats_report(self->stats_callback, stats);
+        Py_DECREF(stats);
+        if (rv < 0) {
+            return nullptr;
+        }
+    }
+    PyObject* v = PyBytes_FromStringAndSize(reinterpret_cast<char*>(&out[0]), out.size());
+    if (v == nullptr
+        || self->ordered) {
+        return v;
+    }
+    return Py_BuildValue("nN", static_cast<Py_ssize_t>(i), v);
+}
+
+PyTypeObject Batch_Type = {
+    PyVarObject_HEAD_INIT(0, 0)
+    MODULE ".ZopfliPNGBatch",                                      // tp_name
+    sizeof(Batch),                                                 // tp_basicsize
+    0,                                                             // tp_itemsize
+    reinterpret_cast<destructor>(Batch_dealloc),                   // tp_dealloc
+    0,                                                             // tp_vectorcall_offset
+    0,                                                             // tp_getattr
+    0,                                                             // tp_setattr
+    0,                                                             // tp_reserved
+    0,                                                             // tp_repr
+    0,                                                             // tp_as_number
+    0,                                                             // tp_as_sequence
+    0,                                                             // tp_as_mapping
+    0,                                                             // tp_hash
+    0,                                                             // tp_call
+    0,                                                             // tp_str
+    0,                                                             // tp_getattro
+    0,                                                             // tp_setattro
+    0,                                                             // tp_as_buffer
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC,                       // tp_flags
+    0,                                                             // tp_doc
+    reinterpret_cast<traverseproc>(Batch_traverse),                // tp_traverse
+    reinterpret_cast<inquiry>(Batch_clear),                        // tp_clear
+    0,                                                             // tp_richcompare
+    0,                                                             // tp_weaklistoffset
+    PyObject_SelfIter,                                             // tp_iter
+    reinterpret_cast<iternextfunc>(Batch_next),                    // tp_iternext
+    0,                                                             // tp_methods
+    0,                                                             // tp_members
+    0,                                                             // tp_getset
+    0,                                                             // tp_base
+    0,                                                             // tp_dict
+    0,                                                             // tp_descr_get
+    0,                                                             // tp_descr_set
+    0,                                                             // tp_dictoffset
+    0,                                                             // tp_init
+    0,                                                             // tp_alloc
+    0,                                                             // tp_new
+};
+
+PyDoc_STRVAR(PNG_optimize_many__doc__,
+"optimize_many(iterable, workers=0, ordered=True) -> iterator\n"
+"\n"
+"Optimize PNG files on up to workers native threads, or the number of\n"
+"CPUs if workers is 0. Each item of iterable is either bytes-like object\n"
+"or a path.\n"
+"\n"
+"The returned iterator yields the optimized data in the same order as\n"
+"iterable. If ordered is false, it yields (index, data) tuples as soon as\n"
+"each item is optimized. stats_callback is called before each item is\n"
+"yielded.");
+
+static PyObject* PNG_optimize_many(PNG* self, PyObject* args, PyObject* kwargs) {
+    static const char* kwlist[] = {
+        "iterable",
+        "workers",
+        "ordered",
+        nullptr,
+    };
+
+    PyObject* iterable;
+    int workers = 0;
+    PyObject* ordered = Py_True;
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs,
+                                     "O|iO:optimize_many", const_cast<char**>(kwlist),
+                                     &iterable,
+                                     &workers,
+                                     &ordered)) {
+        return nullptr;
+    }
+    if (workers < 0) {
+        PyErr_SetString(PyExc_ValueError, "workers must be non-negative");
+        return nullptr;
+    }
+    int b = PyObject_IsTrue(ordered);
+    if (b < 0) {
+        return nullptr;
+    }
+
+    PyObject* it = PyObject_GetIter(iterable);
+    if (it == nullptr) {
+        return nullptr;
+    }
+    Batch* batch = PyObject_GC_New(Batch, &Batch_Type);
+    if (batch == nullptr) {
+        Py_DECREF(it);
+        return nullptr;
+    }
+    batch->items = new std::vector<Batch::Item>;
+    batch->stats_callback = nullptr;
+    batch->threads = nullptr;
+    batch->mutex = new std::mutex;
+    batch->cond = new std::condition_variable;
+    batch->next = 0;
+    batch->pos = 0;
+    batch->ordered = !!b;
+    batch->cancelled = false;
+    ACQUIRE_LOCK(self);
+    batch->options = new Options(*self->options);
+    batch->stats_callback = self->stats_callback;
+    Py_INCREF(batch->stats_callback);
+    RELEASE_LOCK(self);
+
+    PyObject* o;
+    while ((o = PyIter_Next(it)) != nullptr) {
+        batch->items->emplace_back();
+        Batch::Item& item = batch->items->back();
+        item.in = {};
+        item.done = false;
+        item.err = 0;
+        if (PyObject_CheckBuffer(o)) {
+            if (PyObject_GetBuffer(o, &item.in, PyBUF_CONTIG_RO) < 0) {
+                Py_DECREF(o);
+                break;
+            }
+        } else {
+            PyObject* path;
+            if (!PyUnicode_FSConverter(o, &path)) {
+                Py_DECREF(o);
+                break;
+            }
+            item.path = PyBytes_AS_STRING(path);
+            Py_DECREF(path);
+        }
+        Py_DECREF(o);
+    }
+    Py_DECREF(it);
+    if (PyErr_Occurred() != nullptr) {
+        Py_DECREF(batch);
+        return nullptr;
+    }
+
+    size_t n = workers > 0 ? workers : std::thread::hardware_concurrency();
+    if (n > batch->items->size()) {
+        n = batch->items->size();
+    }
+    batch->threads = new std::vector<std::thread>;
+    try {
+        for (size_t i = 0; i < n || batch->threads->empty(); ++i) {
+            batch->threads->emplace_back(Batch_worker, batch);
+        }
+    } catch (const std::system_error&) {
+        if (batch->threads->empty()) {
+            PyErr_SetString(PyExc_RuntimeError, "can't start new thread");
+            Py_DECREF(batch);
+            return nullptr;
+        }
+    }
+    PyObject_GC_Track(batch);
+    return reinterpret_cast<PyObject*>(batch);
+}
+
+PyDoc_STRVAR(PNG_cancel__doc__,
+"cancel() -> None\n"
+"\n"
+"Stop the optimization in progress in another thread before the next filter\n"
+"strategy, or before the next trial of the iterations. The compression with\n"
+"a filter strategy is not interrupted, and all the filter strategies are\n"
+"compressed at once when auto_filter_strategy is true and filter_candidates\n"
+"is 0. The PNG optimizer cannot be used after this method is called.");
+
+static PyObject* PNG_cancel(PNG* self) {
+    // the lock is held while optimizing
+    self->budget.cancelled = 1;
+    Py_RETURN_NONE;
+}
+
 static PyMethodDef PNG_methods[] = {
-    {"optimize", reinterpret_cast<PyCFunction>(PNG_optimize), METH_O, PNG_optimize__doc__},
+    {"optimize",      reinterpret_cast<PyCFunction>(PNG_optimize),      METH_O,                       PNG_optimize__doc__},
+    {"optimize_file", reinterpret_cast<PyCFunction>(PNG_optimize_file), METH_VARARGS,                 PNG_optimize_file__doc__},
+    {"optimize_many", reinterpret_cast<PyCFunction>(PNG_optimize_many), METH_VARARGS | METH_KEYWORDS, PNG_optimize_many__doc__},
+    {"cancel",        reinterpret_cast<PyCFunction>(PNG_cancel),        METH_NOARGS,                  PNG_cancel__doc__},
     {},
 };
 
@@ -322,6 +1195,12 @@ static PyObject* PNG_get_object(PNG* self, void* closure) {
         v = self->filter_strategies;
     } else if (strcmp(s, "keep_chunks") == 0) {
         v = self->keep_chunks;
+    } else if (strcmp(s, "verify") == 0) {
+        return str_FromString(verify_names[self->options->verify]);
+    } else if (strcmp(s, "stats") == 0) {
+        v = self->stats != nullptr ? self->stats : Py_None;
+    } else if (strcmp(s, "stats_callback") == 0) {
+        v = self->stats_callback;
     }
 
     Py_INCREF(v);
@@ -343,6 +1222,16 @@ static int PNG_set_object(PNG* self, PyObject* value, void* closure) {
         if (parse_keep_chunks(self, value) < 0) {
             return -1;
         }
+    } else if (strcmp(s, "verify") == 0) {
+        if (parse_verify(self, value) < 0) {
+            return -1;
+        }
+    } else if (strcmp(s, "stats_callback") == 0) {
+        if (stats_parse_callback(value) < 0) {
+            return -1;
+        }
+        Py_INCREF(value);
+        Py_SETREF(self->stats_callback, value);
     }
     return 0;
 }
@@ -410,6 +1299,12 @@ static PyObject* PNG_get_int(PNG* self, void* closure) {
         v = self->options->num_iterations;
     } else if (strcmp(s, "iterations_large") == 0) {
         v = self->options->num_iterations_large;
+    } else if (strcmp(s, "iterations_used") == 0) {
+        v = self->budget.iterations;
+    } else if (strcmp(s, "threads") == 0) {
+        v = self->options->threads;
+    } else if (strcmp(s, "filter_candidates") == 0) {
+        v = self->options->filter_candidates;
     }
 
     return int_FromLong(v);
@@ -430,6 +1325,54 @@ static int PNG_set_int(PNG* self, PyObject* value, void* closure) {
         self->options->num_iterations = v;
     } else if (strcmp(s, "iterations_large") == 0) {
         self->options->num_iterations_large = v;
+    } else if (strcmp(s, "threads") == 0) {
+        if (v < 1
+            || v > INT_MAX) {
+            PyErr_SetString(PyExc_ValueError, "threads must be positive");
+            return -1;
+        }
+        self->options->threads = static_cast<int>(v);
+    } else if (strcmp(s, "filter_candidates") == 0) {
+        if (v < 0
+            || v > INT_MAX) {
+            PyErr_SetString(PyExc_ValueError, "filter_candidates must be non-negative");
+            return -1;
+        }
+        self->options->filter_candidates = static_cast<int>(v);
+    }
+    return 0;
+}
+
+static PyObject* PNG_get_float(PNG* self, void* closure) {
+    const char* s = static_cast<char*>(closure);
+    double v = 0.0;
+    if (strcmp(s, "deadline") == 0) {
+        v = self->options->deadline;
+    } else if (strcmp(s, "min_gain") == 0) {
+        v = self->options->min_gain;
+    }
+
+    return PyFloat_FromDouble(v);
+}
+
+static int PNG_set_float(PNG* self, PyObject* value, void* closure) {
+    const char* s = static_cast<char*>(closure);
+    if (value == nullptr) {
+        PyErr_Format(PyExc_TypeError, "cannot delete %s", s);
+        return -1;
+    }
+    double v = PyFloat_AsDouble(value);
+    if (PyErr_Occurred() != nullptr) {
+        return -1;
+    } else if (v < 0) {
+        PyErr_Format(PyExc_ValueError, "%s must be non-negative", s);
+        return -1;
+    }
+
+    if (strcmp(s, "deadline") == 0) {
+        self->options->deadline = v;
+    } else if (strcmp(s, "min_gain") == 0) {
+        self->options->min_gain = v;
     }
     return 0;
 }
@@ -447,6 +1390,14 @@ static PyGetSetDef PNG_getset[] = {
     GET_SET(use_zopfli,           bool),
     GET_SET(iterations,           int),
     GET_SET(iterations_large,     int),
+    GET_SET(verify,               object),
+    GET_SET(deadline,             float),
+    GET_SET(min_gain,             float),
+    GET_SET(stats_callback,       object),
+    GET_SET(threads,              int),
+    GET_SET(filter_candidates,    int),
+    {const_cast<char*>("iterations_used"), reinterpret_cast<getter>(PNG_get_int), nullptr, nullptr, const_cast<char*>("iterations_used")},
+    {const_cast<char*>("stats"), reinterpret_cast<getter>(PNG_get_object), nullptr, nullptr, const_cast<char*>("stats")},
     {},
 };
 
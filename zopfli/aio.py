@@ -0,0 +1,107 @@
+#
+# zopfli.aio
+#
+#   Copyright (c) 2026 Akinori Hattori <hattya@gmail.com>
+#
+#   SPDX-License-Identifier: Apache-2.0
+#
+
+"""asyncio interface for Zopfli"""
+
+from __future__ import annotations
+import asyncio
+from collections.abc import Callable
+import concurrent.futures
+import os
+import threading
+from typing import Any, AnyStr, TypeVar
+import zipfile
+
+from . import ZOPFLI_FORMAT_DEFLATE, P, ZipFile, ZopfliCompressor, ZopfliPNG, _Compressed
+
+
+__all__ = ['compress', 'optimize_png', 'write', 'writestr', 'set_max_workers']
+
+T = TypeVar('T')
+
+_lock = threading.Lock()
+_executor: concurrent.futures.ThreadPoolExecutor | None = None
+_max_workers: int | None = None
+
+
+def set_max_workers(max_workers: int | None) -> None:
+    global _executor, _max_workers
+
+    if (max_workers is not None
+        and max_workers <= 0):
+        raise ValueError('max_workers must be greater than 0')
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+        _max_workers = max_workers
+
+
+async def compress(data: bytes, format: int = ZOPFLI_FORMAT_DEFLATE, **kwargs: Any) -> bytes:
+    c = ZopfliCompressor(format, **kwargs)
+    return await _run(lambda: c.compress(data) + c.flush(), c.cancel)
+
+
+async def optimize_png(data: bytes, **kwargs: Any) -> bytes:
+    png = ZopfliPNG(**kwargs)
+    return await _run(lambda: png.optimize(data), png.cancel)
+
+
+async def write(zf: ZipFile, filename: P, arcname: P | None = None,
+                compress_type: int | None = None, compresslevel: int | None = None, **kwargs: Any) -> None:
+    if not zf._zopflify(compress_type):
+        await _run(lambda: zf.write(filename, arcname, compress_type, compresslevel), lambda: None)
+        return
+
+    if zf._streamed(filename):
+        zs = zf._compressor(kwargs, stream=True)
+        await _run(lambda: zf._stream(filename, arcname, zs), zs.cancel)
+        return
+
+    z = zf._compressor(kwargs, zf._arcname(filename, arcname))
+
+    def write() -> None:
+        zf._write(filename, arcname, zipfile.ZIP_STORED, compresslevel, zf._compress(filename, z))
+
+    await _run(write, z.cancel)
+
+
+async def writestr(zf: ZipFile, zinfo_or_arcname: str | zipfile.ZipInfo, data: AnyStr,
+                   compress_type: int | None = None, compresslevel: int | None = None, **kwargs: Any) -> None:
+    compress_type, z = zf._prepare(zinfo_or_arcname, data, compress_type, kwargs)
+    if z is None:
+        await _run(lambda: zf._writestr(zinfo_or_arcname, data, compress_type, compresslevel, None), lambda: None)
+        return
+
+    def writestr() -> None:
+        b = data.encode('utf-8') if isinstance(data, str) else data
+        zf._writestr(zinfo_or_arcname, data, compress_type, compresslevel, _Compressed(z.compress(b) + z.flush()))
+
+    await _run(writestr, z.cancel)
+
+
+async def _run(func: Callable[[], T], cancel: Callable[[], None]) -> T:
+    fut = asyncio.get_running_loop().run_in_executor(_get_executor(), func)
+    try:
+        return await asyncio.shield(fut)
+    except asyncio.CancelledError:
+        cancel()
+        # wait until the native code stops to keep the number of workers
+        await asyncio.wait([fut])
+        if not fut.cancelled():
+            fut.exception()
+        raise
+
+
+def _get_executor() -> concurrent.futures.ThreadPoolExecutor:
+    global _executor
+
+    with _lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(_max_workers or os.cpu_count(), thread_name_prefix='zopfli')
+        return _executor